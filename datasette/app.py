@@ -7,8 +7,10 @@ from jinja2 import Environment, FileSystemLoader, ChoiceLoader, PrefixLoader
 import re
 import sqlite3
 from pathlib import Path
+from collections import OrderedDict
 from concurrent import futures
 import asyncio
+import bisect
 import os
 import threading
 import urllib.parse
@@ -17,33 +19,71 @@ import jinja2
 import hashlib
 import time
 from .utils import (
+    column_affinity,
     Filters,
     compound_pks_from_path,
+    CellRow,
     CustomJSONEncoder,
+    DatasetteError,
     detect_fts_sql,
     escape_css_string,
     escape_sqlite_table_name,
+    FACET_SIZE,
+    file_signature,
     filters_should_redirect,
-    get_all_foreign_keys,
+    fts_prefix_query,
+    has_rowid,
     is_url,
     InvalidSql,
+    LabelCache,
+    key_values_from_path,
+    keyset_where_clause,
     path_from_row_pks,
+    path_from_key_values,
     path_with_added_args,
     path_with_ext,
+    primary_keys_from_table_info,
     sqlite_timelimit,
     to_css_class,
+    TruncatedCell,
     validate_sql_select,
 )
+from .inspect import inspect_database, prepare_connection
 from .version import __version__
 
 app_root = Path(__file__).parent.parent
 
-HASH_BLOCK_SIZE = 1024 * 1024
 HASH_LENGTH = 7
+WATCH_INTERVAL = 1
+COUNT_CACHE_SIZE = 1000
+SUGGEST_CACHE_SIZE = 10000
+SUGGEST_SIZE = 10
+SEARCH_SIZE = 20
+LABEL_CACHE_SIZE = 10 * 1024 * 1024
+# Stays under SQLite's default limit of 999 variables per query
+LABEL_LOOKUP_CHUNK_SIZE = 500
+TRUNCATED_LENGTH_PREFIX = '$length:'
+# FTS snippets mark their matches with these, as they can't be in the text
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
 
 connections = threading.local()
 
 
+def highlighted_snippet(snippet):
+    "Escapes an FTS snippet for HTML, with <b> tags around the matches"
+    if snippet is None:
+        return ''
+    return jinja2.Markup(tagged_snippet(str(jinja2.escape(snippet))))
+
+
+def tagged_snippet(snippet):
+    "An FTS snippet with <b> tags around the matches, as returned in the JSON"
+    if snippet is None:
+        return None
+    return snippet.replace(SNIPPET_START, '<b>').replace(SNIPPET_END, '</b>')
+
+
 class RenderMixin(HTTPMethodView):
     def render(self, templates, **context):
         template = self.jinja_env.select_template(templates)
@@ -71,6 +111,10 @@ class BaseView(RenderMixin):
         self.executor = datasette.executor
         self.page_size = datasette.page_size
         self.max_returned_rows = datasette.max_returned_rows
+        # Inspect data for the databases this request uses, see database_info()
+        self.database_infos = {}
+        # With ?_explain=1, the query plans of every query the request runs
+        self.explain = None
 
     def options(self, request, *args, **kwargs):
         r = response.text('ok')
@@ -90,25 +134,67 @@ class BaseView(RenderMixin):
         return r
 
     async def pks_for_table(self, name, table):
-        rows = [
-            row for row in await self.execute(
-                name,
-                'PRAGMA table_info("{}")'.format(table)
-            )
-            if row[-1]
-        ]
-        rows.sort(key=lambda row: row[-1])
-        return [str(r[1]) for r in rows]
+        return (await self.table_schema(name, table))['primary_keys']
+
+    async def table_schema(self, name, table):
+        """
+        Returns the primary keys, view status, definition and FTS table for a
+        table or view. These are recorded at inspect time - inspect data from
+        older versions of datasette falls back to querying sqlite_master.
+        """
+        info = self.database_info(name)
+        table_info = info['tables'].get(table) or {}
+        if 'primary_keys' in table_info:
+            return {
+                'primary_keys': table_info['primary_keys'],
+                'is_view': False,
+                'definition': table_info['sql'],
+                'fts_table': table_info['fts_table'],
+            }
+        view_definitions = info.get('view_definitions')
+        if view_definitions is not None and table in view_definitions:
+            return {
+                'primary_keys': [],
+                'is_view': True,
+                'definition': view_definitions[table],
+                'fts_table': None,
+            }
+        pks = primary_keys_from_table_info(await self.execute(
+            name, 'PRAGMA table_info("{}")'.format(table)
+        ))
+        definitions = list(await self.execute(
+            name,
+            'select type, sql from sqlite_master where name = :n and type in ("table", "view")',
+            {'n': table}
+        ))
+        fts_rows = list(await self.execute(name, detect_fts_sql(table)))
+        return {
+            'primary_keys': pks,
+            'is_view': bool(definitions) and definitions[0][0] == 'view',
+            'definition': definitions[0][1] if definitions else None,
+            'fts_table': fts_rows[0][0] if fts_rows else None,
+        }
 
-    def resolve_db_name(self, db_name, **kwargs):
-        databases = self.ds.inspect()
+    def database_info(self, name):
+        """
+        Returns the inspect data for a database, keeping the data that
+        resolve_db_name() loaded for the rest of the request. In lazy mode
+        another request could evict the database in the meantime, and
+        inspecting it again here would block the event loop.
+        """
+        info = self.database_infos.get(name)
+        if info is None:
+            info = self.database_infos[name] = self.ds.database_info(name)
+        return info
+
+    async def resolve_db_name(self, db_name, **kwargs):
         hash = None
         name = None
         if '-' in db_name:
             # Might be name-and-hash, or might just be
             # a name with a hyphen in it
             name, hash = db_name.rsplit('-', 1)
-            if name not in databases:
+            if not self.ds.has_database(name):
                 # Try the whole name
                 name = db_name
                 hash = None
@@ -116,9 +202,17 @@ class BaseView(RenderMixin):
             name = db_name
         # Verify the hash
         try:
-            info = databases[name]
+            if self.ds.lazy:
+                # Inspecting a database for the first time means hashing
+                # the whole file, so keep that off the event loop
+                info = await asyncio.get_event_loop().run_in_executor(
+                    None, self.ds.database_info, name
+                )
+            else:
+                info = self.database_info(name)
         except KeyError:
             raise NotFound('Database not found: {}'.format(name))
+        self.database_infos[name] = info
         expected = info['hash'][:HASH_LENGTH]
         if expected != hash:
             should_redirect = '/{}-{}'.format(
@@ -128,6 +222,8 @@ class BaseView(RenderMixin):
                 should_redirect += '/' + kwargs['table']
             if 'pk_path' in kwargs:
                 should_redirect += '/' + kwargs['pk_path']
+            if 'column' in kwargs:
+                should_redirect += '/' + kwargs['column']
             if 'as_json' in kwargs:
                 should_redirect += kwargs['as_json']
             if 'as_db' in kwargs:
@@ -135,23 +231,22 @@ class BaseView(RenderMixin):
             return name, expected, should_redirect
         return name, expected, None
 
-    async def execute(self, db_name, sql, params=None, truncate=False, custom_time_limit=None):
-        """Executes sql against db_name in a thread"""
+    async def execute(self, db_name, sql, params=None, truncate=False, custom_time_limit=None, deadline=None):
+        """
+        Executes sql against db_name in a thread. If a deadline is given the
+        query only gets the time left before it once it starts running, and
+        is interrupted without running if that time has already run out.
+        """
         def sql_operation_in_thread():
-            conn = getattr(connections, db_name, None)
-            if not conn:
-                info = self.ds.inspect()[db_name]
-                conn = sqlite3.connect(
-                    'file:{}?immutable=1'.format(info['file']),
-                    uri=True,
-                    check_same_thread=False,
-                )
-                self.ds.prepare_connection(conn)
-                setattr(connections, db_name, conn)
-
+            conn = self.ds.connection(db_name)
             time_limit_ms = self.ds.sql_time_limit_ms
             if custom_time_limit and custom_time_limit < self.ds.sql_time_limit_ms:
                 time_limit_ms = custom_time_limit
+            if deadline is not None:
+                remaining_ms = (deadline - time.time()) * 1000
+                if remaining_ms <= 0:
+                    raise sqlite3.OperationalError('interrupted')
+                time_limit_ms = min(time_limit_ms, remaining_ms)
 
             with sqlite_timelimit(conn, time_limit_ms):
                 try:
@@ -164,6 +259,15 @@ class BaseView(RenderMixin):
                     else:
                         rows = cursor.fetchall()
                         truncated = False
+                    if self.explain is not None:
+                        self.explain.append({
+                            'sql': sql,
+                            'params': params,
+                            'plan': [
+                                {'id': row[0], 'parent': row[1], 'detail': row[3]}
+                                for row in conn.execute('explain query plan ' + sql, params or {})
+                            ],
+                        })
                 except Exception:
                     print('ERROR: conn={}, sql = {}, params = {}'.format(
                         conn, repr(sql), params
@@ -182,7 +286,7 @@ class BaseView(RenderMixin):
         assert NotImplemented
 
     async def get(self, request, db_name, **kwargs):
-        name, hash, should_redirect = self.resolve_db_name(db_name, **kwargs)
+        name, hash, should_redirect = await self.resolve_db_name(db_name, **kwargs)
         if should_redirect:
             return self.redirect(request, should_redirect)
         return await self.view_get(request, name, hash, **kwargs)
@@ -196,6 +300,8 @@ class BaseView(RenderMixin):
         start = time.time()
         status_code = 200
         templates = []
+        if request.raw_args.get('_explain'):
+            self.explain = []
         try:
             response_or_template_contexts = await self.data(
                 request, name, hash, **kwargs
@@ -204,7 +310,7 @@ class BaseView(RenderMixin):
                 return response_or_template_contexts
             else:
                 data, extra_template_data, templates = response_or_template_contexts
-        except (sqlite3.OperationalError, InvalidSql) as e:
+        except (sqlite3.OperationalError, InvalidSql, DatasetteError) as e:
             data = {
                 'ok': False,
                 'error': str(e),
@@ -215,6 +321,9 @@ class BaseView(RenderMixin):
             templates = ['error.html']
         end = time.time()
         data['query_ms'] = (end - start) * 1000
+        if self.explain is not None:
+            # Label lookups for the HTML page are added as they run
+            data['explain'] = self.explain
         for key in ('source', 'source_url', 'license', 'license_url'):
             value = self.ds.metadata.get(key)
             if value:
@@ -229,17 +338,7 @@ class BaseView(RenderMixin):
                         dict(zip(columns, row))
                         for row in rows
                     ]
-            headers = {}
-            if self.ds.cors:
-                headers['Access-Control-Allow-Origin'] = '*'
-            r = response.HTTPResponse(
-                json.dumps(
-                    data, cls=CustomJSONEncoder
-                ),
-                status=status_code,
-                content_type='application/json',
-                headers=headers,
-            )
+            r = self.json_response(data, status_code)
         else:
             extras = {}
             if callable(extra_template_data):
@@ -273,6 +372,146 @@ class BaseView(RenderMixin):
             )
         return r
 
+    def json_response(self, data, status_code=200):
+        headers = {}
+        if self.ds.cors:
+            headers['Access-Control-Allow-Origin'] = '*'
+        return response.HTTPResponse(
+            json.dumps(
+                data, cls=CustomJSONEncoder
+            ),
+            status=status_code,
+            content_type='application/json',
+            headers=headers,
+        )
+
+    def label_foreign_keys(self, database, table, columns):
+        """
+        Returns the outgoing foreign keys of a table from any of the columns
+        to tables with a label column
+        """
+        tables = self.database_info(database)['tables']
+        return [
+            fk for fk in (tables.get(table) or {}).get(
+                'foreign_keys', {}
+            ).get('outgoing', [])
+            # We only link cells to other tables with label columns defined
+            if tables.get(fk['other_table'], {}).get('label_column')
+            and fk['column'] in columns
+        ]
+
+    def query_foreign_keys(self, database, columns):
+        """
+        Custom SQL results don't say which table a column came from, so this
+        matches each column to the foreign keys declared on columns of the
+        same name. Returns column => foreign key for the columns that match
+        exactly one table with a label column, and column => list of tables
+        for the ambiguous ones.
+        """
+        tables = self.database_info(database)['tables']
+        matches = {}
+        for table_info in tables.values():
+            for fk in table_info['foreign_keys']['outgoing']:
+                if fk['column'] in columns and tables.get(
+                    fk['other_table'], {}
+                ).get('label_column'):
+                    matches.setdefault(fk['column'], {})[
+                        (fk['other_table'], fk['other_column'])
+                    ] = fk
+        return {
+            column: (
+                list(fks.values())[0] if len(fks) == 1
+                else sorted('{}.{}'.format(*target) for target in fks)
+            )
+            for column, fks in matches.items()
+        }
+
+    async def foreign_key_labels(self, database, foreign_keys, columns, rows):
+        """
+        Returns (column, id) => (other table, label) for the values of the
+        foreign key columns in the rows. Labels come from the label cache
+        where possible, and the rest are looked up LABEL_LOOKUP_CHUNK_SIZE
+        ids at a time and added to it.
+        """
+        info = self.database_info(database)
+        tables = info['tables']
+
+        async def expand_foreign_key(fk):
+            label_column = tables[fk['other_table']]['label_column']
+            index = columns.index(fk['column'])
+            ids = {row[index] for row in rows} - {None}
+            key = (info['hash'], fk['other_table'], fk['other_column'], label_column)
+            labels, ids_to_lookup = self.ds.label_cache.get_many(key, ids)
+            for i in range(0, len(ids_to_lookup), LABEL_LOOKUP_CHUNK_SIZE):
+                chunk = ids_to_lookup[i:i + LABEL_LOOKUP_CHUNK_SIZE]
+                sql = 'select "{other_column}", "{label_column}" from {other_table} where "{other_column}" in ({placeholders})'.format(
+                    other_column=fk['other_column'],
+                    label_column=label_column,
+                    other_table=escape_sqlite_table_name(fk['other_table']),
+                    placeholders=', '.join(['?'] * len(chunk)),
+                )
+                try:
+                    results = dict(await self.execute(database, sql, chunk))
+                except sqlite3.OperationalError:
+                    # Probably hit the timelimit
+                    break
+                self.ds.label_cache.set_many(key, chunk, results)
+                labels.update(results)
+            return labels
+
+        # The lookups are independent, so run them all at once
+        all_labels = await asyncio.gather(*[
+            expand_foreign_key(fk) for fk in foreign_keys
+        ])
+        expanded = {}
+        for fk, labels in zip(foreign_keys, all_labels):
+            for id, label in labels.items():
+                expanded[(fk['column'], id)] = (fk['other_table'], label)
+        return expanded
+
+    async def expand_rows(self, database, table, columns, rows, expand):
+        """
+        Returns the rows as lists, with the values of the expand columns
+        replaced by {'value': id, 'label': label}. The foreign keys come from
+        the table, or from query_foreign_keys() for custom SQL.
+        """
+        for column in expand:
+            if column not in columns:
+                raise DatasetteError('Cannot expand {}: no such column'.format(column))
+        if table:
+            foreign_keys = self.label_foreign_keys(database, table, expand)
+        else:
+            matches = self.query_foreign_keys(database, expand)
+            for column, match in matches.items():
+                if isinstance(match, list):
+                    raise DatasetteError(
+                        'Cannot expand {}: it could be a foreign key to {}'.format(
+                            column, ', '.join(match)
+                        )
+                    )
+            foreign_keys = list(matches.values())
+        not_foreign_keys = set(expand) - {fk['column'] for fk in foreign_keys}
+        if not_foreign_keys:
+            raise DatasetteError(
+                'Cannot expand {}: not a foreign key to a table with a label column'.format(
+                    ', '.join(sorted(not_foreign_keys))
+                )
+            )
+        expanded = await self.foreign_key_labels(database, foreign_keys, columns, rows)
+        expand_indexes = [columns.index(fk['column']) for fk in foreign_keys]
+        expanded_rows = []
+        for row in rows:
+            row = list(row)
+            for index in expand_indexes:
+                value = row[index]
+                if value is not None:
+                    row[index] = {
+                        'value': value,
+                        'label': expanded.get((columns[index], value), (None, None))[1],
+                    }
+            expanded_rows.append(row)
+        return expanded_rows
+
     async def custom_sql(self, request, name, hash, sql, editable=True, canned_query=None):
         params = request.raw_args
         if 'sql' in params:
@@ -296,6 +535,9 @@ class BaseView(RenderMixin):
             name, sql, params, truncate=True, **extra_args
         )
         columns = [r[0] for r in description]
+        expand = request.args.getlist('_expand')
+        if expand:
+            rows = await self.expand_rows(name, None, columns, rows, expand)
 
         templates = ['query-{}.html'.format(to_css_class(name)), 'query.html']
         if canned_query:
@@ -329,42 +571,31 @@ class IndexView(RenderMixin):
         self.executor = datasette.executor
 
     async def get(self, request, as_json):
-        databases = []
-        for key, info in sorted(self.ds.inspect().items()):
-            tables = [t for t in info['tables'].values() if not t['hidden']]
-            hidden_tables = [t for t in info['tables'].values() if t['hidden']]
-            database = {
-                'name': key,
-                'hash': info['hash'],
-                'path': '{}-{}'.format(key, info['hash'][:HASH_LENGTH]),
-                'tables_truncated': sorted(
-                    tables,
-                    key=lambda t: t['count'],
-                    reverse=True
-                )[:5],
-                'tables_count': len(tables),
-                'tables_more': len(tables) > 5,
-                'table_rows': sum(t['count'] for t in tables),
-                'hidden_table_rows': sum(t['count'] for t in hidden_tables),
-                'hidden_tables_count': len(hidden_tables),
-                'views_count': len(info['views']),
-            }
-            databases.append(database)
+        databases, next_name = self.ds.database_summaries(
+            request.raw_args.get('_next'), self.ds.page_size
+        )
+        next_url = None
+        if next_name:
+            next_url = path_with_added_args(request, {'_next': next_name})
         if as_json:
+            headers = {
+                'Access-Control-Allow-Origin': '*'
+            }
+            if next_url:
+                headers['Link'] = '<{}>; rel="next"'.format(next_url)
             return response.HTTPResponse(
                 json.dumps(
                     {db['name']: db for db in databases},
                     cls=CustomJSONEncoder
                 ),
                 content_type='application/json',
-                headers={
-                    'Access-Control-Allow-Origin': '*'
-                }
+                headers=headers,
             )
         else:
             return self.render(
                 ['index.html'],
                 databases=databases,
+                next_url=next_url,
                 metadata=self.ds.metadata,
                 datasette_version=__version__,
                 extra_css_urls=self.ds.extra_css_urls(),
@@ -372,6 +603,29 @@ class IndexView(RenderMixin):
             )
 
 
+def database_summary(name, info):
+    "Summary of a database for the index page"
+    tables = [t for t in info['tables'].values() if not t['hidden']]
+    hidden_tables = [t for t in info['tables'].values() if t['hidden']]
+    return {
+        'name': name,
+        'hash': info['hash'],
+        'path': '{}-{}'.format(name, info['hash'][:HASH_LENGTH]),
+        # Only what the index page shows, as summaries outlive the inspect
+        # data of lazily opened databases
+        'tables_truncated': [
+            {'name': t['name'], 'count': t['count']}
+            for t in sorted(tables, key=lambda t: t['count'], reverse=True)[:5]
+        ],
+        'tables_count': len(tables),
+        'tables_more': len(tables) > 5,
+        'table_rows': sum(t['count'] for t in tables),
+        'hidden_table_rows': sum(t['count'] for t in hidden_tables),
+        'hidden_tables_count': len(hidden_tables),
+        'views_count': len(info['views']),
+    }
+
+
 async def favicon(request):
     return response.text('')
 
@@ -382,7 +636,7 @@ class DatabaseView(BaseView):
             sql = request.raw_args.pop('sql')
             validate_sql_select(sql)
             return await self.custom_sql(request, name, hash, sql)
-        info = self.ds.inspect()[name]
+        info = self.database_info(name)
         metadata = self.ds.metadata.get('databases', {}).get(name, {})
         tables = list(info['tables'].values())
         tables.sort(key=lambda t: (t['hidden'], t['name']))
@@ -407,7 +661,7 @@ class DatabaseView(BaseView):
 
 class DatabaseDownload(BaseView):
     async def view_get(self, request, name, hash, **kwargs):
-        filepath = self.ds.inspect()[name]['file']
+        filepath = self.database_info(name)['file']
         return await response.file_stream(
             filepath, headers={
                 'Content-Disposition': 'attachment; filename="{}"'.format(filepath)
@@ -416,38 +670,143 @@ class DatabaseDownload(BaseView):
 
 
 class RowTableShared(BaseView):
+    async def table_columns(self, name, table):
+        "Returns the column names of a table or view"
+        table_info = self.database_info(name)['tables'].get(table) or {}
+        if 'columns' in table_info:
+            return table_info['columns']
+        return [
+            r[1] for r in await self.execute(
+                name, 'PRAGMA table_info("{}")'.format(table)
+            )
+        ]
+
+    async def select_columns(self, name, table, args, keep, use_rowid, truncate=False, table_alias=None):
+        """
+        Returns the select clause for the columns chosen with ?_col= and
+        ?_nocol=, always including the columns in keep - the primary keys and
+        anything else needed to paginate. With truncate, long values in the
+        other columns are cut short in SQL - see truncated_rows(). rowid and *
+        are qualified with table_alias, for queries that join other tables.
+        """
+        col_args = args.get('_col') or []
+        nocol_args = args.get('_nocol') or []
+        rowid = 'rowid'
+        all_columns = '*'
+        if table_alias:
+            rowid = '{}.rowid as rowid'.format(table_alias)
+            all_columns = '{}.*'.format(table_alias)
+        limits = {}
+        if truncate:
+            limits = self.truncate_cells_limits(name, table)
+        if not col_args and not nocol_args and not limits:
+            if use_rowid:
+                return '{}, {}'.format(rowid, all_columns)
+            return all_columns
+        columns = await self.table_columns(name, table)
+        for column in col_args + nocol_args:
+            if column not in columns:
+                raise DatasetteError('Invalid column: {}'.format(column))
+        selected = []
+        for column in columns:
+            if column not in keep and not (
+                (not col_args or column in col_args) and column not in nocol_args
+            ):
+                continue
+            limit = limits.get(column, limits.get(None))
+            if limit and column not in keep:
+                # length() works on numbers too, but only text and blobs
+                # are truncated
+                is_long = 'typeof("{column}") in (\'text\', \'blob\') and length("{column}") > {limit}'.format(
+                    column=column, limit=limit
+                )
+                selected.append(
+                    'case when {is_long} then substr("{column}", 1, {limit}) '
+                    'else "{column}" end as "{column}"'.format(
+                        is_long=is_long, column=column, limit=limit
+                    )
+                )
+                selected.append(
+                    'case when {is_long} then length("{column}") end '
+                    'as "{prefix}{column}"'.format(
+                        is_long=is_long, column=column, prefix=TRUNCATED_LENGTH_PREFIX
+                    )
+                )
+            else:
+                selected.append('"{}"'.format(column))
+        if use_rowid:
+            selected.insert(0, rowid)
+        if not selected:
+            raise DatasetteError('No columns selected')
+        return ', '.join(selected)
+
+    def truncate_cells_limits(self, name, table):
+        """
+        Returns column => maximum length for the cells of a table listing, with
+        the limit for every other column under None. Tables can set their own
+        limit or per-column limits using truncate_cells in the metadata.
+        """
+        limits = {None: self.ds.truncate_cells}
+        table_metadata = self.ds.metadata.get(
+            'databases', {}
+        ).get(name, {}).get('tables', {}).get(table, {})
+        truncate_cells = table_metadata.get('truncate_cells')
+        if isinstance(truncate_cells, dict):
+            limits.update(truncate_cells)
+        elif truncate_cells is not None:
+            limits[None] = truncate_cells
+        if not any(limits.values()):
+            return {}
+        return limits
+
+    def truncated_rows(self, name, table, description, rows, pks, use_rowid):
+        """
+        Replaces the values that were cut short by select_columns() with
+        TruncatedCell objects linking to the full value, returning
+        (description, rows) without the extra length columns.
+        """
+        columns = [d[0] for d in description]
+        length_columns = {
+            i: columns.index(column[len(TRUNCATED_LENGTH_PREFIX):])
+            for i, column in enumerate(columns)
+            if column.startswith(TRUNCATED_LENGTH_PREFIX)
+        }
+        if not length_columns:
+            return description, rows
+        keep = [i for i in range(len(columns)) if i not in length_columns]
+        description = [description[i] for i in keep]
+        kept_columns = [columns[i] for i in keep]
+        truncated_rows = []
+        for row in rows:
+            values = list(row)
+            for length_index, value_index in length_columns.items():
+                length = values[length_index]
+                if length is None:
+                    continue
+                url = None
+                if pks or use_rowid:
+                    url = '/{database}/{table}/{pk_path}/{column}'.format(
+                        database=name,
+                        table=urllib.parse.quote_plus(table),
+                        pk_path=path_from_row_pks(row, pks, use_rowid),
+                        column=urllib.parse.quote_plus(columns[value_index]),
+                    )
+                values[value_index] = TruncatedCell(values[value_index], length, url)
+            truncated_rows.append(CellRow(kept_columns, [values[i] for i in keep]))
+        return description, truncated_rows
+
     async def display_columns_and_rows(self, database, table, description, rows, link_column=False, expand_foreign_keys=True):
         "Returns columns, rows for specified table - including fancy foreign key treatment"
-        info = self.ds.inspect()[database]
         columns = [r[0] for r in description]
-        tables = info['tables']
-        table_info = tables.get(table) or {}
         pks = await self.pks_for_table(database, table)
 
         # Prefetch foreign key resolutions for later expansion:
         expanded = {}
-        if table_info and expand_foreign_keys:
-            foreign_keys = table_info['foreign_keys']['outgoing']
-            for fk in foreign_keys:
-                label_column = tables.get(fk['other_table'], {}).get('label_column')
-                if not label_column:
-                    # We only link cells to other tables with label columns defined
-                    continue
-                ids_to_lookup = set([row[fk['column']] for row in rows])
-                sql = 'select "{other_column}", "{label_column}" from {other_table} where "{other_column}" in ({placeholders})'.format(
-                    other_column=fk['other_column'],
-                    label_column=label_column,
-                    other_table=escape_sqlite_table_name(fk['other_table']),
-                    placeholders=', '.join(['?'] * len(ids_to_lookup)),
-                )
-                try:
-                    results = await self.execute(database, sql, list(set(ids_to_lookup)))
-                except sqlite3.OperationalError:
-                    # Probably hit the timelimit
-                    pass
-                else:
-                    for id, value in results:
-                        expanded[(fk['column'], id)] = (fk['other_table'], value)
+        if expand_foreign_keys:
+            expanded = await self.foreign_key_labels(
+                database, self.label_foreign_keys(database, table, columns),
+                columns, rows
+            )
 
         cell_rows = []
         for row in rows:
@@ -466,7 +825,22 @@ class RowTableShared(BaseView):
                     ),
                 })
             for value, column in zip(row, columns):
-                if (column, value) in expanded:
+                if isinstance(value, TruncatedCell):
+                    display_value = jinja2.Markup(
+                        '{value}&hellip; {length}'.format(
+                            value=jinja2.escape(str(value.value)),
+                            length=jinja2.Markup(
+                                '<a href="{url}">{label}</a>' if value.url else '{label}'
+                            ).format(
+                                url=value.url,
+                                label='({:,} {})'.format(
+                                    value.length,
+                                    'bytes' if isinstance(value.value, bytes) else 'characters',
+                                ),
+                            ),
+                        )
+                    )
+                elif (column, value) in expanded:
                     other_table, label = expanded[(column, value)]
                     display_value = jinja2.Markup(
                         '<a href="/{database}/{table}/{id}">{label}</a>&nbsp;<em>{id}</em>'.format(
@@ -496,6 +870,44 @@ class RowTableShared(BaseView):
             columns = ['Link'] + columns
         return columns, cell_rows
 
+    def rank_search_expressions(self, name, fts_table):
+        """
+        Returns the SQL for the rank (lower is more relevant) and the
+        highlighted snippet of each match in an FTS4 or FTS5 table
+        """
+        fts_sql = (
+            self.database_info(name)['tables'].get(fts_table) or {}
+        ).get('sql') or ''
+        if re.search(r'using\s+fts5', fts_sql, re.I):
+            return {
+                'rank': 'rank',
+                'snippet': "snippet([{}], -1, char({}), char({}), '...', 10)".format(
+                    fts_table, ord(SNIPPET_START), ord(SNIPPET_END)
+                ),
+            }
+        if re.search(r'using\s+fts4', fts_sql, re.I):
+            return {
+                'rank': "rank_bm25(matchinfo([{}], 'pcnalx'))".format(fts_table),
+                'snippet': "snippet([{}], char({}), char({}), '...', -1, 10)".format(
+                    fts_table, ord(SNIPPET_START), ord(SNIPPET_END)
+                ),
+            }
+        raise DatasetteError('_rank needs an FTS4 or FTS5 table')
+
+    async def id_and_label_columns(self, name, table, fts_table):
+        """
+        Returns the columns that identify and label the rows of a table in
+        search results: the primary key (or rowid), and the label column or
+        else the first column of the FTS index.
+        """
+        tables = self.database_info(name)['tables']
+        pks = await self.pks_for_table(name, table)
+        id_column = pks[0] if len(pks) == 1 else 'rowid'
+        label_column = (tables.get(table) or {}).get('label_column')
+        if not label_column:
+            label_column = (tables.get(fts_table) or {}).get('columns', [id_column])[0]
+        return id_column, label_column
+
 
 class TableView(RowTableShared):
     async def data(self, request, name, hash, table):
@@ -503,30 +915,36 @@ class TableView(RowTableShared):
         canned_query = self.ds.get_canned_query(name, table)
         if canned_query is not None:
             return await self.custom_sql(request, name, hash, canned_query['sql'], editable=False, canned_query=table)
-        pks = await self.pks_for_table(name, table)
-        is_view = bool(list(await self.execute(name, "SELECT count(*) from sqlite_master WHERE type = 'view' and name=:n", {
-            'n': table,
-        }))[0][0])
+        schema = await self.table_schema(name, table)
+        pks = schema['primary_keys']
+        is_view = schema['is_view']
         view_definition = None
         table_definition = None
         if is_view:
-            view_definition = list(await self.execute(name, 'select sql from sqlite_master where name = :n and type="view"', {
-                'n': table,
-            }))[0][0]
+            view_definition = schema['definition']
         else:
-            table_definition = list(await self.execute(name, 'select sql from sqlite_master where name = :n and type="table"', {
-                'n': table,
-            }))[0][0]
+            table_definition = schema['definition']
         use_rowid = not pks and not is_view
         if use_rowid:
-            select = 'rowid, *'
             order_by = 'rowid'
         else:
-            select = '*'
             order_by = ', '.join(pks)
 
+        # Views can declare columns that uniquely order their rows, to be
+        # paginated by keyset instead of by offset
+        table_metadata = self.ds.metadata.get(
+            'databases', {}
+        ).get(name, {}).get('tables', {}).get(table, {})
+        pagination_key = None
+        if is_view and not request.raw_args.get('_group_count'):
+            pagination_key = table_metadata.get('pagination_key')
+            if isinstance(pagination_key, str):
+                pagination_key = [pagination_key]
+
         if is_view:
             order_by = ''
+            if pagination_key:
+                order_by = ', '.join('"{}"'.format(column) for column in pagination_key)
 
         # We roll our own query_string decoder because by default Sanic
         # drops anything with an empty value e.g. ?name__exact=
@@ -556,31 +974,141 @@ class TableView(RowTableShared):
                 forward_querystring=False
             )
 
-        filters = Filters(sorted(other_args.items()))
-        where_clauses, params = filters.build_where_clauses()
-
         # _search support:
-        fts_table = None
-        fts_sql = detect_fts_sql(table)
-        fts_rows = list(await self.execute(name, fts_sql))
-        if fts_rows:
-            fts_table = fts_rows[0][0]
-
+        fts_table = schema['fts_table']
         search = special_args.get('_search')
         search_description = None
+
+        # _rank=1 orders _search results by relevance, by joining the table
+        # to its matches in the FTS table instead of filtering on them
+        rank_search = None
+        if search and fts_table and special_args.get('_rank'):
+            rank_search = self.rank_search_expressions(name, fts_table)
+            if special_args.get('_sort') or special_args.get('_sort_desc'):
+                raise DatasetteError('Cannot use _sort or _sort_desc with _rank')
+            if is_view:
+                raise DatasetteError('Cannot use _rank with a view')
+        table_name = escape_sqlite_table_name(table)
+
+        filters = Filters(sorted(other_args.items()))
+        table_info = self.database_info(name)['tables'].get(table) or {}
+        where_clauses, params = filters.build_where_clauses(
+            table_info.get('column_types'),
+            table_info.get('trigram_columns'),
+            # rowid needs qualifying once the FTS table is joined
+            rowid='{}.rowid'.format(table_name) if rank_search else 'rowid',
+        )
+        unindexed_filters = None
+        if 'indexed_columns' in table_info:
+            indexed_columns = list(table_info['indexed_columns'])
+            if has_rowid(table_info.get('sql')):
+                # Looking up a rowid is a seek in the table's own b-tree
+                indexed_columns.append('rowid')
+            unindexed_filters = filters.unindexed_selections(
+                indexed_columns,
+                table_info.get('column_types'),
+                table_info.get('trigram_columns'),
+            )
+
+        count_where_clauses = list(where_clauses)
         if search and fts_table:
-            where_clauses.append(
-                'rowid in (select rowid from [{fts_table}] where [{fts_table}] match :search)'.format(
-                    fts_table=fts_table
-                )
+            search_clause = 'rowid in (select rowid from [{fts_table}] where [{fts_table}] match :search)'.format(
+                fts_table=fts_table
             )
+            count_where_clauses.append(search_clause)
+            if not rank_search:
+                where_clauses.append(search_clause)
             search_description = 'search matches "{}"'.format(search)
             params['search'] = search
 
+        # The count covers every page, so it leaves out the _next clauses
+        count_where_clause = ''
+        if count_where_clauses:
+            count_where_clause = 'where {} '.format(' and '.join(count_where_clauses))
+        count_params = dict(params)
+
+        # _sort=column and _sort_desc=column - rows with the same value are
+        # ordered by primary key, so that _next can seek to the next page
+        sort = special_args.get('_sort')
+        sort_desc = special_args.get('_sort_desc')
+        if sort and sort_desc:
+            raise DatasetteError('Cannot use _sort and _sort_desc at the same time')
+        sort_column = sort or sort_desc
+        sort_keys = []
+        sort_uses_index = None
+        if sort_column:
+            sortable_columns = table_metadata.get('sortable_columns')
+            if sortable_columns is None:
+                sortable_columns = await self.table_columns(name, table)
+            if sort_column not in sortable_columns:
+                raise DatasetteError('Cannot sort table by {}'.format(sort_column))
+            if 'indexed_columns' in table_info:
+                sort_uses_index = sort_column in table_info['indexed_columns']
+            sort_keys = [sort_column]
+            if not is_view:
+                sort_keys += pks or ['rowid']
+            order_by = ', '.join(
+                '"{}"{}'.format(key, ' desc' if sort_desc else '')
+                for key in sort_keys
+            )
+            # Sorted views are paginated by offset
+            pagination_key = None
+
+        # _col=column and _nocol=column choose the columns to return
+        select = await self.select_columns(
+            name, table, special_args_lists,
+            keep=set(pks) | set(sort_keys) | set(pagination_key or []),
+            use_rowid=use_rowid,
+            truncate=True,
+            table_alias=table_name if rank_search else None,
+        )
+        from_clause = table_name
+        if rank_search:
+            select += ', search.search_rowid, search.search_rank, search.search_snippet'
+            from_clause = (
+                '{table_name} join (select rowid as search_rowid, {rank} as search_rank, '
+                '{snippet} as search_snippet from [{fts_table}] where [{fts_table}] match :search) search '
+                'on {table_name}.rowid = search.search_rowid'
+            ).format(
+                table_name=table_name,
+                fts_table=fts_table,
+                rank=rank_search['rank'],
+                snippet=rank_search['snippet'],
+            )
+            order_by = 'search.search_rank, search.search_rowid'
+
         next = special_args.get('_next')
         offset = ''
         if next:
-            if is_view:
+            if rank_search:
+                key_values = key_values_from_path(next, ['REAL', 'INTEGER'])
+                if key_values and key_values[0] is not None:
+                    param_names = ['p{}'.format(len(params) + i) for i in range(2)]
+                    where_clauses.append(keyset_where_clause(
+                        ['search_rank', 'search_rowid'], param_names
+                    ))
+                    params.update(zip(param_names, key_values))
+            elif sort_column and not is_view:
+                key_values = key_values_from_path(
+                    next, self.key_affinities(table_info, sort_keys)
+                )
+                if key_values is not None:
+                    where_clauses.append(self.sorted_keyset_where_clause(
+                        sort_keys, key_values[0], key_values[1:], bool(sort_desc), params
+                    ))
+            elif pagination_key:
+                key_values = key_values_from_path(
+                    next, self.key_affinities(table_info, pagination_key)
+                )
+                if key_values is not None:
+                    param_names = [
+                        'p{}'.format(len(params) + i) for i in range(len(pagination_key))
+                    ]
+                    where_clauses.append(keyset_where_clause(
+                        pagination_key, param_names, values=key_values
+                    ))
+                    params.update(zip(param_names, key_values))
+            elif is_view:
                 # _next is an offset
                 offset = ' offset {}'.format(int(next))
             elif use_rowid:
@@ -591,17 +1119,15 @@ class TableView(RowTableShared):
                 )
                 params['p{}'.format(len(params))] = next
             else:
-                pk_values = compound_pks_from_path(next)
-                if len(pk_values) == len(pks):
-                    param_counter = len(params)
-                    for pk, value in zip(pks, pk_values):
-                        where_clauses.append(
-                            '"{}" > :p{}'.format(
-                                pk, param_counter,
-                            )
-                        )
-                        params['p{}'.format(param_counter)] = value
-                        param_counter += 1
+                pk_values = key_values_from_path(
+                    next, self.key_affinities(table_info, pks)
+                )
+                if pk_values is not None:
+                    param_names = [
+                        'p{}'.format(len(params) + i) for i in range(len(pks))
+                    ]
+                    where_clauses.append(keyset_where_clause(pks, param_names))
+                    params.update(zip(param_names, pk_values))
 
         where_clause = ''
         if where_clauses:
@@ -616,18 +1142,18 @@ class TableView(RowTableShared):
             count_sql = None
             sql = 'select {group_cols}, count(*) as "count" from {table_name} {where} group by {group_cols} order by "count" desc limit 100'.format(
                 group_cols=', '.join('"{}"'.format(group_count_col) for group_count_col in group_count),
-                table_name=escape_sqlite_table_name(table),
+                table_name=table_name,
                 where=where_clause,
             )
             is_view = True
         else:
             count_sql = 'select count(*) from {table_name} {where}'.format(
-                table_name=escape_sqlite_table_name(table),
-                where=where_clause,
+                table_name=table_name,
+                where=count_where_clause,
             )
-            sql = 'select {select} from {table_name} {where}{order_by}limit {limit}{offset}'.format(
+            sql = 'select {select} from {from_clause} {where}{order_by}limit {limit}{offset}'.format(
                 select=select,
-                table_name=escape_sqlite_table_name(table),
+                from_clause=from_clause,
                 where=where_clause,
                 order_by=order_by,
                 limit=self.page_size + 1,
@@ -638,30 +1164,118 @@ class TableView(RowTableShared):
         if request.raw_args.get('_sql_time_limit_ms'):
             extra_args['custom_time_limit'] = int(request.raw_args['_sql_time_limit_ms'])
 
-        rows, truncated, description = await self.execute(
-            name, sql, params, truncate=True, **extra_args
-        )
+        if special_args.get('_count_only'):
+            filtered_table_rows = None
+            if count_sql:
+                filtered_table_rows = await self.filtered_count(
+                    name, count_sql, count_params, **extra_args
+                )
+            return self.json_response({
+                'database': name,
+                'table': table,
+                'filtered_table_rows': filtered_table_rows,
+                'query': {
+                    'sql': count_sql,
+                    'params': count_params,
+                },
+            })
+
+        # A filtered table or a view will usually need a full count as
+        # well, so start it alongside the page query instead of after it -
+        # unless it has been counted before, or counts are deferred
+        count_needed = bool(count_sql and (count_where_clause or is_view))
+        cached_count = None
+        if count_needed:
+            cached_count = self.ds.cached_count(
+                self.database_info(name)['hash'], count_sql, count_params
+            )
+        count_future = None
+        if count_needed and cached_count is None and not self.ds.defer_counts:
+            count_future = asyncio.ensure_future(
+                self.filtered_count(name, count_sql, count_params)
+            )
+
+        # _facet=column - each facet is counted by its own query, running
+        # alongside the page under a short time limit
+        facets = []
+        if not group_count:
+            facets = special_args_lists.get('_facet') or table_metadata.get('facets') or []
+        if facets:
+            table_columns = await self.table_columns(name, table)
+            for facet in facets:
+                if facet not in table_columns:
+                    raise DatasetteError('Cannot facet {} by {}'.format(
+                        'view' if is_view else 'table', facet
+                    ))
+        facet_futures = [
+            asyncio.ensure_future(self.facet(
+                request, name, table, facet, count_where_clause, count_params, other_args
+            ))
+            for facet in facets
+        ]
 
+        try:
+            rows, truncated, description = await self.execute(
+                name, sql, params, truncate=True, **extra_args
+            )
+        except Exception:
+            for future in facet_futures:
+                future.cancel()
+            raise
+
+        search_rowids = ranks = snippets = None
+        if rank_search:
+            description = description[:-3]
+            columns = [r[0] for r in description]
+            search_rowids = [row[-3] for row in rows]
+            ranks = [row[-2] for row in rows]
+            snippets = [row[-1] for row in rows]
+            rows = [CellRow(columns, row[:-3]) for row in rows]
+        description, rows = self.truncated_rows(
+            name, table, description, rows, pks, use_rowid
+        )
         columns = [r[0] for r in description]
         rows = list(rows)
 
+        facet_results = OrderedDict(
+            (result['name'], result)
+            for result in await asyncio.gather(*facet_futures)
+        )
+
         filter_columns = columns[:]
         if use_rowid and filter_columns[0] == 'rowid':
             filter_columns = filter_columns[1:]
 
-        info = self.ds.inspect()
+        info = self.database_info(name)
         table_rows = None
         if not is_view:
-            table_rows = info[name]['tables'][table]['count']
+            table_rows = info['tables'][table]['count']
 
         # Pagination next link
         next_value = None
         next_url = None
         if len(rows) > self.page_size:
-            if is_view:
+            if rank_search:
+                next_value = path_from_key_values(
+                    [ranks[-2], search_rowids[-2]], ['REAL', 'INTEGER']
+                )
+            elif sort_column and not is_view:
+                next_value = path_from_key_values(
+                    [rows[-2][key] for key in sort_keys],
+                    self.key_affinities(table_info, sort_keys),
+                )
+            elif pagination_key:
+                next_value = path_from_key_values(
+                    [rows[-2][key] for key in pagination_key],
+                    self.key_affinities(table_info, pagination_key),
+                )
+            elif is_view:
                 next_value = int(next or 0) + self.page_size
             else:
-                next_value = path_from_row_pks(rows[-2], pks, use_rowid)
+                next_value = path_from_key_values(
+                    [rows[-2][pk] for pk in pks or ['rowid']],
+                    self.key_affinities(table_info, pks or ['rowid']),
+                )
             next_url = urllib.parse.urljoin(request.url, path_with_added_args(request, {
                 '_next': next_value,
             }))
@@ -669,20 +1283,29 @@ class TableView(RowTableShared):
 
         # Number of filtered rows in whole set:
         filtered_table_rows = None
-        if not where_clauses and not is_view:
+        count_url = None
+        if not count_where_clause and not is_view:
             # Use the pre-calculated total
             filtered_table_rows = table_rows
-        elif not truncated and len(rows) < self.page_size:
+        elif not next and not truncated and len(rows) < self.page_size:
             filtered_table_rows = len(rows)
-        else:
-            # Attempt a full count, if we can do it in < X ms
-            if count_sql:
-                try:
-                    count_rows = list(await self.execute(name, count_sql, params))
-                    filtered_table_rows = count_rows[0][0]
-                except sqlite3.OperationalError:
-                    # Almost certainly hit the timeout
-                    pass
+        elif cached_count is not None:
+            filtered_table_rows = cached_count
+        elif count_future is not None:
+            # Attempted in parallel with the page, if we could do it in < X ms
+            filtered_table_rows = await count_future
+        elif count_needed:
+            # Deferred - the count can be fetched separately from this URL
+            count_url = '{}.json{}'.format(
+                re.sub(r'\.jsono?$', '', request.path),
+                path_with_added_args(request, {
+                    '_count_only': 1,
+                    '_next': None,
+                })[len(request.path):],
+            )
+        if count_future is not None and not count_future.done():
+            # The page told us everything we needed to know
+            count_future.cancel()
 
         # human_filter_description combines filters AND search, if provided
         human_description = filters.human_description(extra=search_description)
@@ -691,6 +1314,13 @@ class TableView(RowTableShared):
             display_columns, display_rows = await self.display_columns_and_rows(
                 name, table, description, rows, link_column=not is_view, expand_foreign_keys=True
             )
+            if snippets is not None:
+                display_columns.insert(1, 'Snippet')
+                for display_row, snippet in zip(display_rows, snippets):
+                    display_row.insert(1, {
+                        'column': 'Snippet',
+                        'value': highlighted_snippet(snippet),
+                    })
             return {
                 'database_hash': hash,
                 'human_filter_description': human_description,
@@ -711,7 +1341,7 @@ class TableView(RowTableShared):
                 ).get(name, {}).get('tables', {}).get(table, {}),
             }
 
-        return {
+        data = {
             'database': name,
             'table': table,
             'is_view': is_view,
@@ -721,6 +1351,12 @@ class TableView(RowTableShared):
             'truncated': truncated,
             'table_rows': table_rows,
             'filtered_table_rows': filtered_table_rows,
+            'count_url': count_url,
+            'sort': sort,
+            'sort_desc': sort_desc,
+            'sort_uses_index': sort_uses_index,
+            'unindexed_filters': unindexed_filters,
+            'facet_results': facet_results,
             'columns': columns,
             'primary_keys': pks,
             'query': {
@@ -729,21 +1365,150 @@ class TableView(RowTableShared):
             },
             'next': next_value and str(next_value) or None,
             'next_url': next_url,
-        }, extra_template, (
+        }
+        if rank_search:
+            data['ranks'] = ranks[:self.page_size]
+            data['snippets'] = [tagged_snippet(snippet) for snippet in snippets[:self.page_size]]
+        if special_args.get('_labels'):
+            # column => [id, label] pairs, in the order the ids first appear
+            labels = {}
+            expanded = await self.foreign_key_labels(
+                name, self.label_foreign_keys(name, table, columns),
+                columns, rows[:self.page_size]
+            )
+            for row in rows[:self.page_size]:
+                for column, value in zip(columns, row):
+                    if (column, value) in expanded:
+                        labels.setdefault(column, []).append(
+                            [value, expanded.pop((column, value))[1]]
+                        )
+            data['labels'] = labels
+        if special_args_lists.get('_expand'):
+            data['rows'] = await self.expand_rows(
+                name, table, columns, data['rows'], special_args_lists['_expand']
+            )
+
+        return data, extra_template, (
             'table-{}-{}.html'.format(to_css_class(name), to_css_class(table)),
             'table.html'
         )
 
 
+    def key_affinities(self, table_info, columns):
+        """
+        Returns the affinity of each of the columns a page is ordered by, for
+        encoding their values in _next tokens
+        """
+        column_types = table_info.get('column_types') or {}
+        return [
+            'INTEGER' if column == 'rowid' and column not in column_types
+            else column_affinity(column_types.get(column))
+            for column in columns
+        ]
+
+    def sorted_keyset_where_clause(self, sort_keys, sort_value, pk_values, descending, params):
+        """
+        Returns a where clause for the rows after (sort_value, pk_values) when
+        ordered by sort_keys, adding its parameters to params. NULLs sort
+        first in ascending order and last in descending order.
+        """
+        sort_column = sort_keys[0]
+        operator = '<' if descending else '>'
+        param_names = [
+            'p{}'.format(len(params) + i) for i in range(len(sort_keys))
+        ]
+        if sort_value is None:
+            params.update(zip(param_names[1:], pk_values))
+            clause = '("{}" is null and {})'.format(
+                sort_column,
+                keyset_where_clause(sort_keys[1:], param_names[1:], operator),
+            )
+            if not descending:
+                clause = '({} or "{}" is not null)'.format(clause, sort_column)
+            return clause
+        params.update(zip(param_names, [sort_value] + pk_values))
+        clause = keyset_where_clause(sort_keys, param_names, operator)
+        if descending:
+            clause = '({} or "{}" is null)'.format(clause, sort_column)
+        return clause
+
+    async def facet(self, request, name, table, column, where_clause, params, filter_args):
+        """
+        Returns the most common values of column among the rows matched by
+        where_clause, each with a URL that toggles filtering on that value.
+        Unfiltered tables use the counts precomputed at inspect time.
+        """
+        results = None
+        truncated = False
+        timed_out = False
+        if not where_clause:
+            table_info = self.database_info(name)['tables'].get(table) or {}
+            results = table_info.get('facets', {}).get(column)
+        if results is None:
+            sql = 'select "{column}" as value, count(*) as count from {table_name} {where}group by "{column}" order by count desc, "{column}" limit {limit}'.format(
+                column=column,
+                table_name=escape_sqlite_table_name(table),
+                where=where_clause,
+                limit=FACET_SIZE + 1,
+            )
+            try:
+                results = list(await self.execute(
+                    name, sql, params,
+                    custom_time_limit=self.ds.facet_time_limit_ms,
+                ))
+            except sqlite3.OperationalError:
+                # Almost certainly hit the timeout
+                results = []
+                timed_out = True
+            truncated = len(results) > FACET_SIZE
+            results = results[:FACET_SIZE]
+        facet_results = []
+        for value, count in results:
+            if value is None:
+                key, arg_value = '{}__isnull'.format(column), '1'
+            else:
+                key, arg_value = column, str(value)
+            selected = filter_args.get(key) == arg_value
+            facet_results.append({
+                'value': value,
+                'count': count,
+                'selected': selected,
+                'toggle_url': path_with_added_args(request, {
+                    key: None if selected else arg_value,
+                    '_next': None,
+                }),
+            })
+        return {
+            'name': column,
+            'results': facet_results,
+            'truncated': truncated,
+            'timed_out': timed_out,
+        }
+
+    async def filtered_count(self, name, count_sql, params, **extra_args):
+        "Runs count_sql, remembering the result for this version of the database"
+        count = self.ds.cached_count(self.database_info(name)['hash'], count_sql, params)
+        if count is None:
+            try:
+                count_rows = list(await self.execute(name, count_sql, params, **extra_args))
+            except sqlite3.OperationalError:
+                # Almost certainly hit the timeout
+                return None
+            count = count_rows[0][0]
+            self.ds.store_count(self.database_info(name)['hash'], count_sql, params, count)
+        return count
+
+
 class RowView(RowTableShared):
     async def data(self, request, name, hash, table, pk_path):
         table = urllib.parse.unquote_plus(table)
         pk_values = compound_pks_from_path(pk_path)
         pks = await self.pks_for_table(name, table)
         use_rowid = not pks
-        select = '*'
+        select = await self.select_columns(
+            name, table, dict(request.args), keep=set(pks), use_rowid=use_rowid
+        )
         if use_rowid:
-            select = 'rowid, *'
             pks = ['rowid']
         wheres = [
             '"{}"=:p{}'.format(pk, i)
@@ -755,20 +1520,31 @@ class RowView(RowTableShared):
         params = {}
         for i, pk_value in enumerate(pk_values):
             params['p{}'.format(i)] = pk_value
-        # rows, truncated, description = await self.execute(name, sql, params, truncate=True)
-        rows, truncated, description = await self.execute(name, sql, params, truncate=True)
+        foreign_key_tables = None
+        if 'foreign_key_tables' in (request.raw_args.get('_extras') or '').split(','):
+            # The incoming foreign key counts only need the primary key, so
+            # they can run at the same time as the row query
+            (rows, truncated, description), foreign_key_tables = await asyncio.gather(
+                self.execute(name, sql, params, truncate=True),
+                self.foreign_key_tables(name, table, pk_values),
+            )
+        else:
+            rows, truncated, description = await self.execute(name, sql, params, truncate=True)
         columns = [r[0] for r in description]
         rows = list(rows)
         if not rows:
             raise NotFound('Record not found: {}'.format(pk_values))
 
         async def template_data():
-            display_columns, display_rows = await self.display_columns_and_rows(
-                name, table, description, rows, link_column=False, expand_foreign_keys=True
+            (display_columns, display_rows), foreign_key_tables = await asyncio.gather(
+                self.display_columns_and_rows(
+                    name, table, description, rows, link_column=False, expand_foreign_keys=True
+                ),
+                self.foreign_key_tables(name, table, pk_values),
             )
             return {
                 'database_hash': hash,
-                'foreign_key_tables': await self.foreign_key_tables(name, table, pk_values),
+                'foreign_key_tables': foreign_key_tables,
                 'display_columns': display_columns,
                 'display_rows': display_rows,
                 'custom_rows_and_columns_templates': [
@@ -790,8 +1566,8 @@ class RowView(RowTableShared):
             'primary_key_values': pk_values,
         }
 
-        if 'foreign_key_tables' in (request.raw_args.get('_extras') or '').split(','):
-            data['foreign_key_tables'] = await self.foreign_key_tables(name, table, pk_values)
+        if foreign_key_tables is not None:
+            data['foreign_key_tables'] = foreign_key_tables
 
         return data, template_data, (
             'row-{}-{}.html'.format(to_css_class(name), to_css_class(table)),
@@ -801,28 +1577,41 @@ class RowView(RowTableShared):
     async def foreign_key_tables(self, name, table, pk_values):
         if len(pk_values) != 1:
             return []
-        table_info = self.ds.inspect()[name]['tables'].get(table)
+        table_info = self.database_info(name)['tables'].get(table)
         if not table:
             return []
         foreign_keys = table_info['foreign_keys']['incoming']
-        sql = 'select ' + ', '.join([
-            '(select count(*) from {table} where "{column}"=:id)'.format(
-                table=escape_sqlite_table_name(fk['other_table']),
-                column=fk['other_column'],
-            )
-            for fk in foreign_keys
-        ])
-        try:
-            rows = list(await self.execute(name, sql, {'id': pk_values[0]}))
-        except sqlite3.OperationalError:
-            # Almost certainly hit the timeout
+        if not foreign_keys:
             return []
-        foreign_table_counts = dict(
-            zip(
-                [(fk['other_table'], fk['other_column']) for fk in foreign_keys],
-                list(rows[0]),
+        fk_counts_table = self.database_info(name).get('fk_counts_table')
+        if fk_counts_table:
+            # Counted ahead of time by datasette optimize --fk-counts
+            rows = await self.execute(
+                name,
+                'select other_table, other_column, count from [{}] '
+                'where table_name = :table and value = :id'.format(fk_counts_table),
+                {'table': table, 'id': str(pk_values[0])},
+            )
+            foreign_table_counts = {(row[0], row[1]): row[2] for row in rows}
+        else:
+            sql = 'select ' + ', '.join([
+                '(select count(*) from {table} where "{column}"=:id)'.format(
+                    table=escape_sqlite_table_name(fk['other_table']),
+                    column=fk['other_column'],
+                )
+                for fk in foreign_keys
+            ])
+            try:
+                rows = list(await self.execute(name, sql, {'id': pk_values[0]}))
+            except sqlite3.OperationalError:
+                # Almost certainly hit the timeout
+                return []
+            foreign_table_counts = dict(
+                zip(
+                    [(fk['other_table'], fk['other_column']) for fk in foreign_keys],
+                    list(rows[0]),
+                )
             )
-        )
         foreign_key_tables = []
         for fk in foreign_keys:
             count = foreign_table_counts.get((fk['other_table'], fk['other_column'])) or 0
@@ -830,12 +1619,242 @@ class RowView(RowTableShared):
         return foreign_key_tables
 
 
+class CellView(RowTableShared):
+    async def view_get(self, request, name, hash, table, pk_path, column):
+        "Returns the full value of a single cell, which table pages may truncate"
+        table = urllib.parse.unquote_plus(table)
+        column = urllib.parse.unquote_plus(column)
+        if column not in await self.table_columns(name, table):
+            raise NotFound('Column not found: {}'.format(column))
+        pk_values = compound_pks_from_path(pk_path)
+        pks = await self.pks_for_table(name, table) or ['rowid']
+        if len(pk_values) != len(pks):
+            raise NotFound('Record not found: {}'.format(pk_values))
+        wheres = [
+            '"{}"=:p{}'.format(pk, i)
+            for i, pk in enumerate(pks)
+        ]
+        sql = 'select "{}" from {} where {}'.format(
+            column, escape_sqlite_table_name(table), ' AND '.join(wheres)
+        )
+        params = {
+            'p{}'.format(i): pk_value
+            for i, pk_value in enumerate(pk_values)
+        }
+        rows = list(await self.execute(name, sql, params))
+        if not rows:
+            raise NotFound('Record not found: {}'.format(pk_values))
+        value = rows[0][0]
+        headers = {}
+        if self.ds.cors:
+            headers['Access-Control-Allow-Origin'] = '*'
+        if self.ds.cache_headers:
+            headers['Cache-Control'] = 'max-age={}'.format(365 * 24 * 60 * 60)
+        if isinstance(value, bytes):
+            return response.HTTPResponse(
+                body_bytes=value,
+                content_type='application/octet-stream',
+                headers=headers,
+            )
+        return response.HTTPResponse(
+            '' if value is None else str(value),
+            content_type='text/plain; charset=utf-8',
+            headers=headers,
+        )
+
+
+class SuggestView(RowTableShared):
+    async def get(self, request, db_name, table):
+        # Redirecting to the URL with the hash would double the latency of
+        # every keystroke, so suggestions are returned for either URL - but
+        # only cached by browsers at the URL with the hash
+        name, hash, should_redirect = await self.resolve_db_name(db_name, table=table)
+        r = await self.view_get(request, name, hash, table=table, as_json='.json')
+        if should_redirect:
+            r.headers.pop('Cache-Control', None)
+        return r
+
+    async def data(self, request, name, hash, table):
+        """
+        Returns the id and label of up to _size rows matching q as a prefix,
+        for search-as-you-type. Unlike _search there is no count, ordering
+        or foreign key expansion, and recent prefixes are cached.
+        """
+        table = urllib.parse.unquote_plus(table)
+        fts_table = (await self.table_schema(name, table))['fts_table']
+        if not fts_table:
+            raise DatasetteError('Table has no full-text search index: {}'.format(table))
+        q = request.raw_args.get('q') or ''
+        try:
+            size = int(request.raw_args.get('_size') or SUGGEST_SIZE)
+        except ValueError:
+            raise DatasetteError('_size must be an integer')
+        if not 0 < size <= self.max_returned_rows:
+            raise DatasetteError('_size must be between 1 and {}'.format(
+                self.max_returned_rows
+            ))
+        query = fts_prefix_query(q)
+        suggestions = []
+        if query:
+            key = (name, table, query, size)
+            suggestions = self.ds.cached_suggestions(self.database_info(name)['hash'], key)
+            if suggestions is None:
+                suggestions = await self.suggestions(name, table, fts_table, query, size)
+                self.ds.store_suggestions(self.database_info(name)['hash'], key, suggestions)
+        return {
+            'database': name,
+            'table': table,
+            'q': q,
+            'suggestions': suggestions,
+        }, {}, []
+
+    async def suggestions(self, name, table, fts_table, query, size):
+        id_column, label_column = await self.id_and_label_columns(name, table, fts_table)
+        # The limit applies to the FTS lookup, so only the first few matches
+        # are read - prefix indexes on the FTS table make that faster still
+        sql = (
+            'select "{id_column}", "{label_column}" from {table_name} '
+            'where rowid in (select rowid from [{fts_table}] where [{fts_table}] match :query limit {size})'
+        ).format(
+            id_column=id_column,
+            label_column=label_column,
+            table_name=escape_sqlite_table_name(table),
+            fts_table=fts_table,
+            size=size,
+        )
+        rows = await self.execute(name, sql, {'query': query})
+        return [{'id': row[0], 'label': row[1]} for row in rows]
+
+
+class SearchView(RowTableShared):
+    async def get(self, request):
+        """
+        Searches every FTS4 and FTS5 table of every database at once. The
+        searches share one time budget, and tables that don't finish within
+        it are listed in timed_out rather than holding up the response.
+        Tables whose search fails are listed in failed, unless they all do.
+        """
+        start = time.time()
+        q = request.raw_args.get('q') or ''
+        try:
+            size = int(request.raw_args.get('_size') or SEARCH_SIZE)
+        except ValueError:
+            return self.search_error('_size must be an integer')
+        if not 0 < size <= self.max_returned_rows:
+            return self.search_error('_size must be between 1 and {}'.format(
+                self.max_returned_rows
+            ))
+        results = []
+        timed_out = []
+        failed = []
+        searched = []
+        if q.strip():
+            deadline = time.time() + self.ds.search_time_limit_ms / 1000
+            # Only search what's inspected now, and keep it for the request
+            self.database_infos = self.ds.inspected_databases()
+            searches = OrderedDict(
+                (asyncio.ensure_future(self.search_table(name, table, fts_table, q, size, deadline)), (name, table))
+                for name, table, fts_table in self.ds.searchable_tables(self.database_infos)
+            )
+            done = set()
+            if searches:
+                done, pending = await asyncio.wait(
+                    searches, timeout=max(deadline - time.time(), 0)
+                )
+                for future in pending:
+                    future.cancel()
+            for future, (name, table) in searches.items():
+                if future not in done:
+                    timed_out.append({'database': name, 'table': table})
+                    continue
+                error = future.exception()
+                if error is None:
+                    # Tables without ranking (FTS3) give None and are skipped
+                    if future.result() is not None:
+                        searched.append({'database': name, 'table': table})
+                        results.extend(future.result())
+                elif 'interrupted' in str(error):
+                    timed_out.append({'database': name, 'table': table})
+                else:
+                    failed.append({'database': name, 'table': table, 'error': str(error)})
+            if failed and not searched and not timed_out:
+                # An invalid search fails the same way in every table
+                return self.search_error(failed[-1]['error'])
+            results.sort(key=lambda result: result['rank'])
+        return self.json_response({
+            'q': q,
+            'results': results[:size],
+            'searched': searched,
+            'timed_out': timed_out,
+            'failed': failed,
+            'query_ms': (time.time() - start) * 1000,
+        })
+
+    def search_error(self, error):
+        return self.json_response({'ok': False, 'error': error}, 400)
+
+    async def search_table(self, name, table, fts_table, q, size, deadline):
+        "Returns the best size matches for q in a table, or None if it has no ranking"
+        try:
+            rank_search = self.rank_search_expressions(name, fts_table)
+        except DatasetteError:
+            return None
+        id_column, label_column = await self.id_and_label_columns(name, table, fts_table)
+        pks = await self.pks_for_table(name, table)
+        use_rowid = not pks
+        table_name = escape_sqlite_table_name(table)
+        sql = (
+            'select {id_column}, {label_column}, {pk_columns}, search.search_rank, search.search_snippet '
+            'from {table_name} join (select rowid as search_rowid, {rank} as search_rank, '
+            '{snippet} as search_snippet from [{fts_table}] where [{fts_table}] match :search '
+            'order by search_rank limit {size}) search on {table_name}.rowid = search.search_rowid'
+        ).format(
+            id_column='{}.rowid'.format(table_name) if id_column == 'rowid' else '"{}"'.format(id_column),
+            label_column='{}.rowid'.format(table_name) if label_column == 'rowid' else '"{}"'.format(label_column),
+            pk_columns=', '.join(
+                '{}.rowid as rowid'.format(table_name) if use_rowid else '"{}"'.format(pk)
+                for pk in (pks or ['rowid'])
+            ),
+            table_name=table_name,
+            rank=rank_search['rank'],
+            snippet=rank_search['snippet'],
+            fts_table=fts_table,
+            size=size,
+        )
+        # Queries queued behind busy threads only get what's left of the
+        # budget, as cancelling the search doesn't stop a running query
+        rows = await self.execute(name, sql, {'search': q}, deadline=deadline)
+        path = '/{}-{}/{}/'.format(
+            name,
+            self.database_info(name)['hash'][:HASH_LENGTH],
+            urllib.parse.quote_plus(table),
+        )
+        pk_names = ['rowid'] if use_rowid else pks
+        results = []
+        for row in rows:
+            pk_row = CellRow(pk_names, row[2:-2])
+            results.append({
+                'database': name,
+                'table': table,
+                'id': row[0],
+                'label': row[1],
+                'rank': row[-2],
+                'snippet': tagged_snippet(row[-1]),
+                'url': path + path_from_row_pks(pk_row, pk_names, use_rowid),
+            })
+        return results
+
+
 class Datasette:
     def __init__(
             self, files, num_threads=3, cache_headers=True, page_size=100,
             max_returned_rows=1000, sql_time_limit_ms=1000, cors=False,
             inspect_data=None, metadata=None, sqlite_extensions=None,
-            template_dir=None, static_mounts=None):
+            template_dir=None, static_mounts=None, column_stats=False,
+            column_stats_time_limit_ms=1000, watch=False, metadata_file=None,
+            lazy=False, max_open_databases=0, defer_counts=False,
+            facet_time_limit_ms=200, truncate_cells=0,
+            search_time_limit_ms=500, label_cache_size=LABEL_CACHE_SIZE):
         self.files = files
         self.num_threads = num_threads
         self.executor = futures.ThreadPoolExecutor(
@@ -847,11 +1866,42 @@ class Datasette:
         self.sql_time_limit_ms = sql_time_limit_ms
         self.cors = cors
         self._inspect = inspect_data
+        self.lazy = lazy
+        if lazy:
+            # Least recently used databases are at the front
+            self._inspect = OrderedDict(inspect_data or {})
+        self.max_open_databases = max_open_databases
+        self._inspect_lock = threading.Lock()
+        self._paths = OrderedDict()
+        for filename in files:
+            name = Path(filename).stem
+            if name in self._paths:
+                raise Exception('Multiple files with same stem %s' % name)
+            self._paths[name] = filename
+        self._summaries = {}
+        self._database_names = None
+        self.defer_counts = defer_counts
+        self.facet_time_limit_ms = facet_time_limit_ms
+        self.truncate_cells = truncate_cells
+        self.search_time_limit_ms = search_time_limit_ms
+        # Least recently used counts and suggestions are at the front
+        self._counts = OrderedDict()
+        self._suggestions = OrderedDict()
+        # Foreign key labels, up to label_cache_size bytes
+        self.label_cache = LabelCache(label_cache_size)
         self.metadata = metadata or {}
         self.sqlite_functions = []
         self.sqlite_extensions = sqlite_extensions or []
         self.template_dir = template_dir
         self.static_mounts = static_mounts or []
+        self.column_stats = column_stats
+        self.column_stats_time_limit_ms = column_stats_time_limit_ms
+        self.watch = watch
+        self.metadata_file = metadata_file
+        self._file_signatures = {}
+        if watch:
+            for filename in self.watched_files():
+                self._file_signatures[filename] = file_signature(filename)
 
     def app_css_hash(self):
         if not hasattr(self, '_app_css_hash'):
@@ -893,90 +1943,241 @@ class Datasette:
         return self.asset_urls('extra_js_urls')
 
     def prepare_connection(self, conn):
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = lambda x: str(x, 'utf-8', 'replace')
-        for name, num_args, func in self.sqlite_functions:
-            conn.create_function(name, num_args, func)
-        if self.sqlite_extensions:
-            conn.enable_load_extension(True)
-            for extension in self.sqlite_extensions:
-                conn.execute("SELECT load_extension('{}')".format(extension))
+        prepare_connection(conn, self.sqlite_functions, self.sqlite_extensions)
 
     def inspect(self):
+        if self.lazy:
+            return {name: self.database_info(name) for name in self._paths}
         if not self._inspect:
             self._inspect = {}
-            for filename in self.files:
-                path = Path(filename)
-                name = path.stem
-                if name in self._inspect:
-                    raise Exception('Multiple files with same stem %s' % name)
-                # Calculate hash, efficiently
-                m = hashlib.sha256()
-                with path.open('rb') as fp:
-                    while True:
-                        data = fp.read(HASH_BLOCK_SIZE)
-                        if not data:
-                            break
-                        m.update(data)
-                # List tables and their row counts
-                tables = {}
-                views = []
-                with sqlite3.connect('file:{}?immutable=1'.format(path), uri=True) as conn:
-                    self.prepare_connection(conn)
-                    table_names = [
-                        r['name']
-                        for r in conn.execute('select * from sqlite_master where type="table"')
-                    ]
-                    views = [v[0] for v in conn.execute('select name from sqlite_master where type = "view"')]
-                    for table in table_names:
-                        count = conn.execute(
-                            'select count(*) from {}'.format(escape_sqlite_table_name(table))
-                        ).fetchone()[0]
-                        label_column = None
-                        # If table has two columns, one of which is ID, then label_column is the other one
-                        column_names = [r[1] for r in conn.execute(
-                            'PRAGMA table_info({});'.format(escape_sqlite_table_name(table))
-                        ).fetchall()]
-                        if column_names and len(column_names) == 2 and 'id' in column_names:
-                            label_column = [c for c in column_names if c != 'id'][0]
-                        tables[table] = {
-                            'name': table,
-                            'columns': column_names,
-                            'count': count,
-                            'label_column': label_column,
-                            'hidden': False,
-                        }
-
-                    foreign_keys = get_all_foreign_keys(conn)
-                    for table, info in foreign_keys.items():
-                        tables[table]['foreign_keys'] = info
-
-                    # Mark tables 'hidden' if they relate to FTS virtual tables
-                    fts_tables = [
-                        r['name']
-                        for r in conn.execute(
-                            '''
-                                select name from sqlite_master
-                                where rootpage = 0
-                                and sql like '%VIRTUAL TABLE%USING FTS%'
-                            '''
-                        )
-                    ]
-                    for t in tables.keys():
-                        for fts_table in fts_tables:
-                            if t == fts_table or t.startswith(fts_table):
-                                tables[t]['hidden'] = True
-                                continue
-
-                self._inspect[name] = {
-                    'hash': m.hexdigest(),
-                    'file': str(path),
-                    'tables': tables,
-                    'views': views,
-
-                }
+            for name, filename in self._paths.items():
+                self._inspect[name] = self.inspect_file(filename)[1]
         return self._inspect
 
+    def has_database(self, name):
+        if self.lazy:
+            return name in self._paths or name in self._inspect
+        return name in self.inspect()
+
+    def database_info(self, name):
+        """
+        Returns the inspect data for a single database. In lazy mode the file
+        is inspected the first time it is needed, and only the most recently
+        used max_open_databases databases are kept in memory.
+        """
+        if not self.lazy:
+            return self.inspect()[name]
+        with self._inspect_lock:
+            info = self._inspect.get(name)
+            if info is not None:
+                self._inspect.move_to_end(name)
+                return info
+        _, info = self.inspect_file(self._paths[name])
+        self.store_database_info(name, info)
+        return info
+
+    def store_database_info(self, name, info):
+        with self._inspect_lock:
+            self._inspect[name] = info
+            self._summaries[name] = database_summary(name, info)
+            if self.lazy:
+                self._inspect.move_to_end(name)
+                while self.max_open_databases and len(self._inspect) > self.max_open_databases:
+                    self._inspect.popitem(last=False)
+
+    def count_key(self, database_hash, count_sql, params):
+        return (
+            database_hash,
+            count_sql,
+            tuple(sorted((params or {}).items())),
+        )
+
+    def cached_count(self, database_hash, count_sql, params):
+        """
+        Returns the previously calculated result of count_sql, or None. Counts
+        are keyed on the database hash, so a changed file is counted again.
+        """
+        key = self.count_key(database_hash, count_sql, params)
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+        return count
+
+    def store_count(self, database_hash, count_sql, params, count):
+        self._counts[self.count_key(database_hash, count_sql, params)] = count
+        while len(self._counts) > COUNT_CACHE_SIZE:
+            self._counts.popitem(last=False)
+
+    def cached_suggestions(self, database_hash, key):
+        "Returns the suggestions previously stored for key, or None"
+        key = (database_hash, key)
+        suggestions = self._suggestions.get(key)
+        if suggestions is not None:
+            self._suggestions.move_to_end(key)
+        return suggestions
+
+    def store_suggestions(self, database_hash, key, suggestions):
+        self._suggestions[(database_hash, key)] = suggestions
+        while len(self._suggestions) > SUGGEST_CACHE_SIZE:
+            self._suggestions.popitem(last=False)
+
+    def inspected_databases(self):
+        """
+        Returns a dictionary of database name => inspect data. In lazy mode
+        only databases that are currently inspected are included.
+        """
+        if self.lazy:
+            with self._inspect_lock:
+                return OrderedDict(self._inspect)
+        return OrderedDict(self.inspect())
+
+    def searchable_tables(self, databases):
+        """
+        Returns (database, table, FTS table) for every table with a full-text
+        search index in databases, as returned by inspected_databases()
+        """
+        return [
+            (name, table, info['fts_table'])
+            for name, database in sorted(databases.items())
+            for table, info in sorted(database['tables'].items())
+            if info.get('fts_table') and not info['hidden']
+        ]
+
+    def database_summaries(self, after=None, size=None):
+        """
+        Returns (summaries, next_name) for one page of the index, ordered by
+        database name. Summaries are calculated once per database and kept
+        after the full inspect data has been evicted. Databases that have not
+        been inspected yet in lazy mode are listed by name only.
+        """
+        if self._database_names is None:
+            if self.lazy:
+                names = set(self._paths) | set(self._inspect)
+            else:
+                names = self.inspect().keys()
+            self._database_names = sorted(names)
+        names = self._database_names
+        start = bisect.bisect_right(names, after) if after else 0
+        end = len(names)
+        if size:
+            end = min(start + size, end)
+        summaries = []
+        for name in names[start:end]:
+            summary = self._summaries.get(name)
+            if summary is None:
+                info = self._inspect.get(name)
+                if info is None:
+                    summary = {'name': name, 'hash': None, 'path': name}
+                else:
+                    summary = self._summaries[name] = database_summary(name, info)
+            summaries.append(summary)
+        next_name = None
+        if end < len(names):
+            next_name = names[end - 1]
+        return summaries, next_name
+
+    def connection(self, name):
+        """
+        Returns this thread's connection to the named database. Each thread
+        keeps at most max_open_databases connections open, closing the least
+        recently used when it needs another.
+        """
+        info = self.database_info(name)
+        open_connections = getattr(connections, 'databases', None)
+        if open_connections is None:
+            open_connections = connections.databases = OrderedDict()
+        conn, conn_hash = open_connections.pop(name, (None, None))
+        if conn_hash != info['hash']:
+            # First query in this thread, or the file has been reloaded
+            if conn:
+                conn.close()
+            conn = sqlite3.connect(
+                'file:{}?immutable=1'.format(info['file']),
+                uri=True,
+                check_same_thread=False,
+            )
+            self.prepare_connection(conn)
+            if info.get('trigrams_file'):
+                conn.execute('ATTACH DATABASE ? AS trigrams', [
+                    'file:{}?immutable=1'.format(info['trigrams_file'])
+                ])
+        open_connections[name] = (conn, info['hash'])
+        while self.max_open_databases and len(open_connections) > self.max_open_databases:
+            _, (old_conn, _) = open_connections.popitem(last=False)
+            old_conn.close()
+        return conn
+
+    def inspect_file(self, filename):
+        "Returns (name, inspect data) for a single database file"
+        return inspect_database(
+            filename,
+            sqlite_functions=self.sqlite_functions,
+            sqlite_extensions=self.sqlite_extensions,
+            column_stats=self.column_stats,
+            column_stats_time_limit_ms=self.column_stats_time_limit_ms,
+            facets=self.metadata_facets(Path(filename).stem),
+        )
+
+    def metadata_facets(self, name):
+        "Returns table name => default facet columns from the metadata"
+        tables = self.metadata.get('databases', {}).get(name, {}).get('tables', {})
+        return {
+            table: table_metadata['facets']
+            for table, table_metadata in tables.items()
+            if table_metadata.get('facets')
+        }
+
+    def watched_files(self):
+        files = list(self.files)
+        if self.metadata_file:
+            files.append(self.metadata_file)
+        return files
+
+    def reload_changed_files(self):
+        """
+        Re-inspects any database file that has changed on disk, and re-reads
+        the metadata file if that has changed. The new inspect data for a
+        database replaces the old in a single assignment, so requests that are
+        already running finish against the data they started with. Databases
+        that have not changed keep their existing inspect data and connections.
+        """
+        if not self.lazy:
+            self.inspect()
+        for filename in self.watched_files():
+            try:
+                signature = file_signature(filename)
+            except OSError:
+                # File is probably in the middle of being replaced
+                continue
+            if signature == self._file_signatures.get(filename):
+                continue
+            try:
+                if filename == self.metadata_file:
+                    with open(filename) as fp:
+                        self.metadata = json.load(fp)
+                else:
+                    name = Path(filename).stem
+                    if self.lazy and name not in self._inspect:
+                        # Not in use - it will be inspected when next needed
+                        self._summaries.pop(name, None)
+                    else:
+                        name, info = self.inspect_file(filename)
+                        self.store_database_info(name, info)
+            except (ValueError, sqlite3.DatabaseError) as e:
+                # Partially written file - try again next time
+                print('ERROR: could not reload {}: {}'.format(filename, e))
+                continue
+            self._file_signatures[filename] = signature
+            print('Reloaded {}'.format(filename))
+
+    async def watch_for_changes(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            # Hashing a large file can take a while, so keep it out of the
+            # executor that serves SQL queries
+            await loop.run_in_executor(None, self.reload_changed_files)
+
     def app(self):
         app = Sanic(__name__)
         default_templates = str(app_root / 'datasette' / 'templates')
@@ -998,9 +2199,12 @@ class Datasette:
         self.jinja_env.filters['quote_plus'] = lambda u: urllib.parse.quote_plus(u)
         self.jinja_env.filters['escape_table_name'] = escape_sqlite_table_name
         self.jinja_env.filters['to_css_class'] = to_css_class
+        if self.watch:
+            app.add_task(self.watch_for_changes)
         app.add_route(IndexView.as_view(self), '/<as_json:(\.jsono?)?$>')
         # TODO: /favicon.ico and /-/static/ deserve far-future cache expires
         app.add_route(favicon, '/favicon.ico')
+        app.add_route(SearchView.as_view(self), '/-/search')
         app.static('/-/static/', str(app_root / 'datasette' / 'static'))
         for path, dirname in self.static_mounts:
             app.static(path, dirname)
@@ -1020,4 +2224,12 @@ class Datasette:
             RowView.as_view(self),
             '/<db_name:[^/]+>/<table:[^/]+?>/<pk_path:[^/]+?><as_json:(\.jsono?)?$>'
         )
+        app.add_route(
+            SuggestView.as_view(self),
+            '/<db_name:[^/]+>/<table:[^/]+?>/-/suggest'
+        )
+        app.add_route(
+            CellView.as_view(self),
+            '/<db_name:[^/]+>/<table:[^/]+?>/<pk_path:[^/]+?>/<column:[^/]+?>'
+        )
         return app
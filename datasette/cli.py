@@ -5,9 +5,8 @@ import os
 import shutil
 from subprocess import call, check_output
 import sys
-from .app import Datasette
 from .utils import (
-    temporary_docker_directory, temporary_heroku_directory
+    CustomJSONEncoder, temporary_docker_directory, temporary_heroku_directory
 )
 
 
@@ -38,9 +37,21 @@ def cli():
     'sqlite_extensions', '--load-extension', envvar='SQLITE_EXTENSIONS', multiple=True,
     type=click.Path(exists=True, resolve_path=True), help='Path to a SQLite extension to load'
 )
-def inspect(files, inspect_file, sqlite_extensions):
-    app = Datasette(files, sqlite_extensions=sqlite_extensions)
-    open(inspect_file, 'w').write(json.dumps(app.inspect(), indent=2))
+@click.option('--column-stats', is_flag=True, help='Record null counts, distinct counts, min/max and most common values for every column')
+@click.option('--column-stats-time-limit-ms', default=1000, help='Max time to spend calculating column statistics for each table')
+@click.option('--facets', is_flag=True, help='Precompute facet counts for every column with few distinct values')
+@click.option('--facets-time-limit-ms', default=200, help='Max time to spend precomputing facet counts for each table')
+def inspect(files, inspect_file, sqlite_extensions, column_stats, column_stats_time_limit_ms, facets, facets_time_limit_ms):
+    from .inspect import inspect_databases
+    inspect_data = inspect_databases(
+        files,
+        sqlite_extensions=sqlite_extensions,
+        column_stats=column_stats,
+        column_stats_time_limit_ms=column_stats_time_limit_ms,
+        facets=facets or None,
+        facets_time_limit_ms=facets_time_limit_ms,
+    )
+    open(inspect_file, 'w').write(json.dumps(inspect_data, indent=2, cls=CustomJSONEncoder))
 
 
 @cli.command()
@@ -139,9 +150,9 @@ def skeleton(files, metadata, sqlite_extensions):
             err=True,
         )
         sys.exit(1)
-    app = Datasette(files, sqlite_extensions=sqlite_extensions)
+    from .inspect import inspect_databases
     databases = {}
-    for database_name, info in app.inspect().items():
+    for database_name, info in inspect_databases(files, sqlite_extensions=sqlite_extensions).items():
         databases[database_name] = {
             'title': None,
             'description': None,
@@ -176,6 +187,89 @@ def skeleton(files, metadata, sqlite_extensions):
     click.echo('Wrote skeleton to {}'.format(metadata))
 
 
+@cli.command()
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('table')
+@click.argument('columns', nargs=-1, required=True)
+def trigrams(file, table, columns):
+    """
+    Build a trigram index for the contains and endswith filters on COLUMNS
+
+    The index is written to FILE.trigrams, which datasette serve uses for as
+    long as FILE is unchanged. Requires SQLite 3.34 or later.
+    """
+    import sqlite3
+    from .inspect import database_hash
+    from .trigrams import build_trigram_index
+    conn = sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(file)), uri=True)
+    try:
+        table_columns = [
+            r[1] for r in conn.execute('PRAGMA table_info("{}")'.format(table))
+        ]
+        if not table_columns:
+            raise click.ClickException('Table not found: {}'.format(table))
+        for column in columns:
+            if column not in table_columns:
+                raise click.ClickException('Column not found: {}'.format(column))
+        try:
+            conn.execute("create virtual table temp.t using fts5(value, tokenize='trigram')")
+        except sqlite3.OperationalError:
+            raise click.ClickException(
+                'SQLite {} does not support the FTS5 trigram tokenizer'.format(sqlite3.sqlite_version)
+            )
+    finally:
+        conn.close()
+    path = build_trigram_index(file, database_hash(file), table, columns)
+    click.echo('Wrote trigram index to {}'.format(path))
+
+
+@cli.command()
+@click.argument('files', type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True)
+@click.option('-m', '--metadata', type=click.File(mode='r'), help='Path to JSON metadata file - the sortable_columns and facets of its tables are indexed too')
+@click.option('--page-size', default=4096, help='Page size to rewrite the files with - default is 4096')
+@click.option('--no-vacuum', is_flag=True, help='Skip the VACUUM that rewrites each file, and so the page size change')
+@click.option('--fk-counts', is_flag=True, help='Store the number of rows referencing each row, for the incoming foreign keys on row pages')
+def optimize(files, metadata, page_size, no_vacuum, fk_counts):
+    """
+    Optimize database files for serving
+
+    Indexes the foreign key columns and the sortable and facet columns from
+    the metadata, runs ANALYZE and VACUUM, then prints how long the queries
+    for each table page took before and after. Run it again after changing
+    a file, as the --fk-counts are only correct for the file as it was.
+    """
+    from pathlib import Path
+    from .optimize import optimize_database, table_page_queries, time_queries
+    import sqlite3
+    if page_size < 512 or page_size > 65536 or page_size & (page_size - 1):
+        raise click.ClickException('--page-size must be a power of two between 512 and 65536')
+    metadata_data = json.loads(metadata.read()) if metadata else {}
+    for file in files:
+        table_metadata = metadata_data.get('databases', {}).get(
+            Path(file).stem, {}
+        ).get('tables', {})
+        conn = sqlite3.connect(file)
+        try:
+            queries = table_page_queries(conn, table_metadata)
+        finally:
+            conn.close()
+        before = time_queries(file, queries)
+        created, counts_written = optimize_database(
+            file, table_metadata, page_size, vacuum=not no_vacuum, fk_counts=fk_counts
+        )
+        after = time_queries(file, queries)
+        click.echo(file)
+        for index_name in created:
+            click.echo('  Created index {}'.format(index_name))
+        if counts_written is not None:
+            click.echo('  Stored {} foreign key counts'.format(counts_written))
+        click.echo('  Ran ANALYZE{}'.format('' if no_vacuum else ' and VACUUM'))
+        for (table, description, sql), before_ms, after_ms in zip(queries, before, after):
+            click.echo('  {}: {}: {:.2f}ms -> {:.2f}ms'.format(
+                table, description, before_ms, after_ms
+            ))
+
+
 @cli.command()
 @click.argument('files', type=click.Path(exists=True), nargs=-1, required=True)
 @click.option(
@@ -221,10 +315,18 @@ def package(files, tag, metadata, extra_options, branch, template_dir, static, *
 @click.option('-p', '--port', default=8001, help='port for server, defaults to 8001')
 @click.option('--debug', is_flag=True, help='Enable debug mode - useful for development')
 @click.option('--reload', is_flag=True, help='Automatically reload if code change detected - useful for development')
+@click.option('--watch', is_flag=True, help='Reload changed database files and metadata without restarting')
 @click.option('--cors', is_flag=True, help='Enable CORS by serving Access-Control-Allow-Origin: *')
 @click.option('--page_size', default=100, help='Page size - default is 100')
 @click.option('--max_returned_rows', default=1000, help='Max allowed rows to return at once - default is 1000. Set to 0 to disable check entirely.')
 @click.option('--sql_time_limit_ms', default=1000, help='Max time allowed for SQL queries in ms')
+@click.option('--facet_time_limit_ms', default=200, help='Max time allowed for each facet count in ms')
+@click.option('--search_time_limit_ms', default=500, help='Max time allowed for searching every table at /-/search in ms')
+@click.option('--label_cache_mb', default=10, help='Memory for caching foreign key labels in MB - default is 10')
+@click.option('--truncate_cells', default=0, help='Truncate text and binary values longer than this in table listings - default is 0, no truncation')
+@click.option('--lazy', is_flag=True, help='Inspect each database the first time it is requested, rather than on startup')
+@click.option('--defer_counts', is_flag=True, help='Return table pages without waiting for filtered row counts, which the page then fetches separately')
+@click.option('--max_open_databases', default=0, help='Max databases each thread keeps connections open to (and keeps inspect data for, with --lazy) - default is 0, no limit')
 @click.option(
     'sqlite_extensions', '--load-extension', envvar='SQLITE_EXTENSIONS', multiple=True,
     type=click.Path(exists=True, resolve_path=True), help='Path to a SQLite extension to load'
@@ -233,13 +335,13 @@ def package(files, tag, metadata, extra_options, branch, template_dir, static, *
 @click.option('-m', '--metadata', type=click.File(mode='r'), help='Path to JSON file containing license/source metadata')
 @click.option('--template-dir', type=click.Path(exists=True, file_okay=False, dir_okay=True), help='Path to directory containing custom templates')
 @click.option('--static', type=StaticMount(), help='mountpoint:path-to-directory for serving static files', multiple=True)
-def serve(files, host, port, debug, reload, cors, page_size, max_returned_rows, sql_time_limit_ms, sqlite_extensions, inspect_file, metadata, template_dir, static):
+def serve(files, host, port, debug, reload, watch, cors, page_size, max_returned_rows, sql_time_limit_ms, facet_time_limit_ms, search_time_limit_ms, label_cache_mb, truncate_cells, lazy, max_open_databases, defer_counts, sqlite_extensions, inspect_file, metadata, template_dir, static):
     """Serve up specified SQLite database files with a web UI"""
+    # Imported here so the other commands don't pay for loading the web stack
+    from .app import Datasette
     if reload:
         import hupper
-        reloader = hupper.start_reloader('datasette.cli.serve')
-        if metadata:
-            reloader.watch_files([metadata.name])
+        hupper.start_reloader('datasette.cli.serve')
 
     inspect_data = None
     if inspect_file:
@@ -257,12 +359,22 @@ def serve(files, host, port, debug, reload, cors, page_size, max_returned_rows,
         page_size=page_size,
         max_returned_rows=max_returned_rows,
         sql_time_limit_ms=sql_time_limit_ms,
+        facet_time_limit_ms=facet_time_limit_ms,
+        search_time_limit_ms=search_time_limit_ms,
+        label_cache_size=label_cache_mb * 1024 * 1024,
+        truncate_cells=truncate_cells,
         inspect_data=inspect_data,
         metadata=metadata_data,
         sqlite_extensions=sqlite_extensions,
         template_dir=template_dir,
         static_mounts=static,
+        watch=watch or reload,
+        metadata_file=metadata and metadata.name,
+        lazy=lazy,
+        max_open_databases=max_open_databases,
+        defer_counts=defer_counts,
     )
-    # Force initial hashing/table counting
-    ds.inspect()
+    if not lazy:
+        # Force initial hashing/table counting
+        ds.inspect()
     ds.app().run(host=host, port=port, debug=debug)
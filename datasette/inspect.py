@@ -0,0 +1,191 @@
+"""
+Inspection of SQLite database files. This module deliberately avoids
+importing the web serving stack, so the inspect and skeleton commands
+start quickly.
+"""
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import sqlite3
+from .utils import (
+    get_all_foreign_keys,
+    get_all_fts_tables,
+    get_all_indexed_columns,
+    get_all_table_counts,
+    get_all_table_info,
+    get_column_stats,
+    get_facet_counts,
+    primary_keys_from_table_info,
+    rank_bm25,
+    regexp,
+)
+from .optimize import FK_COUNTS_TABLE
+from .trigrams import trigram_tables, trigrams_path
+
+HASH_BLOCK_SIZE = 1024 * 1024
+FACETS_TIME_LIMIT_MS = 200
+
+
+def prepare_connection(conn, sqlite_functions=None, sqlite_extensions=None):
+    conn.row_factory = sqlite3.Row
+    conn.text_factory = lambda x: str(x, 'utf-8', 'replace')
+    conn.create_function('rank_bm25', 1, rank_bm25)
+    conn.create_function('regexp', 2, regexp)
+    for name, num_args, func in (sqlite_functions or []):
+        conn.create_function(name, num_args, func)
+    if sqlite_extensions:
+        conn.enable_load_extension(True)
+        for extension in sqlite_extensions:
+            conn.execute("SELECT load_extension('{}')".format(extension))
+
+
+def inspect_databases(
+        files, sqlite_extensions=None, column_stats=False,
+        column_stats_time_limit_ms=1000, facets=None,
+        facets_time_limit_ms=FACETS_TIME_LIMIT_MS):
+    "Returns a dictionary of database name => inspect data for the files"
+    inspected = {}
+    for filename in files:
+        name, info = inspect_database(
+            filename,
+            sqlite_extensions=sqlite_extensions,
+            column_stats=column_stats,
+            column_stats_time_limit_ms=column_stats_time_limit_ms,
+            facets=facets,
+            facets_time_limit_ms=facets_time_limit_ms,
+        )
+        if name in inspected:
+            raise Exception('Multiple files with same stem %s' % name)
+        inspected[name] = info
+    return inspected
+
+
+def inspect_database(
+        filename, sqlite_functions=None, sqlite_extensions=None,
+        column_stats=False, column_stats_time_limit_ms=1000, facets=None,
+        facets_time_limit_ms=FACETS_TIME_LIMIT_MS):
+    """
+    Returns (name, inspect data) for a single database file: its content
+    hash, plus the columns, row count, label column, foreign keys and
+    (optionally) column statistics of every table.
+
+    facets can be True, to precompute facet counts for every low-cardinality
+    column, or a dictionary of table name => columns to consider.
+    """
+    path = Path(filename)
+    name = path.stem
+    hash = database_hash(path)
+    # List tables and their row counts
+    tables = {}
+    views = []
+    with sqlite3.connect('file:{}?immutable=1'.format(path), uri=True) as conn:
+        prepare_connection(conn, sqlite_functions, sqlite_extensions)
+        definitions = {'table': {}, 'view': OrderedDict()}
+        for r in conn.execute(
+            'select type, name, sql from sqlite_master where type in ("table", "view")'
+        ):
+            definitions[r['type']][r['name']] = r['sql']
+        views = list(definitions['view'])
+        fts_for_table = get_all_fts_tables(conn)
+        indexed_columns = get_all_indexed_columns(conn)
+        # Columns for every table come from one catalog query, rather than
+        # a PRAGMA per table
+        all_table_info = get_all_table_info(conn)
+        counts = get_all_table_counts(conn, list(all_table_info))
+        for table, table_info in all_table_info.items():
+            column_names = [row[1] for row in table_info]
+            count = counts[table]
+            label_column = None
+            # If table has two columns, one of which is ID, then label_column is the other one
+            if column_names and len(column_names) == 2 and 'id' in column_names:
+                label_column = [c for c in column_names if c != 'id'][0]
+            primary_keys = primary_keys_from_table_info(table_info)
+            table_indexed_columns = indexed_columns.get(table, set())
+            if len(primary_keys) == 1 and any(
+                row[1] == primary_keys[0] and row[2].upper() == 'INTEGER'
+                for row in table_info
+            ):
+                # An INTEGER PRIMARY KEY is the rowid, so is always indexed
+                table_indexed_columns.add(primary_keys[0])
+            tables[table] = {
+                'name': table,
+                'columns': column_names,
+                'column_types': OrderedDict((row[1], row[2]) for row in table_info),
+                'count': count,
+                'label_column': label_column,
+                'hidden': False,
+                'primary_keys': primary_keys,
+                'indexed_columns': sorted(table_indexed_columns),
+                'fts_table': fts_for_table.get(table),
+                'sql': definitions['table'].get(table),
+            }
+            if column_stats:
+                tables[table]['column_stats'] = get_column_stats(
+                    conn, table, column_names,
+                    column_stats_time_limit_ms,
+                )
+            facet_columns = column_names if facets is True else (facets or {}).get(table)
+            if facet_columns:
+                tables[table]['facets'] = get_facet_counts(
+                    conn, table,
+                    [c for c in facet_columns if c in column_names],
+                    facets_time_limit_ms,
+                )
+
+        foreign_keys = get_all_foreign_keys(conn)
+        for table, info in foreign_keys.items():
+            tables[table]['foreign_keys'] = info
+
+        # Mark tables 'hidden' if they relate to FTS virtual tables
+        fts_tables = {
+            r['name']
+            for r in conn.execute(
+                '''
+                    select name from sqlite_master
+                    where rootpage = 0
+                    and sql like '%VIRTUAL TABLE%USING FTS%'
+                '''
+            )
+        }
+        if fts_tables:
+            # Check every prefix of each table name against the set of
+            # FTS table names - this matches t.startswith(fts_table)
+            # without comparing every table against every FTS table
+            longest = max(len(fts_table) for fts_table in fts_tables)
+            for t in tables:
+                if any(
+                    t[:i] in fts_tables
+                    for i in range(1, min(len(t), longest) + 1)
+                ):
+                    tables[t]['hidden'] = True
+
+    info = {
+        'hash': hash,
+        'file': str(path),
+        'tables': tables,
+        'views': views,
+        'view_definitions': definitions['view'],
+    }
+    if FK_COUNTS_TABLE in tables:
+        # Written by datasette optimize --fk-counts
+        tables[FK_COUNTS_TABLE]['hidden'] = True
+        info['fk_counts_table'] = FK_COUNTS_TABLE
+    trigram_columns = trigram_tables(path, hash)
+    if trigram_columns:
+        info['trigrams_file'] = str(trigrams_path(path))
+        for table, columns in trigram_columns.items():
+            if table in tables:
+                tables[table]['trigram_columns'] = columns
+    return name, info
+
+
+def database_hash(filename):
+    "Returns the SHA-256 hex digest of a database file, reading it in blocks"
+    m = hashlib.sha256()
+    with Path(filename).open('rb') as fp:
+        while True:
+            data = fp.read(HASH_BLOCK_SIZE)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
@@ -0,0 +1,199 @@
+"""
+Tuning of database files for the queries datasette serve runs: indexes on
+the columns table pages join, sort and filter on, query planner statistics
+and a defragmented file. Like the inspect module, this avoids importing
+the web serving stack.
+"""
+from collections import OrderedDict
+import sqlite3
+import time
+from .utils import (
+    escape_sqlite_table_name,
+    get_all_foreign_keys,
+    get_all_indexed_columns,
+    get_all_table_info,
+    primary_keys_from_table_info,
+)
+
+DEFAULT_PAGE_SIZE = 4096
+TIMING_RUNS = 3
+FK_COUNTS_TABLE = '_datasette_fk_counts'
+
+
+def optimize_tables(conn):
+    """
+    Returns the names of the ordinary tables, leaving out virtual tables and
+    the table of foreign key counts
+    """
+    return [
+        r[0] for r in conn.execute(
+            "select name from sqlite_master where type = 'table' "
+            "and name not like 'sqlite_%' and sql not like 'CREATE VIRTUAL TABLE%' "
+            'and name != ? order by name',
+            [FK_COUNTS_TABLE]
+        )
+    ]
+
+
+def columns_to_index(conn, table_metadata=None):
+    """
+    Returns (table, column) pairs for the columns that table pages look up
+    by but that don't lead an index: both sides of every foreign key, plus
+    the sortable_columns and facets of each table's metadata
+    """
+    table_metadata = table_metadata or {}
+    tables = optimize_tables(conn)
+    table_columns = {
+        table: [row[1] for row in info]
+        for table, info in get_all_table_info(conn).items()
+    }
+    indexed_columns = get_all_indexed_columns(conn)
+    wanted = OrderedDict()
+    foreign_keys = get_all_foreign_keys(conn)
+    for table in tables:
+        for fk in foreign_keys.get(table, {}).get('outgoing', []):
+            wanted[(table, fk['column'])] = True
+            wanted[(fk['other_table'], fk['other_column'])] = True
+        metadata = table_metadata.get(table) or {}
+        for column in (metadata.get('sortable_columns') or []) + (metadata.get('facets') or []):
+            wanted[(table, column)] = True
+    return [
+        (table, column) for table, column in wanted
+        if table in tables
+        and column in table_columns.get(table, [])
+        and column not in indexed_columns.get(table, set())
+        and not is_rowid_alias(conn, table, column)
+    ]
+
+
+def is_rowid_alias(conn, table, column):
+    "An INTEGER PRIMARY KEY is the rowid, so it never needs an index"
+    info = conn.execute(
+        'PRAGMA table_info({})'.format(escape_sqlite_table_name(table))
+    ).fetchall()
+    pks = primary_keys_from_table_info(info)
+    return pks == [column] and any(
+        row[1] == column and row[2].upper() == 'INTEGER' for row in info
+    )
+
+
+def table_page_queries(conn, table_metadata=None):
+    """
+    Returns a list of (table, description, sql) for the queries a first
+    visit to each table page runs: the count, the first page, the first page
+    sorted by each sortable column and each facet of its metadata.
+    """
+    table_metadata = table_metadata or {}
+    queries = []
+    for table in optimize_tables(conn):
+        info = conn.execute(
+            'PRAGMA table_info({})'.format(escape_sqlite_table_name(table))
+        ).fetchall()
+        pks = primary_keys_from_table_info(info) or ['rowid']
+        order_by = ', '.join('"{}"'.format(pk) for pk in pks)
+        table_name = escape_sqlite_table_name(table)
+        metadata = table_metadata.get(table) or {}
+        queries.append((table, 'count', 'select count(*) from {}'.format(table_name)))
+        queries.append((table, 'first page', 'select * from {} order by {} limit 101'.format(
+            table_name, order_by
+        )))
+        for column in metadata.get('sortable_columns') or []:
+            queries.append((table, 'sort by {}'.format(column), (
+                'select * from {} order by "{}", {} limit 101'
+            ).format(table_name, column, order_by)))
+        for column in metadata.get('facets') or []:
+            queries.append((table, 'facet by {}'.format(column), (
+                'select "{c}", count(*) from {t} group by "{c}" order by count(*) desc limit 31'
+            ).format(t=table_name, c=column)))
+    return queries
+
+
+def time_queries(filename, queries):
+    "Returns the best of TIMING_RUNS times, in ms, for each of the queries"
+    conn = sqlite3.connect(str(filename))
+    timings = []
+    try:
+        for table, description, sql in queries:
+            best = None
+            for _ in range(TIMING_RUNS):
+                start = time.perf_counter()
+                conn.execute(sql).fetchall()
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+    finally:
+        conn.close()
+    return timings
+
+
+def write_fk_counts(conn):
+    """
+    Replaces the FK_COUNTS_TABLE table with the number of rows referencing
+    each value of each column that has incoming foreign keys, so row pages
+    can look up all of their counts at once. Values are stored as text, the
+    form they take in row URLs, and values with no references are left out.
+    Returns the number of counts written.
+    """
+    conn.execute('drop table if exists [{}]'.format(FK_COUNTS_TABLE))
+    conn.execute(
+        'create table [{}] (table_name text, value text, other_table text, '
+        'other_column text, count integer, '
+        'primary key (table_name, value, other_table, other_column)) without rowid'.format(
+            FK_COUNTS_TABLE
+        )
+    )
+    foreign_keys = get_all_foreign_keys(conn)
+    for table in optimize_tables(conn):
+        for fk in foreign_keys.get(table, {}).get('incoming', []):
+            conn.execute(
+                'insert into [{counts}] select :table, cast("{column}" as text), '
+                ':other_table, :other_column, count(*) from {other_table} '
+                'where "{column}" is not null group by cast("{column}" as text)'.format(
+                    counts=FK_COUNTS_TABLE,
+                    column=fk['other_column'],
+                    other_table=escape_sqlite_table_name(fk['other_table']),
+                ),
+                {
+                    'table': table,
+                    'other_table': fk['other_table'],
+                    'other_column': fk['other_column'],
+                }
+            )
+    return conn.execute(
+        'select count(*) from [{}]'.format(FK_COUNTS_TABLE)
+    ).fetchone()[0]
+
+
+def optimize_database(
+        filename, table_metadata=None, page_size=DEFAULT_PAGE_SIZE,
+        vacuum=True, fk_counts=False):
+    """
+    Creates the missing indexes from columns_to_index(), optionally writes
+    the foreign key counts table, runs ANALYZE so the query planner has
+    sqlite_stat1, then sets the page size and runs VACUUM to rewrite the
+    file in order. Returns (names of the created indexes, number of foreign
+    key counts written or None).
+    """
+    conn = sqlite3.connect(str(filename))
+    created = []
+    counts_written = None
+    try:
+        with conn:
+            for table, column in columns_to_index(conn, table_metadata):
+                index_name = 'idx_{}_{}'.format(table, column)
+                conn.execute('create index if not exists "{}" on {} ("{}")'.format(
+                    index_name.replace('"', '""'),
+                    escape_sqlite_table_name(table),
+                    column,
+                ))
+                created.append(index_name)
+            if fk_counts:
+                counts_written = write_fk_counts(conn)
+        conn.execute('ANALYZE')
+        conn.commit()
+        if vacuum:
+            conn.execute('PRAGMA page_size = {}'.format(int(page_size)))
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+    return created, counts_written
@@ -0,0 +1,115 @@
+"""
+Trigram indexes for the contains and endswith filters. The indexes live in
+a sidecar file next to the database - FTS5 tables using the trigram
+tokenizer, one per indexed column, keyed on the rowid of the indexed table.
+"""
+from pathlib import Path
+import sqlite3
+from .utils import escape_sqlite_table_name
+
+TRIGRAMS_SUFFIX = '.trigrams'
+
+
+def trigrams_path(filename):
+    "Returns the path of the trigram sidecar file for a database"
+    return Path(str(filename) + TRIGRAMS_SUFFIX)
+
+
+def build_trigram_index(filename, database_hash, table, columns):
+    """
+    Creates or replaces the trigram indexes for the columns of a table in the
+    sidecar file. If the database has changed since the sidecar was built,
+    the indexes it already has are rebuilt as well.
+    """
+    path = trigrams_path(filename)
+    conn = sqlite3.connect('file:{}'.format(path), uri=True)
+    conn.execute(
+        'ATTACH DATABASE ? AS source',
+        ['file:{}?mode=ro'.format(Path(filename).resolve())],
+    )
+    with conn:
+        conn.execute(
+            'create table if not exists _trigram_meta (key text primary key, value text)'
+        )
+        conn.execute(
+            'create table if not exists _trigram_columns ('
+            'table_name text, column_name text, fts_table text, '
+            'primary key (table_name, column_name))'
+        )
+        rows = conn.execute(
+            "select value from _trigram_meta where key = 'hash'"
+        ).fetchall()
+        to_build = [(table, column) for column in columns]
+        if rows and rows[0][0] != database_hash:
+            to_build = [
+                (t, c) for t, c in conn.execute(
+                    'select table_name, column_name from _trigram_columns'
+                ) if (t, c) not in to_build
+            ] + to_build
+        for table_name, column in to_build:
+            existing = conn.execute(
+                'select fts_table from _trigram_columns '
+                'where table_name = ? and column_name = ?',
+                [table_name, column]
+            ).fetchall()
+            if existing:
+                fts_table = existing[0][0]
+                conn.execute('drop table if exists [{}]'.format(fts_table))
+            else:
+                fts_table = 'trigrams_{}'.format(conn.execute(
+                    'select count(*) from _trigram_columns'
+                ).fetchone()[0])
+                conn.execute(
+                    'insert into _trigram_columns values (?, ?, ?)',
+                    [table_name, column, fts_table]
+                )
+            # Matches are checked against the original column, so the index
+            # only needs to record which rows contain each trigram
+            conn.execute(
+                "create virtual table [{}] using fts5(value, tokenize='trigram', detail='none')".format(
+                    fts_table
+                )
+            )
+            conn.execute(
+                'insert into [{fts_table}] (rowid, value) '
+                'select rowid, "{column}" from source.{table} where "{column}" is not null'.format(
+                    fts_table=fts_table,
+                    column=column,
+                    table=escape_sqlite_table_name(table_name),
+                )
+            )
+        conn.execute(
+            "insert or replace into _trigram_meta values ('hash', ?)",
+            [database_hash]
+        )
+    conn.execute('VACUUM')
+    conn.close()
+    return path
+
+
+def trigram_tables(filename, database_hash):
+    """
+    Returns table name => {column name: FTS table} for the sidecar of a
+    database, or an empty dictionary if it has no sidecar or the sidecar was
+    built from a different version of the database.
+    """
+    path = trigrams_path(filename)
+    if not path.exists():
+        return {}
+    conn = sqlite3.connect('file:{}?immutable=1'.format(path), uri=True)
+    try:
+        rows = conn.execute(
+            "select value from _trigram_meta where key = 'hash'"
+        ).fetchall()
+        if not rows or rows[0][0] != database_hash:
+            return {}
+        tables = {}
+        for table, column, fts_table in conn.execute(
+            'select table_name, column_name, fts_table from _trigram_columns'
+        ):
+            tables.setdefault(table, {})[column] = fts_table
+        return tables
+    except sqlite3.DatabaseError:
+        return {}
+    finally:
+        conn.close()
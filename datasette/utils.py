@@ -1,11 +1,19 @@
 from contextlib import contextmanager
+from collections import OrderedDict
 import base64
+import functools
 import hashlib
 import json
+import math
 import os
 import re
 import shlex
 import sqlite3
+import sre_constants
+import sre_parse
+import string
+import struct
+import sys
 import tempfile
 import time
 import shutil
@@ -29,10 +37,105 @@ def path_from_row_pks(row, pks, use_rowid):
     return ','.join(bits)
 
 
+class TruncatedCell:
+    """
+    A text or blob value that was cut down to its first characters (or
+    bytes) in SQL. length is the length of the full value, which can be
+    fetched from url.
+    """
+    def __init__(self, value, length, url=None):
+        self.value = value
+        self.length = length
+        self.url = url
+
+    def __repr__(self):
+        return 'TruncatedCell({!r}, {!r}, {!r})'.format(self.value, self.length, self.url)
+
+
+class CellRow(tuple):
+    "A row of values that can also be indexed by column name, like sqlite3.Row"
+    def __new__(cls, columns, values):
+        row = super().__new__(cls, values)
+        row._columns = columns
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._columns.index(key)
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self._columns)
+
+
+class LabelCache:
+    """
+    Least recently used cache of foreign key labels. Labels are grouped
+    under a key - the database hash, table, id column and label column -
+    and the oldest are evicted once their estimated size passes max_bytes.
+    Ids that have no row in the table are cached too.
+    """
+    # Rough size of the dictionary entry and key tuple for each label
+    ENTRY_OVERHEAD = 150
+    _not_found = object()
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._labels = OrderedDict()
+
+    def __len__(self):
+        return len(self._labels)
+
+    def get_many(self, key, ids):
+        """
+        Returns (labels, missing): a dictionary of id => label for the ids
+        found in the cache, and the ids that still need to be looked up
+        """
+        labels = {}
+        missing = []
+        for id in ids:
+            if (key, id) not in self._labels:
+                missing.append(id)
+                continue
+            self._labels.move_to_end((key, id))
+            label = self._labels[(key, id)]
+            if label is not self._not_found:
+                labels[id] = label
+        return labels, missing
+
+    def set_many(self, key, ids, labels):
+        "Stores the labels for ids, recording the ids missing from labels"
+        if not self.max_bytes:
+            return
+        for id in ids:
+            label = labels.get(id, self._not_found)
+            if (key, id) in self._labels:
+                continue
+            self._labels[(key, id)] = label
+            self.size += self.entry_size(id, label)
+        while self.size > self.max_bytes and self._labels:
+            (_, id), label = self._labels.popitem(last=False)
+            self.size -= self.entry_size(id, label)
+
+    def entry_size(self, id, label):
+        size = self.ENTRY_OVERHEAD + sys.getsizeof(id)
+        if label is not self._not_found:
+            size += sys.getsizeof(label)
+        return size
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, sqlite3.Row):
             return tuple(obj)
+        if isinstance(obj, TruncatedCell):
+            return {
+                '$truncated': True,
+                'value': obj.value,
+                'length': obj.length,
+                'url': obj.url,
+            }
         if isinstance(obj, sqlite3.Cursor):
             return list(obj)
         if isinstance(obj, bytes):
@@ -63,14 +166,20 @@ def sqlite_timelimit(conn, ms):
             return 1
 
     conn.set_progress_handler(handler, n)
-    yield
-    conn.set_progress_handler(None, n)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, n)
 
 
 class InvalidSql(Exception):
     pass
 
 
+class DatasetteError(Exception):
+    pass
+
+
 allowed_sql_res = [
     re.compile(r'^select\b'),
     re.compile(r'^with\b'),
@@ -89,13 +198,123 @@ def validate_sql_select(sql):
             raise InvalidSql(msg)
 
 
+def keyset_where_clause(columns, param_names, operator='>', values=None):
+    """
+    Returns a where clause matching rows that sort after the given values
+    when ordered by columns, e.g. ("pk1", "pk2") > (:p0, :p1). Use '<' for
+    rows that come after them in descending order.
+
+    SQLite can satisfy this with a single seek on an index over the columns.
+    Versions of SQLite without row values (before 3.15) get the equivalent
+    expanded form instead. So do values with a NULL in them, which row values
+    can't compare - NULLs sort first in ascending order and last in
+    descending order.
+    """
+    columns = ['"{}"'.format(column) for column in columns]
+    params = [':{}'.format(param_name) for param_name in param_names]
+    if values is not None and None in values:
+        clauses = []
+        for i, (column, param, value) in enumerate(zip(columns, params, values)):
+            if value is None:
+                if operator == '<':
+                    # Nothing sorts after NULL in descending order
+                    continue
+                after = '{} is not null'.format(column)
+            elif operator == '<':
+                after = '({} < {} or {} is null)'.format(column, param, column)
+            else:
+                after = '{} > {}'.format(column, param)
+            clauses.append('({})'.format(' and '.join(
+                ['{} is {}'.format(c, p) for c, p in zip(columns[:i], params[:i])]
+                + [after]
+            )))
+        return '({})'.format(' or '.join(clauses) or '0')
+    if len(columns) == 1:
+        return '{} {} {}'.format(columns[0], operator, params[0])
+    if sqlite3.sqlite_version_info >= (3, 15, 0):
+        return '({}) {} ({})'.format(', '.join(columns), operator, ', '.join(params))
+    clauses = []
+    for i, (column, param) in enumerate(zip(columns, params)):
+        clauses.append('({})'.format(' and '.join(
+            ['{} = {}'.format(c, p) for c, p in zip(columns[:i], params[:i])]
+            + ['{} {} {}'.format(column, operator, param)]
+        )))
+    return '({})'.format(' or '.join(clauses))
+
+
+# Stands in for a NULL value in _next tokens - real values are URL-encoded,
+# so can never be this literal string or start with a $
+NULL_SORT_VALUE = '$null'
+
+
+def path_from_key_value(value, affinity=None):
+    """
+    Encodes one value of a _next token. SQLite converts string parameters
+    compared with columns that have a numeric affinity, so most values are
+    written as plain strings - but columns with no affinity (no declared
+    type, or expressions in views) compare a string greater than any number,
+    so their numbers record their type as $int:5 or $float:2.5. Blobs are
+    always written as $blob: followed by their hex.
+    """
+    if value is None:
+        return NULL_SORT_VALUE
+    if isinstance(value, bytes):
+        return '$blob:{}'.format(value.hex())
+    if affinity in (None, 'BLOB'):
+        if isinstance(value, int):
+            return '$int:{}'.format(value)
+        if isinstance(value, float):
+            return '$float:{!r}'.format(value)
+    return urllib.parse.quote_plus(str(value))
+
+
+def key_value_from_path(bit, affinity=None):
+    "Decodes a value written by path_from_key_value()"
+    if bit == NULL_SORT_VALUE:
+        return None
+    if bit.startswith('$'):
+        type_name, _, encoded = bit[1:].partition(':')
+        converters = {'int': int, 'float': float, 'blob': bytes.fromhex}
+        try:
+            return converters[type_name](encoded)
+        except (KeyError, ValueError):
+            raise DatasetteError('Invalid _next value: {}'.format(bit))
+    value = urllib.parse.unquote_plus(bit)
+    if affinity in ('INTEGER', 'REAL', 'NUMERIC'):
+        return value_with_affinity(value, affinity)
+    return value
+
+
+def path_from_key_values(values, affinities):
+    "Returns a _next token for the values of the columns a page is ordered by"
+    return ','.join(
+        path_from_key_value(value, affinity)
+        for value, affinity in zip(values, affinities)
+    )
+
+
+def key_values_from_path(path, affinities):
+    """
+    Decodes a _next token written by path_from_key_values(), or returns None
+    if it doesn't have a value for each of the affinities
+    """
+    bits = path.split(',')
+    if len(bits) != len(affinities):
+        return None
+    return [
+        key_value_from_path(bit, affinity)
+        for bit, affinity in zip(bits, affinities)
+    ]
+
+
 def path_with_added_args(request, args):
     if isinstance(args, dict):
         args = args.items()
     arg_keys = set(a[0] for a in args)
+    # Repeated arguments such as ?_facet=a&_facet=b are all kept
     current = [
         (key, value)
-        for key, value in request.raw_args.items()
+        for key, value in urllib.parse.parse_qsl(request.query_string)
         if key not in arg_keys
     ]
     current.extend([
@@ -290,6 +509,138 @@ def temporary_heroku_directory(files, name, metadata, extra_options, branch, tem
         os.chdir(saved_cwd)
 
 
+def get_all_table_info(conn):
+    """
+    Returns a dictionary of table name => list of PRAGMA table_info() rows
+    (cid, name, type, notnull, dflt_value, pk) for every table in the
+    database, fetched using a single catalog query.
+
+    Falls back to one PRAGMA table_info() call per table on versions of
+    SQLite that do not support table-valued pragma functions.
+    """
+    table_info = OrderedDict(
+        (r[0], [])
+        for r in conn.execute('select name from sqlite_master where type="table"')
+    )
+    try:
+        rows = conn.execute(
+            'select m.name, p.* from sqlite_master m, pragma_table_info(m.name) p '
+            "where m.type = 'table'"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = [
+            (table,) + tuple(r)
+            for table in table_info
+            for r in conn.execute(
+                'PRAGMA table_info({})'.format(escape_sqlite_table_name(table))
+            ).fetchall()
+        ]
+    for row in rows:
+        table_info[row[0]].append(tuple(row[1:]))
+    return table_info
+
+
+# Schemas with more tables than this are counted using dbstat
+DBSTAT_MIN_TABLES = 1000
+# Tables counted by each query when counting them one by one
+COUNT_CHUNK_SIZE = 500
+_without_rowid_re = re.compile(r'\bwithout\s+rowid\b', re.IGNORECASE)
+
+
+def has_rowid(table_sql):
+    "Whether the table created by table_sql has a rowid - WITHOUT ROWID tables don't"
+    return not _without_rowid_re.search(table_sql or '')
+
+
+def get_all_table_counts(conn, tables):
+    """
+    Returns a dictionary of table name => row count for the tables.
+
+    SQLite finds a table by name in time that grows with the number of
+    tables, so counting tens of thousands of tables one at a time takes
+    minutes. For schemas that big, tables that SQLite's dbstat virtual table
+    can see are counted from the cells of their leaf pages in one pass.
+    Virtual tables and WITHOUT ROWID tables - whose interior pages hold rows
+    too - are counted with count(*), COUNT_CHUNK_SIZE tables per query.
+    """
+    counts = {}
+    if len(tables) > DBSTAT_MIN_TABLES:
+        try:
+            leaf_cells = dict(conn.execute(
+                "select name, sum(ncell) from dbstat where pagetype = 'leaf' group by name"
+            ).fetchall())
+        except sqlite3.OperationalError:
+            # SQLite was compiled without dbstat
+            leaf_cells = {}
+        definitions = dict(conn.execute(
+            "select name, sql from sqlite_master where type = 'table'"
+        ).fetchall())
+        for table in tables:
+            if table in leaf_cells and has_rowid(definitions.get(table)):
+                counts[table] = leaf_cells[table]
+    remaining = [table for table in tables if table not in counts]
+    for i in range(0, len(remaining), COUNT_CHUNK_SIZE):
+        chunk = remaining[i:i + COUNT_CHUNK_SIZE]
+        row = conn.execute('select {}'.format(', '.join(
+            '(select count(*) from {})'.format(escape_sqlite_table_name(table))
+            for table in chunk
+        ))).fetchone()
+        counts.update(zip(chunk, row))
+    return counts
+
+
+def primary_keys_from_table_info(table_info):
+    "Primary key column names, in primary key order, from PRAGMA table_info() rows"
+    return [
+        str(row[1])
+        for row in sorted((row for row in table_info if row[-1]), key=lambda row: row[-1])
+    ]
+
+
+def _index_leading_columns(conn, tables):
+    "(table, column) pairs for the first column of every index on the tables"
+    rows = []
+    for table in tables:
+        for index in conn.execute(
+            'PRAGMA index_list({})'.format(escape_sqlite_table_name(table))
+        ).fetchall():
+            for info in conn.execute(
+                'PRAGMA index_info({})'.format(escape_sqlite_table_name(index[1]))
+            ).fetchall():
+                if info[0] == 0:
+                    rows.append((table, info[2]))
+    return rows
+
+
+def get_all_indexed_columns(conn):
+    """
+    Returns a dictionary of table name => set of the columns that lead at
+    least one index on that table, fetched using a single catalog query.
+    """
+    definitions = dict(conn.execute(
+        "select name, sql from sqlite_master where type = 'table'"
+    ).fetchall())
+    indexed_columns = {table: set() for table in definitions}
+    try:
+        # Every index, including the automatic ones, is in sqlite_master, so
+        # tables without indexes never need to be looked up
+        rows = conn.execute(
+            'select m.tbl_name, ii.name from sqlite_master m, pragma_index_info(m.name) ii '
+            "where m.type = 'index' and ii.seqno = 0"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        rows = _index_leading_columns(conn, definitions)
+    # The primary key of a WITHOUT ROWID table is the table's own b-tree, so
+    # it has no index in sqlite_master
+    rows += _index_leading_columns(conn, [
+        table for table, sql in definitions.items() if not has_rowid(sql)
+    ])
+    for table, column in rows:
+        if column is not None:
+            indexed_columns[table].add(column)
+    return indexed_columns
+
+
 def get_all_foreign_keys(conn):
     tables = [r[0] for r in conn.execute('select name from sqlite_master where type="table"')]
     table_to_foreign_keys = {}
@@ -298,31 +649,164 @@ def get_all_foreign_keys(conn):
             'incoming': [],
             'outgoing': [],
         }
-    for table in tables:
+    try:
+        # A foreign key can't be declared without REFERENCES, so the other
+        # tables are skipped
         infos = conn.execute(
-            'PRAGMA foreign_key_list([{}])'.format(table)
+            'select m.name, p.* from sqlite_master m, pragma_foreign_key_list(m.name) p '
+            "where m.type = 'table' and m.sql like '%references%'"
         ).fetchall()
-        for info in infos:
-            if info is not None:
-                id, seq, table_name, from_, to_, on_update, on_delete, match = info
-                if table_name not in table_to_foreign_keys:
-                    # Weird edge case where something refers to a table that does
-                    # not actually exist
-                    continue
-                table_to_foreign_keys[table_name]['incoming'].append({
-                    'other_table': table,
-                    'column': to_,
-                    'other_column': from_
-                })
-                table_to_foreign_keys[table]['outgoing'].append({
-                    'other_table': table_name,
-                    'column': from_,
-                    'other_column': to_
-                })
+    except sqlite3.OperationalError:
+        infos = [
+            (table,) + tuple(info)
+            for table in tables
+            for info in conn.execute(
+                'PRAGMA foreign_key_list([{}])'.format(table)
+            ).fetchall()
+        ]
+    for info in infos:
+        table, id, seq, table_name, from_, to_, on_update, on_delete, match = info
+        if table_name not in table_to_foreign_keys:
+            # Weird edge case where something refers to a table that does
+            # not actually exist
+            continue
+        table_to_foreign_keys[table_name]['incoming'].append({
+            'other_table': table,
+            'column': to_,
+            'other_column': from_
+        })
+        table_to_foreign_keys[table]['outgoing'].append({
+            'other_table': table_name,
+            'column': from_,
+            'other_column': to_
+        })
 
     return table_to_foreign_keys
 
 
+STATS_SAMPLE_SIZE = 100000
+
+
+def get_column_stats(conn, table, columns, time_limit_ms, top_k=10):
+    """
+    Returns a dictionary of column name => statistics for the specified table.
+
+    Every column gets a null count, a distinct count, min and max values and
+    the top_k most common values with their counts. Distinct counts are taken
+    from the first STATS_SAMPLE_SIZE rows, so they are approximate for larger
+    tables. All of the queries share a single time budget - any statistic that
+    could not be calculated in time is returned as None.
+    """
+    deadline = time.time() + (time_limit_ms / 1000)
+    table_name = escape_sqlite_table_name(table)
+    stats = {
+        column: {
+            'nulls': None,
+            'distinct': None,
+            'min': None,
+            'max': None,
+            'top': None,
+        }
+        for column in columns
+    }
+    if not columns:
+        return stats
+
+    def run(sql):
+        remaining_ms = (deadline - time.time()) * 1000
+        if remaining_ms <= 0:
+            return None
+        with sqlite_timelimit(conn, remaining_ms):
+            try:
+                return conn.execute(sql).fetchall()
+            except sqlite3.OperationalError:
+                # Probably hit the time limit
+                return None
+
+    # Nulls, min and max for every column can be calculated in a single scan
+    rows = run('select count(*), {} from {}'.format(
+        ', '.join(
+            'count("{c}"), min("{c}"), max("{c}")'.format(c=column)
+            for column in columns
+        ),
+        table_name,
+    ))
+    non_null_counts = {}
+    if rows:
+        row = list(rows[0])
+        count = row.pop(0)
+        for i, column in enumerate(columns):
+            non_null, min_value, max_value = row[i * 3:(i + 1) * 3]
+            non_null_counts[column] = non_null
+            stats[column].update({
+                'nulls': count - non_null,
+                'min': min_value,
+                'max': max_value,
+            })
+
+    rows = run('select {} from (select {} from {} limit {})'.format(
+        ', '.join('count(distinct "{}")'.format(column) for column in columns),
+        ', '.join('"{}"'.format(column) for column in columns),
+        table_name,
+        STATS_SAMPLE_SIZE,
+    ))
+    if rows:
+        for column, distinct in zip(columns, rows[0]):
+            stats[column]['distinct'] = distinct
+
+    for column in columns:
+        distinct = stats[column]['distinct']
+        if distinct is not None and distinct == non_null_counts.get(column):
+            # Every value is unique, so there are no common values to report
+            stats[column]['top'] = []
+            continue
+        rows = run(
+            'select "{column}", count(*) from {table_name} '
+            'group by "{column}" order by count(*) desc, "{column}" limit {top_k}'.format(
+                column=column,
+                table_name=table_name,
+                top_k=top_k,
+            )
+        )
+        if rows is not None:
+            stats[column]['top'] = [list(row) for row in rows]
+    return stats
+
+
+FACET_SIZE = 30
+
+
+def get_facet_counts(conn, table, columns, time_limit_ms, max_values=FACET_SIZE):
+    """
+    Returns a dictionary of column name => [[value, count], ...], most common
+    value first, for each of the columns that has at most max_values distinct
+    values. Columns with more distinct values than that, or that could not be
+    counted within the shared time budget, are left out.
+    """
+    deadline = time.time() + (time_limit_ms / 1000)
+    facets = {}
+    for column in columns:
+        remaining_ms = (deadline - time.time()) * 1000
+        if remaining_ms <= 0:
+            break
+        with sqlite_timelimit(conn, remaining_ms):
+            try:
+                rows = conn.execute(
+                    'select "{column}", count(*) from {table_name} '
+                    'group by "{column}" order by count(*) desc, "{column}" limit {limit}'.format(
+                        column=column,
+                        table_name=escape_sqlite_table_name(table),
+                        limit=max_values + 1,
+                    )
+                ).fetchall()
+            except sqlite3.OperationalError:
+                # Probably hit the time limit
+                continue
+        if len(rows) <= max_values:
+            facets[column] = [list(row) for row in rows]
+    return facets
+
+
 def detect_fts(conn, table, return_sql=False):
     "Detect if table has a corresponding FTS virtual table and return it"
     rows = conn.execute(detect_fts_sql(table)).fetchall()
@@ -332,6 +816,186 @@ def detect_fts(conn, table, return_sql=False):
         return rows[0][0]
 
 
+def get_all_fts_tables(conn):
+    """
+    Returns a dictionary of table name => the FTS virtual table that indexes
+    it, for every table detected by detect_fts_sql(), using one query.
+    """
+    fts_tables = {}
+    for name, tbl_name, sql in conn.execute(
+        """
+            select name, tbl_name, sql from sqlite_master
+            where rootpage = 0
+            and sql like '%VIRTUAL TABLE%USING FTS%'
+        """
+    ).fetchall():
+        fts_tables.setdefault(tbl_name, name)
+        for content in re.findall(r'content="(.*?)"', sql, re.IGNORECASE):
+            fts_tables.setdefault(content, name)
+    return fts_tables
+
+
+def rank_bm25(matchinfo):
+    """
+    SQLite function returning the BM25 score of an FTS4 match, negated so
+    that better matches sort first - the same ordering as the FTS5 rank
+    column. Expects the output of matchinfo(fts_table, 'pcnalx').
+    """
+    k1 = 1.2
+    b = 0.75
+    values = struct.unpack('@{}I'.format(len(matchinfo) // 4), matchinfo)
+    phrase_count, column_count, row_count = values[:3]
+    average_lengths = values[3:3 + column_count]
+    lengths = values[3 + column_count:3 + column_count * 2]
+    hits = values[3 + column_count * 2:]
+    score = 0.0
+    for phrase in range(phrase_count):
+        for column in range(column_count):
+            offset = 3 * (phrase * column_count + column)
+            hits_this_row = hits[offset]
+            docs_with_hits = hits[offset + 2]
+            if not hits_this_row:
+                continue
+            idf = math.log(
+                (row_count - docs_with_hits + 0.5) / (docs_with_hits + 0.5)
+            )
+            idf = max(idf, 1e-6)
+            length_ratio = lengths[column] / (average_lengths[column] or 1)
+            score += idf * (hits_this_row * (k1 + 1)) / (
+                hits_this_row + k1 * (1 - b + b * length_ratio)
+            )
+    return -score
+
+
+REGEXP_CACHE_SIZE = 256
+# Repeats allowing more than this many matches count as unbounded
+REGEXP_MAX_BOUNDED_REPEAT = 100
+# Values are only searched up to this many characters
+REGEXP_MAX_VALUE_LENGTH = 10000
+_repeat_ops = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+def _regexp_leading_chars(alternative):
+    """
+    Returns a list of sets of the characters, lowercased, that each of the
+    leading single character items of a BRANCH alternative can match. The
+    list stops at the first item that could match anything else.
+    """
+    leading = []
+    for op, av in alternative:
+        if op == sre_constants.LITERAL:
+            leading.append({chr(av).lower()})
+        elif op == sre_constants.IN and all(
+            item_op == sre_constants.LITERAL
+            or (item_op == sre_constants.RANGE and item_av[1] - item_av[0] <= 256)
+            for item_op, item_av in av
+        ):
+            chars = set()
+            for item_op, item_av in av:
+                if item_op == sre_constants.LITERAL:
+                    chars.add(chr(item_av).lower())
+                else:
+                    chars.update(
+                        chr(c).lower() for c in range(item_av[0], item_av[1] + 1)
+                    )
+            leading.append(chars)
+        else:
+            break
+    return leading
+
+
+def _regexp_overlapping_branch(alternatives):
+    """
+    Returns True if two of the alternatives could match the same text: unless
+    some leading character of one can't match the same leading character of
+    the other, they are assumed to overlap.
+    """
+    leading = [_regexp_leading_chars(alternative) for alternative in alternatives]
+    for i, first in enumerate(leading):
+        for second in leading[i + 1:]:
+            if not any(not (a & b) for a, b in zip(first, second)):
+                return True
+    return False
+
+
+def _regexp_slow_reason(parsed, inside_repeat=False):
+    """
+    Returns why parsed could take exponential time to fail to match, or None.
+    Inside a repeat that can match more than once, it rejects unbounded
+    repeats - like (a+)+ or (.*a){12} - and alternatives that can match the
+    same text - like (a|a)* - since each gives the engine another way to
+    split the same text to try.
+    """
+    for op, av in parsed:
+        if op in _repeat_ops:
+            low, high, item = av
+            unbounded = high is sre_constants.MAXREPEAT or high > REGEXP_MAX_BOUNDED_REPEAT
+            if unbounded and inside_repeat:
+                return 'has a repeat inside a repeat'
+            reason = _regexp_slow_reason(item, inside_repeat or high > 1)
+            if reason:
+                return reason
+        elif op == sre_constants.SUBPATTERN:
+            reason = _regexp_slow_reason(av[-1], inside_repeat)
+            if reason:
+                return reason
+        elif op == sre_constants.BRANCH:
+            if inside_repeat and _regexp_overlapping_branch(av[1]):
+                return 'has a repeat of alternatives that can match the same text'
+            for branch in av[1]:
+                reason = _regexp_slow_reason(branch, inside_repeat)
+                if reason:
+                    return reason
+    return None
+
+
+@functools.lru_cache(maxsize=REGEXP_CACHE_SIZE)
+def compile_regexp(pattern):
+    """
+    Compiles a pattern for the regexp() SQL function, raising DatasetteError
+    if it is invalid or _regexp_slow_reason() finds it could take exponential
+    time to fail to match. Compiled patterns are cached.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except sre_constants.error as e:
+        raise DatasetteError('Invalid regular expression: {}'.format(e))
+    reason = _regexp_slow_reason(parsed)
+    if reason:
+        raise DatasetteError(
+            'Regular expression {}, which can be very slow: {}'.format(reason, pattern)
+        )
+    return re.compile(pattern)
+
+
+def regexp(pattern, value):
+    """
+    SQLite function for X REGEXP Y, which SQLite calls as regexp(Y, X).
+    Returns 1 if the pattern matches anywhere in the first
+    REGEXP_MAX_VALUE_LENGTH characters of the value.
+    """
+    if pattern is None or value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    value = str(value)[:REGEXP_MAX_VALUE_LENGTH]
+    return int(compile_regexp(pattern).search(value) is not None)
+
+
+def fts_prefix_query(q):
+    """
+    Turns search-as-you-type input into an FTS query for the rows containing
+    every word, treating the last word as a prefix. Returns None if q has no
+    words to search for.
+    """
+    # Bare lower case words work in both FTS4 and FTS5 - the upper case AND,
+    # OR, NOT and NEAR would be read as operators
+    words = re.findall(r'\w+', q.lower())
+    if not words:
+        return None
+    return ' '.join(words) + '*'
+
+
 def detect_fts_sql(table):
     return r'''
         select name from sqlite_master
@@ -396,6 +1060,7 @@ class Filters:
         Filter('lte', '\u2264', '"{c}" <= :{p}', '{c} \u2264 {v}', numeric=True),
         Filter('glob', 'glob', '"{c}" glob :{p}', '{c} glob "{v}"'),
         Filter('like', 'like', '"{c}" like :{p}', '{c} like "{v}"'),
+        Filter('regex', 'matches regex', '"{c}" regexp :{p}', '{c} matches regex "{v}"'),
         Filter('isnull', 'is null', '"{c}" is null', '{c} is null', no_argument=True),
         Filter('notnull', 'is not null', '"{c}" is not null', '{c} is not null', no_argument=True),
         Filter('isblank', 'is blank', '("{c}" is null or "{c}" = "")', '{c} is blank', no_argument=True),
@@ -404,6 +1069,12 @@ class Filters:
     _filters_by_key = {
         f.key: f for f in _filters
     }
+    # Filters that compare the column with their value, rather than using
+    # it as a pattern
+    _comparisons = {'exact', 'not', 'gt', 'gte', 'lt', 'lte'}
+    # Filters that an index on their column can answer - startswith only
+    # on TEXT columns, see build_where_clauses()
+    _indexable = {'exact', 'gt', 'gte', 'lt', 'lte', 'isnull', 'startswith'}
 
     def __init__(self, pairs):
         self.pairs = pairs
@@ -443,20 +1114,158 @@ class Filters:
     def has_selections(self):
         return bool(self.pairs)
 
-    def build_where_clauses(self):
+    def unindexed_selections(self, indexed_columns, column_types=None, trigram_tables=None):
+        """
+        Returns the column__lookup keys of the filters that no index can
+        answer, each of which means checking every row of the table
+        """
+        column_types = column_types or {}
+        trigram_tables = trigram_tables or {}
+        keys = []
+        for column, lookup, value in self.selections():
+            if lookup not in self._filters_by_key:
+                continue
+            if lookup in ('contains', 'endswith') and column in trigram_tables and (
+                len(value) >= MIN_TRIGRAM_PATTERN_LENGTH
+            ):
+                continue
+            indexable = lookup in self._indexable and column in indexed_columns
+            if lookup == 'startswith' and (
+                column_affinity(column_types.get(column)) != 'TEXT' or set(value) & set('%_')
+            ):
+                indexable = False
+            if not indexable:
+                keys.append('{}__{}'.format(column, lookup))
+        return keys
+
+    def build_where_clauses(self, column_types=None, trigram_tables=None, rowid='rowid'):
+        """
+        Returns (sql_bits, params). column_types maps column names to their
+        declared types: comparison values are then bound with the column's
+        affinity, so they can be looked up in its indexes, and startswith
+        filters on TEXT columns get a range in front of their LIKE that an
+        index can serve.
+
+        trigram_tables maps column names to attached trigram FTS tables (see
+        datasette.trigrams), which narrow down contains and endswith filters
+        to the rows that have every trigram of the value. rowid is the SQL
+        used to refer to the rowid of the filtered table.
+        """
+        column_types = column_types or {}
+        trigram_tables = trigram_tables or {}
         sql_bits = []
         params = {}
         for i, (column, lookup, value) in enumerate(self.selections()):
             filter = self._filters_by_key.get(lookup, None)
-            if filter:
-                sql_bit, param = filter.where_clause(column, value, i)
-                sql_bits.append(sql_bit)
-                if param is not None:
-                    param_id = 'p{}'.format(i)
-                    params[param_id] = param
+            if not filter:
+                continue
+            param_id = 'p{}'.format(i)
+            affinity = None
+            if column in column_types:
+                affinity = column_affinity(column_types[column])
+            if lookup == 'startswith' and affinity == 'TEXT' and not (
+                set(value) & set('%_')
+            ):
+                # LIKE ignores the case of ASCII letters, so the range runs
+                # from the all uppercase prefix to past the all lowercase one
+                upper = prefix_upper_bound(value.translate(_ascii_lowercase))
+                if upper is not None:
+                    like_bit, like_param = filter.where_clause(column, value, i)
+                    lower_param_id = '{}_lower'.format(param_id)
+                    upper_param_id = '{}_upper'.format(param_id)
+                    sql_bits.append('("{c}" >= :{l} and "{c}" < :{u} and {like})'.format(
+                        c=column, l=lower_param_id, u=upper_param_id, like=like_bit,
+                    ))
+                    params[param_id] = like_param
+                    params[lower_param_id] = value.translate(_ascii_uppercase)
+                    params[upper_param_id] = upper
+                    continue
+            if lookup == 'regex':
+                # Checked up front, for a better error than the SQL function
+                # raising an exception
+                compile_regexp(value)
+            sql_bit, param = filter.where_clause(column, value, i)
+            if (
+                lookup in ('contains', 'endswith') and column in trigram_tables
+                and len(value) >= MIN_TRIGRAM_PATTERN_LENGTH
+            ):
+                # The LIKE is still checked, so the results are the same
+                sql_bit = (
+                    '({rowid} in (select rowid from trigrams.[{t}] where value like :{p}) '
+                    'and {sql_bit})'
+                ).format(
+                    rowid=rowid, t=trigram_tables[column], p=param_id, sql_bit=sql_bit
+                )
+            sql_bits.append(sql_bit)
+            if param is not None:
+                if lookup in self._comparisons:
+                    if affinity not in (None, 'BLOB'):
+                        param = value_with_affinity(value, affinity)
+                    elif filter.numeric:
+                        param = value_with_affinity(value, 'NUMERIC')
+                params[param_id] = param
         return sql_bits, params
 
 
+def column_affinity(declared_type):
+    "Returns the affinity SQLite gives a column with this declared type"
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return 'INTEGER'
+    if any(t in declared_type for t in ('CHAR', 'CLOB', 'TEXT')):
+        return 'TEXT'
+    if 'BLOB' in declared_type or not declared_type:
+        return 'BLOB'
+    if any(t in declared_type for t in ('REAL', 'FLOA', 'DOUB')):
+        return 'REAL'
+    return 'NUMERIC'
+
+
+def value_with_affinity(value, affinity):
+    """
+    Converts a query string value to the type that a column with this
+    affinity would store it as, so it compares equal to the stored values
+    """
+    if affinity in ('INTEGER', 'REAL', 'NUMERIC'):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            converted = float(value)
+        except ValueError:
+            pass
+        else:
+            # NaN would be bound as NULL
+            if converted == converted:
+                return converted
+    return value
+
+
+_ascii_lowercase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_ascii_uppercase = str.maketrans(string.ascii_lowercase, string.ascii_uppercase)
+
+
+def prefix_upper_bound(prefix):
+    """
+    Returns the smallest string greater than every string starting with
+    prefix, or None if there is no such string
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last == 0xd7ff:
+            # Skip the surrogates, which cannot be encoded as UTF-8
+            return prefix[:-1] + chr(0xe000)
+        if last < 0x10ffff:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+# Shorter values have no trigrams to look up
+MIN_TRIGRAM_PATTERN_LENGTH = 3
+
+
 filter_column_re = re.compile(r'^_filter_column_\d+$')
 
 
@@ -536,6 +1345,12 @@ def to_css_class(s):
     return '-'.join(bits)
 
 
+def file_signature(path):
+    "Cheap check for whether a file has changed - (modification time, size)"
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
 def link_or_copy(src, dst):
     # Intended for use in populating a temp directory. We link if possible,
     # but fall back to copying if the temp directory is on a different device
@@ -1,11 +1,63 @@
 from datasette.app import Datasette
+import itertools
 import os
 import sqlite3
 import tempfile
 import time
 
 
+def generate_compound_rows(num):
+    for a, b, c in itertools.islice(itertools.product('abcdefg', repeat=3), num):
+        yield a, b, c, '{}-{}-{}'.format(a, b, c)
+
+
 def app_client():
+    yield from make_app_client()
+
+
+def app_client_with_deferred_counts():
+    yield from make_app_client(defer_counts=True)
+
+
+def app_client_with_truncated_cells():
+    yield from make_app_client(truncate_cells=2)
+
+
+def app_client_with_search():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'search.db')
+        make_search_database(filepath)
+        ds = Datasette([filepath], page_size=2, max_returned_rows=100)
+        yield ds.app().test_client
+
+
+def app_client_with_foreign_keys():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'items.db')
+        make_foreign_key_database(filepath, num_foreign_keys=2, num_rows=1000)
+        ds = Datasette([filepath], page_size=20, max_returned_rows=1000)
+        yield ds.app().test_client
+
+
+def app_client_with_untyped_keys():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'untyped.db')
+        make_untyped_database(filepath)
+        ds = Datasette([filepath], page_size=50, max_returned_rows=100, metadata={
+            'databases': {
+                'untyped': {
+                    'tables': {
+                        'untyped_view': {
+                            'pagination_key': ['k', 'id'],
+                        },
+                    },
+                },
+            },
+        })
+        yield ds.app().test_client
+
+
+def make_app_client(**kwargs):
     with tempfile.TemporaryDirectory() as tmpdir:
         filepath = os.path.join(tmpdir, 'test_tables.db')
         conn = sqlite3.connect(filepath)
@@ -16,6 +68,8 @@ def app_client():
             page_size=50,
             max_returned_rows=100,
             sql_time_limit_ms=20,
+            metadata=METADATA,
+            **kwargs
         )
         ds.sqlite_functions.append(
             ('sleep', 1, lambda n: time.sleep(float(n))),
@@ -23,6 +77,28 @@ def app_client():
         yield ds.app().test_client
 
 
+METADATA = {
+    'databases': {
+        'test_tables': {
+            'tables': {
+                'compound_three_primary_keys': {
+                    'facets': ['pk1'],
+                },
+                'no_primary_key': {
+                    'truncate_cells': {'b': 0},
+                },
+                'paginated_view_with_key': {
+                    'pagination_key': ['b', 'content'],
+                },
+                'sortable': {
+                    'sortable_columns': ['sortable', 'sortable_with_nulls', 'content'],
+                },
+            },
+        },
+    },
+}
+
+
 TABLES = '''
 CREATE TABLE simple_primary_key (
   pk varchar(30) primary key,
@@ -38,6 +114,14 @@ CREATE TABLE compound_primary_key (
 
 INSERT INTO compound_primary_key VALUES ('a', 'b', 'c');
 
+CREATE TABLE compound_three_primary_keys (
+  pk1 varchar(30),
+  pk2 varchar(30),
+  pk3 varchar(30),
+  content text,
+  PRIMARY KEY (pk1, pk2, pk3)
+);
+
 CREATE TABLE no_primary_key (
   content text,
   a text,
@@ -49,12 +133,27 @@ CREATE TABLE [123_starts_with_digits] (
   content text
 );
 
+CREATE TABLE sortable (
+  pk1 varchar(30),
+  pk2 varchar(30),
+  content text,
+  sortable integer,
+  sortable_with_nulls real,
+  text text,
+  PRIMARY KEY (pk1, pk2)
+);
+
+CREATE INDEX idx_sortable ON sortable (sortable);
+
 CREATE VIEW paginated_view AS
     SELECT
         content,
         '- ' || content || ' -' AS content_extra
     FROM no_primary_key;
 
+CREATE VIEW paginated_view_with_key AS
+    SELECT content, b FROM no_primary_key;
+
 CREATE TABLE "Table With Space In Name" (
   pk varchar(30) primary key,
   content text
@@ -89,4 +188,153 @@ CREATE VIEW simple_view AS
 ''' + '\n'.join([
     'INSERT INTO no_primary_key VALUES ({i}, "a{i}", "b{i}", "c{i}");'.format(i=i + 1)
     for i in range(201)
+]) + '\n'.join([
+    'INSERT INTO compound_three_primary_keys VALUES ("{a}", "{b}", "{c}", "{content}");'.format(
+        a=a, b=b, c=c, content=content
+    ) for a, b, c, content in generate_compound_rows(201)
+]) + '\n'.join([
+    'INSERT INTO sortable VALUES ("a{}", "{}", "c{}", {}, {}, "t{}");'.format(
+        i // 20, i, i, i % 7, 'null' if i % 3 == 0 else i % 11, i % 5
+    ) for i in range(201)
 ])
+
+
+def make_wide_schema(filepath, num_tables):
+    """
+    Creates a database with num_tables tables, shaped like the output of a
+    sharded ETL job: every shard has a foreign key to the previous shard and
+    every hundredth shard has a full-text search index.
+
+    SQLite scans sqlite_master after each CREATE TABLE, so this takes
+    minutes for tens of thousands of tables.
+    """
+    conn = sqlite3.connect(filepath, isolation_level=None)
+    conn.execute('BEGIN')
+    for i in range(num_tables):
+        conn.execute(
+            'CREATE TABLE shard_{i} (id integer primary key, name text, '
+            'previous_id integer{fk})'.format(
+                i=i,
+                fk=', FOREIGN KEY (previous_id) REFERENCES shard_{}(id)'.format(i - 1) if i else '',
+            )
+        )
+        if i % 100 == 0:
+            conn.execute(
+                'CREATE VIRTUAL TABLE shard_{i}_fts USING FTS4 (name, content="shard_{i}")'.format(i=i)
+            )
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def make_foreign_key_database(filepath, num_foreign_keys=4, num_rows=200000):
+    """
+    Creates a database with an "items" table that has num_foreign_keys
+    foreign keys to label tables, and is referenced by as many event tables.
+    None of the foreign key columns are indexed, so every label lookup and
+    every incoming foreign key count is a full table scan.
+    """
+    conn = sqlite3.connect(filepath)
+    for i in range(num_foreign_keys):
+        conn.execute('CREATE TABLE label_{} (id integer, name text)'.format(i))
+        conn.executemany(
+            'INSERT INTO label_{} VALUES (?, ?)'.format(i),
+            ((j, 'Label {}'.format(j)) for j in range(num_rows))
+        )
+        conn.execute(
+            'CREATE TABLE event_{} (item_id integer, note text, '
+            'FOREIGN KEY (item_id) REFERENCES items(id))'.format(i)
+        )
+        conn.executemany(
+            'INSERT INTO event_{} VALUES (?, ?)'.format(i),
+            ((j % 100, 'Event {}'.format(j)) for j in range(num_rows))
+        )
+    conn.execute('CREATE TABLE items (id integer primary key, {}, {})'.format(
+        ', '.join('label_{} integer'.format(i) for i in range(num_foreign_keys)),
+        ', '.join(
+            'FOREIGN KEY (label_{i}) REFERENCES label_{i}(id)'.format(i=i)
+            for i in range(num_foreign_keys)
+        ),
+    ))
+    conn.executemany(
+        'INSERT INTO items VALUES (?, {})'.format(', '.join('?' * num_foreign_keys)),
+        ([i] + [i * 7] * num_foreign_keys for i in range(100))
+    )
+    conn.commit()
+    conn.close()
+
+
+def untyped_value(i):
+    "Mixes NULLs, integers, floats, numeric looking text and other text"
+    return [None, i, i + 0.5, str(i), 'x{}'.format(i)][i % 5]
+
+
+def make_untyped_database(filepath, num_rows=300):
+    """
+    Creates a database with a table whose n column has no declared type, so
+    SQLite compares its values without converting them, and a view with a
+    computed k column of NULLs, numbers, repeated zeros and text
+    """
+    conn = sqlite3.connect(filepath)
+    conn.execute('CREATE TABLE untyped (id integer primary key, n)')
+    conn.executemany(
+        'INSERT INTO untyped VALUES (?, ?)',
+        ((i, untyped_value(i)) for i in range(num_rows))
+    )
+    conn.execute(
+        'CREATE VIEW untyped_view AS SELECT id, '
+        'CASE WHEN id % 10 = 4 THEN n ELSE n * 1 END AS k FROM untyped'
+    )
+    conn.commit()
+    conn.close()
+
+
+def make_compound_pk_database(filepath, num_rows):
+    "Creates a database with a two column primary key table of num_rows rows"
+    conn = sqlite3.connect(filepath)
+    conn.execute(
+        'CREATE TABLE readings (station integer, reading integer, value text, '
+        'PRIMARY KEY (station, reading))'
+    )
+    conn.executemany(
+        'INSERT INTO readings VALUES (?, ?, ?)',
+        ((i // 1000, i % 1000, 'Reading {}'.format(i)) for i in range(num_rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+SEARCH_DOCUMENTS = [
+    (1, 'Cats', 'A cat sat on a mat next to another cat'),
+    (2, 'Dogs', 'Dogs chase the cat around the garden'),
+    (3, 'Fish', 'Fish swim in the pond'),
+    (4, 'Cat care', 'Feeding your cat, grooming your cat and your cat\'s cat flap'),
+    (5, 'Birds', 'Birds are watched by the cat'),
+    (6, 'Markup', 'Close a <b> tag with </b>'),
+]
+
+
+def make_search_database(filepath):
+    """
+    Creates a database with the same documents indexed by an FTS5 table
+    (documents) and an FTS4 table (notes), both using external content
+    """
+    conn = sqlite3.connect(filepath)
+    for table, fts in (('documents', 'FTS5'), ('notes', 'FTS4')):
+        conn.execute(
+            'CREATE TABLE {} (id integer primary key, title text, body text)'.format(table)
+        )
+        conn.executemany(
+            'INSERT INTO {} VALUES (?, ?, ?)'.format(table), SEARCH_DOCUMENTS
+        )
+        conn.execute(
+            'CREATE VIRTUAL TABLE {table}_fts USING {fts} (title, body, content="{table}")'.format(
+                table=table, fts=fts
+            )
+        )
+        conn.execute(
+            'INSERT INTO {table}_fts (rowid, title, body) SELECT id, title, body FROM {table}'.format(
+                table=table
+            )
+        )
+    conn.commit()
+    conn.close()
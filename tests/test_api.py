@@ -1,7 +1,27 @@
-from .fixtures import app_client
+from datasette.app import BaseView, Datasette
+from .fixtures import (
+    app_client,
+    app_client_with_deferred_counts,
+    app_client_with_foreign_keys,
+    app_client_with_search,
+    app_client_with_untyped_keys,
+    app_client_with_truncated_cells,
+    make_search_database,
+)
+import asyncio
+import os
 import pytest
+import sqlite3
+import tempfile
+import time
+import urllib
 
 pytest.fixture(scope='module')(app_client)
+pytest.fixture(scope='module')(app_client_with_deferred_counts)
+pytest.fixture(scope='module')(app_client_with_foreign_keys)
+pytest.fixture(scope='module')(app_client_with_search)
+pytest.fixture(scope='module')(app_client_with_untyped_keys)
+pytest.fixture(scope='module')(app_client_with_truncated_cells)
 
 
 def test_homepage(app_client):
@@ -10,7 +30,7 @@ def test_homepage(app_client):
     assert response.json.keys() == {'test_tables': 0}.keys()
     d = response.json['test_tables']
     assert d['name'] == 'test_tables'
-    assert d['tables_count'] == 7
+    assert d['tables_count'] == 9
 
 
 def test_database_page(app_client):
@@ -24,6 +44,9 @@ def test_database_page(app_client):
         'hidden': False,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
+        'primary_keys': [],
+        'indexed_columns': [],
+        'fts_table': None,
     }, {
         'columns': ['pk', 'content'],
         'name': 'Table With Space In Name',
@@ -31,6 +54,9 @@ def test_database_page(app_client):
         'hidden': False,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
+        'primary_keys': ['pk'],
+        'indexed_columns': ['pk'],
+        'fts_table': None,
     }, {
         'columns': ['pk', 'f1', 'f2', 'f3'],
         'name': 'complex_foreign_keys',
@@ -53,6 +79,9 @@ def test_database_page(app_client):
         },
         'hidden': False,
         'label_column': None,
+        'primary_keys': ['pk'],
+        'indexed_columns': ['pk'],
+        'fts_table': None,
     }, {
         'columns': ['pk1', 'pk2', 'content'],
         'name': 'compound_primary_key',
@@ -60,6 +89,22 @@ def test_database_page(app_client):
         'hidden': False,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
+        'primary_keys': ['pk1', 'pk2'],
+        'indexed_columns': ['pk1'],
+        'fts_table': None,
+    }, {
+        'columns': ['pk1', 'pk2', 'pk3', 'content'],
+        'name': 'compound_three_primary_keys',
+        'count': 201,
+        'hidden': False,
+        'foreign_keys': {'incoming': [], 'outgoing': []},
+        'label_column': None,
+        'primary_keys': ['pk1', 'pk2', 'pk3'],
+        'indexed_columns': ['pk1'],
+        'fts_table': None,
+        'facets': {
+            'pk1': [['a', 49], ['b', 49], ['c', 49], ['d', 49], ['e', 5]],
+        },
     }, {
         'columns': ['content', 'a', 'b', 'c'],
         'name': 'no_primary_key',
@@ -67,6 +112,9 @@ def test_database_page(app_client):
         'hidden': False,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
+        'primary_keys': [],
+        'indexed_columns': [],
+        'fts_table': None,
     }, {
         'columns': ['pk', 'content'],
         'name': 'simple_primary_key',
@@ -89,6 +137,19 @@ def test_database_page(app_client):
             'outgoing': [],
         },
         'label_column': None,
+        'primary_keys': ['pk'],
+        'indexed_columns': ['pk'],
+        'fts_table': None,
+    }, {
+        'columns': ['pk1', 'pk2', 'content', 'sortable', 'sortable_with_nulls', 'text'],
+        'name': 'sortable',
+        'count': 201,
+        'hidden': False,
+        'foreign_keys': {'incoming': [], 'outgoing': []},
+        'label_column': None,
+        'primary_keys': ['pk1', 'pk2'],
+        'indexed_columns': ['pk1', 'sortable'],
+        'fts_table': None,
     }, {
         'columns': ['pk', 'content'],
         'name': 'table/with/slashes.csv',
@@ -96,7 +157,27 @@ def test_database_page(app_client):
         'hidden': False,
         'foreign_keys': {'incoming': [], 'outgoing': []},
         'label_column': None,
-    }] == data['tables']
+        'primary_keys': ['pk'],
+        'indexed_columns': ['pk'],
+        'fts_table': None,
+    }] == [
+        {
+            key: value for key, value in table.items()
+            if key not in ('sql', 'column_types')
+        }
+        for table in data['tables']
+    ]
+    assert (
+        'CREATE TABLE [123_starts_with_digits] (\n  content text\n)'
+    ) == data['tables'][0]['sql']
+    assert {
+        'pk1': 'varchar(30)',
+        'pk2': 'varchar(30)',
+        'content': 'TEXT',
+        'sortable': 'INTEGER',
+        'sortable_with_nulls': 'REAL',
+        'text': 'TEXT',
+    } == next(t for t in data['tables'] if t['name'] == 'sortable')['column_types']
 
 
 def test_custom_sql(app_client):
@@ -184,6 +265,8 @@ def test_table_with_slashes_in_name(app_client):
     ('/test_tables/no_primary_key.jsono', 201, 5),
     ('/test_tables/paginated_view.jsono', 201, 5),
     ('/test_tables/123_starts_with_digits.jsono', 0, 1),
+    ('/test_tables/compound_three_primary_keys.jsono', 201, 5),
+    ('/test_tables/paginated_view_with_key.jsono', 201, 5),
 ])
 def test_paginate_tables_and_views(app_client, path, expected_rows, expected_pages):
     fetched = []
@@ -194,13 +277,718 @@ def test_paginate_tables_and_views(app_client, path, expected_rows, expected_pag
         fetched.extend(response.json['rows'])
         path = response.json['next_url']
         if path:
-            assert response.json['next'] and path.endswith(response.json['next'])
+            assert response.json['next'] and path.endswith(
+                urllib.parse.quote_plus(response.json['next'])
+            )
         assert count < 10, 'Possible infinite loop detected'
 
     assert expected_rows == len(fetched)
     assert expected_pages == count
 
 
+def test_paginate_view_with_pagination_key(app_client):
+    response = app_client.get('/test_tables/paginated_view_with_key.json', gather_request=False)
+    assert (
+        'select * from paginated_view_with_key order by "b", "content" limit 51'
+    ) == response.json['query']['sql']
+    last_row = response.json['rows'][-1]
+    assert '{},{}'.format(last_row[1], last_row[0]) == response.json['next']
+    response = app_client.get(response.json['next_url'], gather_request=False)
+    assert (
+        'select * from paginated_view_with_key where ("b", "content") > (:p0, :p1) '
+        'order by "b", "content" limit 51'
+    ) == response.json['query']['sql']
+    assert 'offset' not in response.json['query']['sql']
+    assert 201 == response.json['filtered_table_rows']
+
+
+@pytest.mark.parametrize('query_string,sort_key,reverse,uses_index', [
+    ('_sort=sortable', 'sortable', False, True),
+    ('_sort_desc=sortable', 'sortable', True, True),
+    ('_sort=sortable_with_nulls', 'sortable_with_nulls', False, False),
+    ('_sort_desc=sortable_with_nulls', 'sortable_with_nulls', True, False),
+    ('_sort_desc=sortable_with_nulls&text=t1', 'sortable_with_nulls', True, False),
+])
+def test_sortable(app_client, query_string, sort_key, reverse, uses_index):
+    path = '/test_tables/sortable.jsono?{}'.format(query_string)
+    fetched = []
+    page = 0
+    while path:
+        page += 1
+        assert page < 10, 'Possible infinite loop detected'
+        response = app_client.get(path, gather_request=False)
+        assert 'offset' not in response.json['query']['sql']
+        assert uses_index is response.json['sort_uses_index']
+        fetched.extend(response.json['rows'])
+        path = response.json['next_url']
+    assert response.json['filtered_table_rows'] == len(fetched)
+    # NULLs come first, ties are ordered by primary key, and descending
+    # order is the exact reverse
+    expected = sorted(fetched, key=lambda row: (
+        row[sort_key] is not None, row[sort_key], row['pk1'], row['pk2']
+    ), reverse=reverse)
+    assert [(r['pk1'], r['pk2']) for r in expected] == [
+        (r['pk1'], r['pk2']) for r in fetched
+    ]
+    assert len(set((r['pk1'], r['pk2']) for r in fetched)) == len(fetched)
+
+
+@pytest.mark.parametrize('query_string,reverse', [
+    ('_sort=n', False),
+    ('_sort_desc=n', True),
+])
+def test_sort_untyped_column(app_client_with_untyped_keys, query_string, reverse):
+    # Numbers in n have to stay numbers in the _next tokens, or they would
+    # compare greater than every number on the next page
+    path = '/untyped/untyped.jsono?{}'.format(query_string)
+    fetched = []
+    while path:
+        assert len(fetched) <= 300, 'Possible infinite loop detected'
+        response = app_client_with_untyped_keys.get(path, gather_request=False)
+        assert 200 == response.status
+        fetched.extend(response.json['rows'])
+        path = response.json['next_url']
+    assert 300 == len(fetched)
+    # SQLite sorts NULLs, then numbers, then text
+    expected = sorted(fetched, key=lambda row: (
+        row['n'] is not None, isinstance(row['n'], str), row['n'], row['id']
+    ), reverse=reverse)
+    assert [row['id'] for row in expected] == [row['id'] for row in fetched]
+
+
+def test_paginate_view_with_untyped_pagination_key(app_client_with_untyped_keys):
+    path = '/untyped/untyped_view.jsono'
+    fetched = []
+    while path:
+        assert len(fetched) <= 300, 'Possible infinite loop detected'
+        response = app_client_with_untyped_keys.get(path, gather_request=False)
+        assert 200 == response.status
+        assert 'offset' not in response.json['query']['sql']
+        fetched.extend(response.json['rows'])
+        path = response.json['next_url']
+    assert 300 == len(fetched)
+    assert {type(None), int, float, str} == {type(row['k']) for row in fetched}
+    expected = sorted(fetched, key=lambda row: (
+        row['k'] is not None, isinstance(row['k'], str), row['k'], row['id']
+    ))
+    assert [row['id'] for row in expected] == [row['id'] for row in fetched]
+
+
+@pytest.mark.parametrize('path,error', [
+    ('/test_tables/sortable.json?_sort=text', 'Cannot sort table by text'),
+    ('/test_tables/sortable.json?_sort=missing', 'Cannot sort table by missing'),
+    ('/test_tables/sortable.json?_sort=sortable&_sort_desc=sortable',
+        'Cannot use _sort and _sort_desc at the same time'),
+    ('/test_tables/simple_view.json?_sort=missing', 'Cannot sort table by missing'),
+])
+def test_sortable_errors(app_client, path, error):
+    response = app_client.get(path, gather_request=False)
+    assert 400 == response.status
+    assert error == response.json['error']
+
+
+def test_facets(app_client):
+    response = app_client.get(
+        '/test_tables/compound_three_primary_keys.json?pk2=a&_facet=pk1&_facet=pk2',
+        gather_request=False
+    )
+    facet_results = response.json['facet_results']
+    assert ['pk1', 'pk2'] == list(facet_results.keys())
+    assert [
+        ('a', 7), ('b', 7), ('c', 7), ('d', 7), ('e', 5),
+    ] == [(r['value'], r['count']) for r in facet_results['pk1']['results']]
+    assert not facet_results['pk1']['truncated']
+    assert not facet_results['pk1']['timed_out']
+    assert (
+        'compound_three_primary_keys.json?_facet=pk1&_facet=pk2&pk1=b&pk2=a'
+    ) == facet_results['pk1']['results'][1]['toggle_url'].split('/')[-1]
+    pk2_result = facet_results['pk2']['results'][0]
+    assert ('a', 33, True) == (
+        pk2_result['value'], pk2_result['count'], pk2_result['selected']
+    )
+    assert (
+        'compound_three_primary_keys.json?_facet=pk1&_facet=pk2'
+    ) == pk2_result['toggle_url'].split('/')[-1]
+
+
+def test_facets_default_from_metadata(app_client):
+    response = app_client.get(
+        '/test_tables/compound_three_primary_keys.json', gather_request=False
+    )
+    facet_results = response.json['facet_results']
+    assert ['pk1'] == list(facet_results.keys())
+    assert [
+        ('a', 49), ('b', 49), ('c', 49), ('d', 49), ('e', 5),
+    ] == [(r['value'], r['count']) for r in facet_results['pk1']['results']]
+
+
+def test_facets_truncated_and_nulls(app_client):
+    response = app_client.get(
+        '/test_tables/sortable.json?_facet=sortable_with_nulls&_facet=content',
+        gather_request=False
+    )
+    facet_results = response.json['facet_results']
+    nulls = facet_results['sortable_with_nulls']['results'][0]
+    assert (None, 67) == (nulls['value'], nulls['count'])
+    assert nulls['toggle_url'].endswith('sortable_with_nulls__isnull=1')
+    assert facet_results['content']['truncated']
+    assert 30 == len(facet_results['content']['results'])
+
+
+def test_facets_view(app_client):
+    response = app_client.get(
+        '/test_tables/simple_view.json?_facet=upper_content', gather_request=False
+    )
+    assert [
+        ('', 1), ('HELLO', 1), ('WORLD', 1),
+    ] == [
+        (r['value'], r['count'])
+        for r in response.json['facet_results']['upper_content']['results']
+    ]
+
+
+@pytest.mark.parametrize('path,error', [
+    ('/test_tables/sortable.json?_facet=missing', 'Cannot facet table by missing'),
+    ('/test_tables/simple_view.json?_facet=missing', 'Cannot facet view by missing'),
+])
+def test_facets_errors(app_client, path, error):
+    response = app_client.get(path, gather_request=False)
+    assert 400 == response.status
+    assert error == response.json['error']
+
+
+@pytest.mark.parametrize('path,expected_columns', [
+    ('/test_tables/sortable.json?_col=content', ['pk1', 'pk2', 'content']),
+    ('/test_tables/sortable.json?_nocol=content&_nocol=text&_nocol=pk1', [
+        'pk1', 'pk2', 'sortable', 'sortable_with_nulls',
+    ]),
+    ('/test_tables/sortable.json?_col=text&_sort_desc=sortable', [
+        'pk1', 'pk2', 'sortable', 'text',
+    ]),
+    ('/test_tables/no_primary_key.json?_col=a', ['rowid', 'a']),
+    ('/test_tables/simple_view.json?_col=upper_content', ['upper_content']),
+    ('/test_tables/paginated_view_with_key.json?_nocol=b', ['content', 'b']),
+    ('/test_tables/compound_primary_key/a,b.json?_nocol=content', ['pk1', 'pk2']),
+])
+def test_col_and_nocol(app_client, path, expected_columns):
+    response = app_client.get(path, gather_request=False)
+    assert 200 == response.status
+    assert expected_columns == response.json['columns']
+    assert all(len(row) == len(expected_columns) for row in response.json['rows'])
+
+
+def test_col_pagination(app_client):
+    path = '/test_tables/compound_three_primary_keys.json?_col=content'
+    fetched = []
+    while path:
+        response = app_client.get(path, gather_request=False)
+        assert ['pk1', 'pk2', 'pk3', 'content'] == response.json['columns']
+        fetched.extend(row[3] for row in response.json['rows'])
+        path = response.json['next_url']
+    assert 201 == len(fetched)
+    assert 'a-a-a' == fetched[0]
+
+
+@pytest.mark.parametrize('path,error', [
+    ('/test_tables/sortable.json?_col=missing', 'Invalid column: missing'),
+    ('/test_tables/simple_view.json?_nocol=content&_nocol=upper_content', 'No columns selected'),
+    ('/test_tables/simple_primary_key/1.json?_col=missing', 'Invalid column: missing'),
+])
+def test_col_errors(app_client, path, error):
+    response = app_client.get(path, gather_request=False)
+    assert 400 == response.status
+    assert error == response.json['error']
+
+
+def test_truncate_cells(app_client_with_truncated_cells):
+    response = app_client_with_truncated_cells.get(
+        '/test_tables/simple_primary_key.json', gather_request=False
+    )
+    assert ['pk', 'content'] == response.json['columns']
+    assert [
+        ['1', {
+            '$truncated': True,
+            'value': 'he',
+            'length': 5,
+            'url': '/test_tables/simple_primary_key/1/content',
+        }],
+        ['2', {
+            '$truncated': True,
+            'value': 'wo',
+            'length': 5,
+            'url': '/test_tables/simple_primary_key/2/content',
+        }],
+        ['3', ''],
+    ] == response.json['rows']
+    assert 'length("content") > 2' in response.json['query']['sql']
+    assert 'typeof("content") in (\'text\', \'blob\')' in response.json['query']['sql']
+
+
+def test_truncate_cells_leaves_numbers(app_client_with_truncated_cells):
+    response = app_client_with_truncated_cells.get(
+        '/test_tables/sortable.jsono?_col=sortable&_col=sortable_with_nulls&pk1=a0&pk2=10',
+        gather_request=False
+    )
+    assert [{
+        'pk1': 'a0',
+        'pk2': '10',
+        'sortable': 3,
+        'sortable_with_nulls': 10.0,
+    }] == response.json['rows']
+
+
+def test_truncate_cells_metadata_and_rowid(app_client_with_truncated_cells):
+    response = app_client_with_truncated_cells.get(
+        '/test_tables/no_primary_key.jsono?_col=a&_col=b&content=10',
+        gather_request=False
+    )
+    assert [{
+        'rowid': 10,
+        'a': {
+            '$truncated': True,
+            'value': 'a1',
+            'length': 3,
+            'url': '/test_tables/no_primary_key/10/a',
+        },
+        'b': 'b10',
+    }] == response.json['rows']
+
+
+def test_truncate_cells_view(app_client_with_truncated_cells):
+    response = app_client_with_truncated_cells.get(
+        '/test_tables/simple_view.jsono', gather_request=False
+    )
+    assert {
+        '$truncated': True,
+        'value': 'HE',
+        'length': 5,
+        'url': None,
+    } == response.json['rows'][0]['upper_content']
+
+
+def test_cell(app_client_with_truncated_cells):
+    response = app_client_with_truncated_cells.get(
+        '/test_tables/simple_primary_key/1/content', gather_request=False
+    )
+    assert 200 == response.status
+    assert 'text/plain; charset=utf-8' == response.headers['content-type']
+    assert 'hello' == response.text
+
+
+@pytest.mark.parametrize('path', [
+    '/test_tables/simple_primary_key/1/missing',
+    '/test_tables/simple_primary_key/99/content',
+    '/test_tables/compound_primary_key/a/content',
+])
+def test_cell_not_found(app_client, path):
+    response = app_client.get(path, gather_request=False)
+    assert 404 == response.status
+
+
+def test_filters_use_column_types(app_client):
+    response = app_client.get(
+        '/test_tables/sortable.json?text__startswith=t1&sortable_with_nulls__gte=9.5',
+        gather_request=False
+    )
+    assert {
+        'p0': 9.5,
+        'p1': 't1%',
+        'p1_lower': 'T1',
+        'p1_upper': 't2',
+    } == response.json['query']['params']
+    assert (
+        'where "sortable_with_nulls" >= :p0 and '
+        '("text" >= :p1_lower and "text" < :p1_upper and "text" like :p1) '
+    ) in (
+        response.json['query']['sql']
+    )
+    assert 2 == response.json['filtered_table_rows']
+    assert all(row[5] == 't1' and row[4] >= 9.5 for row in response.json['rows'])
+
+
+@pytest.mark.parametrize('table', ['documents', 'notes'])
+def test_search_rank(app_client_with_search, table):
+    path = '/search/{}.jsono?_search=cat&_rank=1'.format(table)
+    ids = []
+    ranks = []
+    while path:
+        response = app_client_with_search.get(path, gather_request=False)
+        assert 200 == response.status
+        data = response.json
+        assert 4 == data['filtered_table_rows']
+        assert len(data['rows']) == len(data['ranks']) == len(data['snippets'])
+        ids.extend(row['id'] for row in data['rows'])
+        ranks.extend(data['ranks'])
+        path = data['next_url']
+    # Document 4 mentions cat most often, document 2 in the longest text
+    assert 4 == ids[0]
+    assert 2 == ids[-1]
+    assert [1, 2, 4, 5] == sorted(ids)
+    assert ranks == sorted(ranks)
+
+
+def test_search_rank_snippets(app_client_with_search):
+    response = app_client_with_search.get(
+        '/search/documents.json?_search=pond&_rank=1', gather_request=False
+    )
+    assert [[3, 'Fish', 'Fish swim in the pond']] == response.json['rows']
+    assert ['Fish swim in the <b>pond</b>'] == response.json['snippets']
+
+
+@pytest.mark.parametrize('path,error', [
+    ('/search/documents.json?_search=cat&_rank=1&_sort=title',
+        'Cannot use _sort or _sort_desc with _rank'),
+])
+def test_search_rank_errors(app_client_with_search, path, error):
+    response = app_client_with_search.get(path, gather_request=False)
+    assert 400 == response.status
+    assert error == response.json['error']
+
+
+@pytest.mark.parametrize('path,expected', [
+    ('/search/documents/-/suggest?q=Ca', [
+        {'id': 1, 'label': 'Cats'},
+        {'id': 2, 'label': 'Dogs'},
+        {'id': 4, 'label': 'Cat care'},
+        {'id': 5, 'label': 'Birds'},
+    ]),
+    ('/search/notes/-/suggest?q=cat+ca&_size=1', [{'id': 1, 'label': 'Cats'}]),
+    ('/search/documents/-/suggest?q=po', [{'id': 3, 'label': 'Fish'}]),
+    ('/search/documents/-/suggest?q=zebra', []),
+    ('/search/documents/-/suggest?q=', []),
+])
+def test_suggest(app_client_with_search, path, expected):
+    response = app_client_with_search.get(path, gather_request=False)
+    assert 200 == response.status
+    assert expected == response.json['suggestions']
+    # Suggestions are served without redirecting to the URL with the hash
+    assert 'Cache-Control' not in response.headers
+
+
+def test_suggest_with_hash(app_client_with_search):
+    path = app_client_with_search.get('/.json', gather_request=False).json['search']['path']
+    response = app_client_with_search.get(
+        '/{}/documents/-/suggest?q=fish'.format(path), gather_request=False
+    )
+    assert [{'id': 3, 'label': 'Fish'}] == response.json['suggestions']
+    assert 'max-age=31536000' == response.headers['Cache-Control']
+
+
+@pytest.mark.parametrize('path,error', [
+    ('/search/documents/-/suggest?q=ca&_size=0', '_size must be between 1 and 100'),
+    ('/search/documents/-/suggest?q=ca&_size=x', '_size must be an integer'),
+    ('/search/documents_fts_data/-/suggest?q=ca',
+        'Table has no full-text search index: documents_fts_data'),
+])
+def test_suggest_errors(app_client_with_search, path, error):
+    response = app_client_with_search.get(path, gather_request=False)
+    assert 400 == response.status
+    assert error == response.json['error']
+
+
+def test_global_search(app_client_with_search):
+    response = app_client_with_search.get('/-/search?q=pond', gather_request=False)
+    assert 200 == response.status
+    data = response.json
+    assert [
+        {'database': 'search', 'table': 'documents'},
+        {'database': 'search', 'table': 'notes'},
+    ] == data['searched']
+    assert [] == data['timed_out']
+    assert [] == data['failed']
+    assert [
+        ('documents', 3, 'Fish', 'Fish swim in the <b>pond</b>'),
+        ('notes', 3, 'Fish', 'Fish swim in the <b>pond</b>'),
+    ] == sorted(
+        (r['table'], r['id'], r['label'], r['snippet']) for r in data['results']
+    )
+    assert all(r['url'].endswith('/3') for r in data['results'])
+
+
+def test_global_search_merged_by_rank(app_client_with_search):
+    response = app_client_with_search.get('/-/search?q=cat&_size=3', gather_request=False)
+    ranks = [r['rank'] for r in response.json['results']]
+    assert 3 == len(ranks)
+    assert ranks == sorted(ranks)
+    # Document 4 is the best match in both tables
+    assert 4 == response.json['results'][0]['id']
+
+
+@pytest.mark.parametrize('path,error', [
+    ('/-/search?q=%22', 'malformed MATCH expression: ["]'),
+    ('/-/search?q=cat&_size=0', '_size must be between 1 and 100'),
+])
+def test_global_search_errors(app_client_with_search, path, error):
+    response = app_client_with_search.get(path, gather_request=False)
+    assert 400 == response.status
+    assert error == response.json['error']
+
+
+def test_global_search_timed_out():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'search.db')
+        make_search_database(filepath)
+        # No time at all for the searches - the tables are reported instead
+        client = Datasette([filepath], search_time_limit_ms=0).app().test_client
+        response = client.get('/-/search?q=cat', gather_request=False)
+    assert 200 == response.status
+    assert [] == response.json['results']
+    assert [] == response.json['searched']
+    assert [
+        {'database': 'search', 'table': 'documents'},
+        {'database': 'search', 'table': 'notes'},
+    ] == response.json['timed_out']
+
+
+def test_global_search_table_fails():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'search.db')
+        make_search_database(filepath)
+        conn = sqlite3.connect(filepath)
+        # Ranking this index calls a function that doesn't exist
+        conn.executescript('''
+        CREATE TABLE broken (id integer primary key, title text, body text);
+        INSERT INTO broken VALUES (3, 'Fish', 'pond');
+        CREATE VIRTUAL TABLE broken_fts USING FTS5 (title, body, content="broken");
+        INSERT INTO broken_fts (rowid, title, body) VALUES (3, 'Fish', 'pond');
+        INSERT INTO broken_fts (broken_fts, rank) VALUES ('rank', 'missing()');
+        ''')
+        conn.close()
+        client = Datasette([filepath]).app().test_client
+        response = client.get('/-/search?q=pond', gather_request=False)
+    assert 200 == response.status
+    assert [
+        {'database': 'search', 'table': 'documents'},
+        {'database': 'search', 'table': 'notes'},
+    ] == response.json['searched']
+    assert 2 == len(response.json['results'])
+    assert [
+        {'database': 'search', 'table': 'broken', 'error': 'no such function: missing'},
+    ] == response.json['failed']
+
+
+def test_execute_skips_query_queued_past_deadline():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'search.db')
+        make_search_database(filepath)
+        ds = Datasette([filepath], num_threads=1)
+        ds.app()
+        view = BaseView(ds)
+        view.explain = []
+        loop = asyncio.new_event_loop()
+        try:
+            # The only thread is busy until well after the deadline
+            ds.executor.submit(time.sleep, 0.2)
+            with pytest.raises(sqlite3.OperationalError) as e:
+                loop.run_until_complete(view.execute(
+                    'search', 'select * from documents',
+                    deadline=time.time() + 0.05,
+                ))
+            assert 'interrupted' == str(e.value)
+            rows = loop.run_until_complete(view.execute(
+                'search', 'select count(*) from documents',
+                deadline=time.time() + 1,
+            ))
+        finally:
+            loop.close()
+    assert ['select count(*) from documents'] == [
+        query['sql'] for query in view.explain
+    ]
+    assert rows[0][0] > 0
+
+
+@pytest.mark.parametrize('path,expected_sql', [
+    ('/test_tables/sortable.json?sortable__gt=4&_explain=1', [
+        'select * from sortable where "sortable" > :p0 order by pk1, pk2 limit 51',
+        'select count(*) from sortable where "sortable" > :p0 ',
+    ]),
+    ('/test_tables/simple_primary_key/1.json?_explain=1', [
+        'select * from "simple_primary_key" where "pk"=:p0',
+    ]),
+    ('/test_tables.json?sql=select+content+from+simple_primary_key&_explain=1', [
+        'select content from simple_primary_key',
+    ]),
+])
+def test_explain(app_client, path, expected_sql):
+    response = app_client.get(path, gather_request=False)
+    assert 200 == response.status
+    explain = response.json['explain']
+    assert expected_sql == sorted(query['sql'] for query in explain)
+    assert all(query['plan'] for query in explain)
+
+
+def test_explain_plan(app_client):
+    response = app_client.get(
+        '/test_tables/sortable.json?sortable__gte=5&_explain=1', gather_request=False
+    )
+    plans = {
+        query['sql'].split()[1]: [step['detail'] for step in query['plan']]
+        for query in response.json['explain']
+    }
+    assert 'INDEX idx_sortable' in plans['count(*)'][0]
+    response = app_client.get('/test_tables/sortable.json', gather_request=False)
+    assert 'explain' not in response.json
+
+
+@pytest.mark.parametrize('path,expected', [
+    ('/test_tables/sortable.json', []),
+    ('/test_tables/sortable.json?sortable__gt=3&sortable__lt=9', []),
+    ('/test_tables/sortable.json?content__contains=a&text__startswith=t',
+        ['content__contains', 'text__startswith']),
+    ('/test_tables/sortable.json?sortable_with_nulls__gt=3&sortable=1',
+        ['sortable_with_nulls__gt']),
+    ('/test_tables/no_primary_key.json?rowid=1', []),
+    ('/test_tables/no_primary_key.json?rowid=1&content=a1', ['content__exact']),
+])
+def test_unindexed_filters(app_client, path, expected):
+    response = app_client.get(path, gather_request=False)
+    assert expected == response.json['unindexed_filters']
+
+
+def test_labels(app_client_with_foreign_keys):
+    path = '/items/items.json?_labels=1&_explain=1&_next=40'
+    response = app_client_with_foreign_keys.get(path, gather_request=False)
+    assert 200 == response.status
+    labels = response.json['labels']
+    assert ['label_0', 'label_1'] == sorted(labels)
+    assert [
+        [id * 7, 'Label {}'.format(id * 7)] for id in range(41, 61)
+    ] == labels['label_0'] == labels['label_1']
+    assert 2 == len([
+        query for query in response.json['explain'] if 'in (?' in query['sql']
+    ])
+    # The labels are cached, so asking again doesn't look them up
+    response = app_client_with_foreign_keys.get(path, gather_request=False)
+    assert labels == response.json['labels']
+    assert ['select * from items where "id" > :p0 order by id limit 21'] == [
+        query['sql'] for query in response.json['explain']
+    ]
+    response = app_client_with_foreign_keys.get('/items/items.json', gather_request=False)
+    assert 'labels' not in response.json
+
+
+def test_expand_table(app_client_with_foreign_keys):
+    response = app_client_with_foreign_keys.get(
+        '/items/items.jsono?_expand=label_0', gather_request=False
+    )
+    assert 200 == response.status
+    assert {
+        'id': 2,
+        'label_0': {'value': 14, 'label': 'Label 14'},
+        'label_1': 14,
+    } == response.json['rows'][2]
+
+
+def test_expand_custom_sql(app_client_with_foreign_keys):
+    # More ids than SQLite allows variables in a single query
+    response = app_client_with_foreign_keys.get(
+        '/items.json?sql=select+id+as+label_1+from+label_1&_expand=label_1&_explain=1',
+        gather_request=False
+    )
+    assert 200 == response.status
+    assert 1000 == len(response.json['rows'])
+    assert [
+        [{'value': id, 'label': 'Label {}'.format(id)}] for id in range(1000)
+    ] == response.json['rows']
+    assert 2 == len([
+        query for query in response.json['explain'] if 'in (?' in query['sql']
+    ])
+
+
+@pytest.mark.parametrize('path,expected_error', [
+    ('/items/items.json?_expand=id', 'Cannot expand id: not a foreign key to a table with a label column'),
+    ('/items/items.json?_expand=nope', 'Cannot expand nope: no such column'),
+    ('/items.json?sql=select+item_id+from+event_0&_expand=item_id', 'Cannot expand item_id: not a foreign key to a table with a label column'),
+])
+def test_expand_errors(app_client_with_foreign_keys, path, expected_error):
+    response = app_client_with_foreign_keys.get(path, gather_request=False)
+    assert 400 == response.status
+    assert expected_error == response.json['error']
+
+
+def test_expand_custom_sql_ambiguous():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'ambiguous.db')
+        conn = sqlite3.connect(filepath)
+        conn.executescript('''
+            CREATE TABLE cities (id integer primary key, name text);
+            CREATE TABLE people (id integer primary key, name text);
+            CREATE TABLE events (owner integer, FOREIGN KEY (owner) REFERENCES cities(id));
+            CREATE TABLE pets (owner integer, FOREIGN KEY (owner) REFERENCES people(id));
+        ''')
+        conn.close()
+        client = Datasette([filepath]).app().test_client
+        response = client.get(
+            '/ambiguous.json?sql=select+owner+from+pets&_expand=owner',
+            gather_request=False
+        )
+    assert 400 == response.status
+    assert (
+        'Cannot expand owner: it could be a foreign key to cities.id, people.id'
+    ) == response.json['error']
+
+
+def test_sort_rowid_table(app_client):
+    response = app_client.get(
+        '/test_tables/no_primary_key.json?_sort_desc=content', gather_request=False
+    )
+    assert (
+        'select rowid, * from no_primary_key order by "content" desc, "rowid" desc limit 51'
+    ) == response.json['query']['sql']
+    # content is text, so '9' sorts between '90' and '89'
+    assert '54,54' == response.json['next']
+    response = app_client.get(response.json['next_url'], gather_request=False)
+    assert ['53', '52'] == [row[1] for row in response.json['rows'][:2]]
+
+
+def test_filtered_count_ignores_next(app_client):
+    path = '/test_tables/no_primary_key.json?a__contains=a1'
+    counts = []
+    while path:
+        response = app_client.get(path, gather_request=False)
+        counts.append(response.json['filtered_table_rows'])
+        path = response.json['next_url']
+    # a1, a10 to a19 and a100 to a199
+    assert [111, 111, 111] == counts
+
+
+def test_count_only(app_client):
+    response = app_client.get(
+        '/test_tables/no_primary_key.json?a__contains=a1&_next=20&_count_only=1',
+        gather_request=False
+    )
+    assert {
+        'database': 'test_tables',
+        'table': 'no_primary_key',
+        'filtered_table_rows': 111,
+        'query': {
+            'sql': 'select count(*) from no_primary_key where "a" like :p0 ',
+            'params': {'p0': '%a1%'},
+        },
+    } == response.json
+
+
+def test_deferred_counts(app_client_with_deferred_counts):
+    path = '/test_tables/no_primary_key.json?a__contains=a1'
+    response = app_client_with_deferred_counts.get(path, gather_request=False)
+    assert 50 == len(response.json['rows'])
+    assert None is response.json['filtered_table_rows']
+    count_url = response.json['count_url']
+    assert count_url.startswith('/test_tables-')
+    assert count_url.endswith('/no_primary_key.json?_count_only=1&a__contains=a1')
+    response = app_client_with_deferred_counts.get(count_url, gather_request=False)
+    assert 111 == response.json['filtered_table_rows']
+    # The count has been cached, so now it comes back with the page
+    response = app_client_with_deferred_counts.get(path, gather_request=False)
+    assert 111 == response.json['filtered_table_rows']
+    assert None is response.json['count_url']
+    # HTML pages fill in the count once it has loaded
+    response = app_client_with_deferred_counts.get(
+        '/test_tables/no_primary_key?a__contains=a', gather_request=False
+    )
+    assert '/no_primary_key.json?_count_only=1&amp;a__contains=a"' in response.text
+
+
 @pytest.mark.parametrize('path,expected_rows', [
     ('/test_tables/simple_primary_key.json?content=hello', [
         ['1', 'hello'],
@@ -216,12 +1004,40 @@ def test_paginate_tables_and_views(app_client, path, expected_rows, expected_pag
         ['1', 'hello'],
         ['3', ''],
     ]),
+    ('/test_tables/simple_primary_key.json?content__regex=l%7B2%7D|^w', [
+        ['1', 'hello'],
+        ['2', 'world'],
+    ]),
 ])
 def test_table_filter_queries(app_client, path, expected_rows):
     response = app_client.get(path, gather_request=False)
     assert expected_rows == response.json['rows']
 
 
+@pytest.mark.parametrize('pattern,expected_error', [
+    ('(l+)+x', 'Regular expression has a repeat inside a repeat, which can be very slow: (l+)+x'),
+    ('(.*a){12}x', 'Regular expression has a repeat inside a repeat, which can be very slow: (.*a){12}x'),
+    ('(a|a)*b', 'Regular expression has a repeat of alternatives that can match the same text, which can be very slow: (a|a)*b'),
+])
+def test_table_filter_regex_catastrophic(app_client, pattern, expected_error):
+    response = app_client.get(
+        '/test_tables/simple_primary_key.json?content__regex={}'.format(
+            urllib.parse.quote(pattern)
+        ),
+        gather_request=False
+    )
+    assert 400 == response.status
+    assert expected_error == response.json['error']
+
+
+def test_regexp_sql_function(app_client):
+    response = app_client.get(
+        '/test_tables.json?sql=select+content+from+simple_primary_key+where+content+regexp+%27o%24%27',
+        gather_request=False
+    )
+    assert [['hello']] == response.json['rows']
+
+
 def test_max_returned_rows(app_client):
     response = app_client.get(
         '/test_tables.jsono?sql=select+content+from+no_primary_key',
@@ -0,0 +1,161 @@
+"""
+Benchmarks against very large generated databases. These are slow, so they
+only run if the DATASETTE_BENCHMARKS environment variable is set:
+
+    DATASETTE_BENCHMARKS=1 pytest -s tests/test_benchmarks.py
+"""
+from datasette.app import Datasette
+from .fixtures import (
+    make_compound_pk_database, make_foreign_key_database, make_wide_schema
+)
+import os
+import pytest
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get('DATASETTE_BENCHMARKS'),
+    reason='DATASETTE_BENCHMARKS is not set',
+)
+
+# Wall time, in milliseconds, that running each command with --help may take
+# beyond starting Python and importing click. Lower these if startup gets
+# faster, never raise them.
+STARTUP_TIME_BUDGETS_MS = {
+    'inspect': 80,
+    'skeleton': 80,
+    'publish': 80,
+    'package': 80,
+}
+
+
+@pytest.fixture(scope='session')
+def wide_database():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'wide.db')
+        make_wide_schema(filepath, 50000)
+        yield filepath
+
+
+def test_inspect_50000_tables(wide_database):
+    # SQLite parses the whole schema before the first query, which sets a
+    # floor on how fast inspect can be on this machine
+    start = time.time()
+    conn = sqlite3.connect('file:{}?immutable=1'.format(wide_database), uri=True)
+    conn.execute('select count(*) from sqlite_master').fetchone()
+    conn.close()
+    schema_load = time.time() - start
+    start = time.time()
+    tables = Datasette([wide_database]).inspect()['wide']['tables']
+    elapsed = time.time() - start
+    print('inspect of {} tables: {:.2f}s, schema load: {:.2f}s'.format(
+        len(tables), elapsed, schema_load
+    ))
+    assert 50000 + 500 * 5 == len(tables)
+    assert elapsed < 60
+
+
+def best_wall_time_ms(code, *args, repeat=5):
+    "Fastest of repeat runs of a Python subprocess, in milliseconds"
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_output(
+            [sys.executable, '-c', code] + list(args), stderr=subprocess.STDOUT
+        )
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+@pytest.mark.parametrize('command', sorted(STARTUP_TIME_BUDGETS_MS))
+def test_command_startup_time(command):
+    baseline_ms = best_wall_time_ms('import click')
+    elapsed_ms = best_wall_time_ms(
+        'import sys\n'
+        'from datasette.cli import cli\n'
+        'try:\n'
+        '    cli(sys.argv[1:])\n'
+        'except SystemExit:\n'
+        '    pass\n',
+        command, '--help'
+    )
+    print('{} --help: {:.1f}ms, {:.1f}ms importing click'.format(
+        command, elapsed_ms, baseline_ms
+    ))
+    assert elapsed_ms - baseline_ms < STARTUP_TIME_BUDGETS_MS[command]
+
+
+@pytest.fixture(scope='module')
+def foreign_key_database():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'fks.db')
+        make_foreign_key_database(filepath, num_foreign_keys=4)
+        yield filepath
+
+
+def best_time(client, path, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        response = client.get(path, gather_request=False)
+        times.append(time.time() - start)
+        assert 200 == response.status
+    return min(times)
+
+
+@pytest.mark.skipif(
+    (os.cpu_count() or 1) < 2,
+    reason='Concurrent queries need more than one CPU to run faster'
+)
+@pytest.mark.parametrize('path', [
+    # Four foreign key label lookups
+    '/fks/items',
+    # The row, four label lookups and the incoming foreign key counts
+    '/fks/items/1',
+])
+def test_concurrent_queries(foreign_key_database, path):
+    timings = {}
+    for num_threads in (1, 5):
+        client = Datasette(
+            [foreign_key_database], num_threads=num_threads, sql_time_limit_ms=10000
+        ).app().test_client
+        timings[num_threads] = best_time(client, path)
+    print('{}: {:.0f}ms with 1 thread, {:.0f}ms with 5 threads'.format(
+        path, timings[1] * 1000, timings[5] * 1000
+    ))
+    assert timings[5] < timings[1]
+
+
+@pytest.fixture(scope='module')
+def compound_pk_database():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'compound.db')
+        make_compound_pk_database(filepath, 2000000)
+        yield filepath
+
+
+def test_compound_primary_key_pagination_depth(compound_pk_database):
+    client = Datasette([compound_pk_database]).app().test_client
+    timings = {}
+    for next in ('0,10', '1000,500', '1999,0'):
+        times = []
+        for _ in range(5):
+            response = client.get(
+                '/compound/readings.json?_next={}'.format(next), gather_request=False
+            )
+            times.append(response.json['query_ms'])
+            assert 100 == len(response.json['rows'])
+        timings[next] = min(times)
+    print('Page times by depth: {}'.format(', '.join(
+        '{}: {:.1f}ms'.format(next, ms) for next, ms in timings.items()
+    )))
+    # The page query seeks straight to the starting key
+    conn = sqlite3.connect(compound_pk_database)
+    plan = ' '.join(str(row[-1]) for row in conn.execute(
+        'explain query plan ' + response.json['query']['sql'], response.json['query']['params']
+    ))
+    assert 'SEARCH' in plan
+    assert timings['1999,0'] < timings['0,10'] * 3
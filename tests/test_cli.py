@@ -0,0 +1,205 @@
+"""
+Tests for the datasette command-line interface.
+"""
+from click.testing import CliRunner
+from datasette.app import Datasette
+from datasette.cli import cli
+from .fixtures import TABLES, make_foreign_key_database
+import json
+import os
+import pytest
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+# Modules that only the serve command should need
+SERVING_MODULES = ('sanic', 'jinja2', 'datasette.app')
+
+RUN_COMMAND = '''
+import sys
+from datasette.cli import cli
+try:
+    cli(sys.argv[1:])
+except SystemExit:
+    pass
+print(' '.join(sorted(sys.modules)))
+'''
+
+
+@pytest.fixture(scope='module')
+def database():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'test_tables.db')
+        conn = sqlite3.connect(filepath)
+        conn.executescript(TABLES)
+        conn.close()
+        yield filepath
+
+
+def imported_modules(*args):
+    output = subprocess.check_output(
+        [sys.executable, '-c', RUN_COMMAND] + list(args),
+        stderr=subprocess.DEVNULL,
+    )
+    return output.decode('utf8').strip().splitlines()[-1].split()
+
+
+@pytest.mark.parametrize('args', [
+    ['inspect', '--help'],
+    ['skeleton', '--help'],
+    ['publish', '--help'],
+    ['package', '--help'],
+    ['trigrams', '--help'],
+    ['optimize', '--help'],
+])
+def test_commands_do_not_import_serving_stack(args):
+    modules = imported_modules(*args)
+    assert 'datasette.cli' in modules
+    for module in SERVING_MODULES:
+        assert module not in modules
+
+
+def test_inspect_does_not_import_serving_stack(database):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inspect_file = os.path.join(tmpdir, 'inspect.json')
+        modules = imported_modules('inspect', database, '--inspect-file', inspect_file)
+        assert os.path.exists(inspect_file)
+    for module in SERVING_MODULES:
+        assert module not in modules
+
+
+def test_skeleton_does_not_import_serving_stack(database):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        metadata = os.path.join(tmpdir, 'metadata.json')
+        modules = imported_modules('skeleton', database, '-m', metadata)
+        assert 'simple_primary_key' in json.load(open(metadata))['databases']['test_tables']['tables']
+    for module in SERVING_MODULES:
+        assert module not in modules
+
+
+def test_inspect_matches_datasette_inspect(database):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        inspect_file = os.path.join(tmpdir, 'inspect.json')
+        result = CliRunner().invoke(cli, ['inspect', database, '--inspect-file', inspect_file])
+        assert 0 == result.exit_code, result.output
+        inspect_data = json.load(open(inspect_file))
+    assert json.loads(json.dumps(Datasette([database]).inspect())) == inspect_data
+
+
+def test_trigrams():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'test_tables.db')
+        conn = sqlite3.connect(filepath)
+        conn.executescript(TABLES)
+        conn.close()
+        runner = CliRunner()
+        result = runner.invoke(cli, ['trigrams', filepath, 'no_primary_key', 'a', 'b'])
+        assert 0 == result.exit_code, result.output
+        assert os.path.exists(filepath + '.trigrams')
+        result = runner.invoke(cli, ['trigrams', filepath, 'sortable', 'missing'])
+        assert 1 == result.exit_code
+        assert 'Column not found: missing' in result.output
+
+        ds = Datasette([filepath], page_size=1000, max_returned_rows=1000)
+        info = ds.inspect()['test_tables']
+        assert filepath + '.trigrams' == info['trigrams_file']
+        assert ['a', 'b'] == sorted(info['tables']['no_primary_key']['trigram_columns'])
+        client = ds.app().test_client
+        conn = sqlite3.connect(filepath)
+        for filter, like in (
+            ('a__contains=A11', '%A11%'),
+            ('b__endswith=b10', '%b10'),
+            ('a__contains=a1', '%a1%'),
+        ):
+            response = client.get(
+                '/test_tables/no_primary_key.json?_col=a&_col=b&' + filter,
+                gather_request=False,
+            )
+            column = filter[0]
+            expected = sorted(
+                r[0] for r in conn.execute(
+                    'select rowid from no_primary_key where {} like ?'.format(column),
+                    [like]
+                )
+            )
+            assert expected == sorted(row[0] for row in response.json['rows'])
+            assert (len(like.strip('%')) >= 3) == (
+                'trigrams.' in response.json['query']['sql']
+            )
+
+        # Changing the database makes the sidecar stale, so it is ignored
+        conn.execute('insert into no_primary_key (a) values ("a11")')
+        conn.commit()
+        conn.close()
+        info = Datasette([filepath]).inspect()['test_tables']
+        assert 'trigrams_file' not in info
+        assert 'trigram_columns' not in info['tables']['no_primary_key']
+
+
+def test_optimize():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'items.db')
+        make_foreign_key_database(filepath, num_foreign_keys=2, num_rows=1000)
+        metadata = os.path.join(tmpdir, 'metadata.json')
+        open(metadata, 'w').write(json.dumps({
+            'databases': {'items': {'tables': {
+                'event_0': {'sortable_columns': ['note']},
+            }}},
+        }))
+        result = CliRunner().invoke(
+            cli, ['optimize', filepath, '-m', metadata, '--page-size', '8192']
+        )
+        assert 0 == result.exit_code, result.output
+        lines = result.output.splitlines()
+        assert [
+            'Created index idx_event_0_item_id',
+            'Created index idx_event_0_note',
+            'Created index idx_event_1_item_id',
+            'Created index idx_items_label_0',
+            'Created index idx_items_label_1',
+            'Created index idx_label_0_id',
+            'Created index idx_label_1_id',
+        ] == sorted(line.strip() for line in lines if 'Created index' in line)
+        assert '  Ran ANALYZE and VACUUM' in lines
+        assert any(line.startswith('  event_0: sort by note: ') for line in lines)
+        conn = sqlite3.connect(filepath)
+        assert 8192 == conn.execute('PRAGMA page_size').fetchone()[0]
+        assert conn.execute('select count(*) from sqlite_stat1').fetchone()[0]
+        conn.close()
+        # Everything is indexed now, so running it again creates nothing
+        result = CliRunner().invoke(cli, ['optimize', filepath, '--no-vacuum'])
+        assert 0 == result.exit_code, result.output
+        assert 'Created index' not in result.output
+        assert '  Ran ANALYZE' in result.output.splitlines()
+
+
+def test_optimize_fk_counts():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'items.db')
+        make_foreign_key_database(filepath, num_foreign_keys=2, num_rows=1000)
+        path = '/items/items/7.json?_extras=foreign_key_tables&_explain=1'
+        client = Datasette([filepath]).app().test_client
+        expected = client.get(path, gather_request=False).json['foreign_key_tables']
+        assert [10, 10] == [fk['count'] for fk in expected]
+
+        result = CliRunner().invoke(cli, ['optimize', filepath, '--fk-counts'])
+        assert 0 == result.exit_code, result.output
+        # 100 items referenced by each event table, 100 labels of each kind
+        assert '  Stored 400 foreign key counts' in result.output.splitlines()
+        ds = Datasette([filepath])
+        info = ds.inspect()['items']
+        assert '_datasette_fk_counts' == info['fk_counts_table']
+        assert info['tables']['_datasette_fk_counts']['hidden']
+        response = ds.app().test_client.get(path, gather_request=False)
+        assert expected == response.json['foreign_key_tables']
+        assert any(
+            '_datasette_fk_counts' in query['sql']
+            for query in response.json['explain']
+        )
+
+
+def test_optimize_invalid_page_size(database):
+    result = CliRunner().invoke(cli, ['optimize', database, '--page-size', '1000'])
+    assert 1 == result.exit_code
+    assert '--page-size must be a power of two between 512 and 65536' in result.output
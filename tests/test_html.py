@@ -1,10 +1,16 @@
 from bs4 import BeautifulSoup as Soup
-from .fixtures import app_client
+from .fixtures import (
+    app_client,
+    app_client_with_search,
+    app_client_with_truncated_cells,
+)
 import pytest
 import re
 import urllib.parse
 
 pytest.fixture(scope='module')(app_client)
+pytest.fixture(scope='module')(app_client_with_search)
+pytest.fixture(scope='module')(app_client_with_truncated_cells)
 
 
 def test_homepage(app_client):
@@ -154,6 +160,16 @@ def test_css_classes_on_body(app_client, path, expected_classes):
     assert classes == expected_classes
 
 
+def test_table_html_col(app_client):
+    response = app_client.get(
+        '/test_tables/complex_foreign_keys?_col=f2', gather_request=False
+    )
+    table = Soup(response.body, 'html.parser').find('table')
+    assert [
+        'Link', 'pk', 'f2'
+    ] == [th.string for th in table.select('thead th')]
+
+
 def test_table_html_simple_primary_key(app_client):
     response = app_client.get('/test_tables/simple_primary_key', gather_request=False)
     table = Soup(response.body, 'html.parser').find('table')
@@ -280,3 +296,80 @@ def test_view_html(app_client):
         ]
     ]
     assert expected == [[str(td) for td in tr.select('td')] for tr in table.select('tbody tr')]
+
+
+@pytest.mark.parametrize('query_string,expected_warning', [
+    ('_sort=sortable', None),
+    ('_sort_desc=sortable_with_nulls', 'Sorted by sortable_with_nulls descending, which is not indexed - pages may be slow'),
+])
+def test_sort_warning(app_client, query_string, expected_warning):
+    response = app_client.get(
+        '/test_tables/sortable?{}'.format(query_string), gather_request=False
+    )
+    assert response.status == 200
+    warning = Soup(response.body, 'html.parser').find('p', {'class': 'sort-warning'})
+    if expected_warning is None:
+        assert warning is None
+    else:
+        assert expected_warning == warning.text
+
+
+def test_facets(app_client):
+    response = app_client.get(
+        '/test_tables/compound_three_primary_keys?pk2=a', gather_request=False
+    )
+    assert response.status == 200
+    facet = Soup(response.body, 'html.parser').find(
+        'div', {'class': 'facet-test_tables-compound_three_primary_keys-pk1'}
+    )
+    assert 'pk1' == facet.find('strong').text
+    assert [
+        ('a', 'compound_three_primary_keys?pk1=a&pk2=a'),
+        ('e', 'compound_three_primary_keys?pk1=e&pk2=a'),
+    ] == [
+        (a.text, a['href'].split('/')[-1]) for a in facet.find_all('a')
+    ][::4]
+
+
+def test_truncated_cells(app_client_with_truncated_cells):
+    response = app_client_with_truncated_cells.get(
+        '/test_tables/simple_primary_key', gather_request=False
+    )
+    table = Soup(response.body, 'html.parser').find('table')
+    assert (
+        '<td>he… <a href="/test_tables/simple_primary_key/1/content">(5 characters)</a></td>'
+    ) == str(table.select('tbody tr')[0].select('td')[2])
+
+
+def test_search_rank_snippets(app_client_with_search):
+    response = app_client_with_search.get(
+        '/search/documents?_search=pond&_rank=1', gather_request=False
+    )
+    table = Soup(response.body, 'html.parser').find('table')
+    assert 'Snippet' == table.select('thead th')[1].text.strip()
+    assert (
+        '<td>Fish swim in the <b>pond</b></td>'
+    ) == str(table.select('tbody tr')[0].select('td')[1])
+    # Tags in the text itself are escaped
+    response = app_client_with_search.get(
+        '/search/documents?_search=tag&_rank=1', gather_request=False
+    )
+    assert (
+        'Close a &lt;b&gt; <b>tag</b> with &lt;/b&gt;'
+    ) in response.text
+
+
+def test_unindexed_filter_warning(app_client):
+    response = app_client.get(
+        '/test_tables/sortable?content__contains=a&sortable__gt=3&_explain=1',
+        gather_request=False
+    )
+    soup = Soup(response.body, 'html.parser')
+    assert (
+        "Filtering by content__contains can't use an index - pages may be slow"
+    ) == soup.find('p', {'class': 'filter-warning'}).text
+    assert ['content'] == [
+        row.find('option', selected=True).text
+        for row in soup.select('.filter-row.filter-unindexed')
+    ]
+    assert 'Query plans' == soup.find('div', {'class': 'explain'}).find('h3').text
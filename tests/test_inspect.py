@@ -1,4 +1,6 @@
-from datasette.app import Datasette
+from datasette.app import BaseView, Datasette, connections
+from .fixtures import TABLES as FIXTURE_TABLES, make_wide_schema
+import asyncio
 import os
 import pytest
 import sqlite3
@@ -101,3 +103,165 @@ def test_inspect_foreign_keys(ds_instance):
         key=lambda d: d['column']
     )
     assert [] == election_results['foreign_keys']['incoming']
+
+
+def test_reload_changed_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepaths = [
+            os.path.join(tmpdir, '{}.db'.format(name))
+            for name in ('one', 'two')
+        ]
+        for filepath in filepaths:
+            conn = sqlite3.connect(filepath)
+            conn.execute('CREATE TABLE t (id integer primary key)')
+            conn.commit()
+            conn.close()
+        metadata_file = os.path.join(tmpdir, 'metadata.json')
+        open(metadata_file, 'w').write('{"title": "Before"}')
+        ds = Datasette(
+            filepaths,
+            metadata={'title': 'Before'},
+            metadata_file=metadata_file,
+            watch=True,
+        )
+        before = dict(ds.inspect())
+        # Nothing has changed yet
+        ds.reload_changed_files()
+        assert before == ds.inspect()
+
+        conn = sqlite3.connect(filepaths[0])
+        conn.execute('INSERT INTO t VALUES (1)')
+        conn.commit()
+        conn.close()
+        open(metadata_file, 'w').write('{"title": "After"}')
+        ds.reload_changed_files()
+        after = ds.inspect()
+        assert 1 == after['one']['tables']['t']['count']
+        assert before['one']['hash'] != after['one']['hash']
+        # The database that did not change keeps its existing inspect data
+        assert before['two'] is after['two']
+        assert {'title': 'After'} == ds.metadata
+
+
+def test_lazy_inspect_with_max_open_databases():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepaths = []
+        for name in ('a', 'b', 'c'):
+            filepath = os.path.join(tmpdir, '{}.db'.format(name))
+            conn = sqlite3.connect(filepath)
+            conn.execute('CREATE TABLE t (id integer primary key)')
+            conn.close()
+            filepaths.append(filepath)
+        ds = Datasette(filepaths, lazy=True, max_open_databases=2)
+        # Nothing is inspected until it is needed
+        assert not ds._inspect
+        assert ds.has_database('b')
+        assert not ds.has_database('d')
+        summaries, next_name = ds.database_summaries()
+        assert [{'name': n, 'hash': None, 'path': n} for n in 'abc'] == summaries
+        assert None is next_name
+        for name in ('a', 'b', 'c'):
+            assert 0 == ds.database_info(name)['tables']['t']['count']
+            ds.connection(name)
+        # Only the two most recently used are kept
+        assert ['b', 'c'] == list(ds._inspect.keys())
+        assert ['b', 'c'] == list(connections.databases.keys())
+        # Summaries survive eviction, and can be paginated
+        summaries, next_name = ds.database_summaries(size=2)
+        assert ['a', 'b'] == [s['name'] for s in summaries]
+        assert all(s['tables_count'] == 1 for s in summaries)
+        assert [{'name': 't', 'count': 0}] == summaries[0]['tables_truncated']
+        assert 'b' == next_name
+        summaries, next_name = ds.database_summaries(after='b', size=2)
+        assert ['c'] == [s['name'] for s in summaries]
+        assert None is next_name
+
+
+def test_lazy_database_info_kept_for_request():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepaths = []
+        for name in ('a', 'b'):
+            filepath = os.path.join(tmpdir, '{}.db'.format(name))
+            conn = sqlite3.connect(filepath)
+            conn.execute('CREATE TABLE t (id integer primary key)')
+            conn.close()
+            filepaths.append(filepath)
+        ds = Datasette(filepaths, lazy=True, max_open_databases=1)
+        ds.app()
+        view = BaseView(ds)
+        loop = asyncio.new_event_loop()
+        try:
+            name, hash, _ = loop.run_until_complete(view.resolve_db_name('a'))
+        finally:
+            loop.close()
+        # Another request evicts a while this one is still running
+        ds.database_info('b')
+        assert ['b'] == list(ds._inspect.keys())
+
+        def inspect_file(filename):
+            raise AssertionError('Inspected {} again'.format(filename))
+        ds.inspect_file = inspect_file
+        assert hash == view.database_info('a')['hash'][:len(hash)]
+        assert 0 == view.database_info('a')['tables']['t']['count']
+
+
+def test_inspect_wide_schema():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'wide.db')
+        make_wide_schema(filepath, 250)
+        conn = sqlite3.connect(filepath)
+        conn.execute("INSERT INTO shard_5 (name) VALUES ('five')")
+        conn.commit()
+        conn.close()
+        tables = Datasette([filepath]).inspect()['wide']['tables']
+    assert 250 + 3 * 5 == len(tables)
+    assert 1 == tables['shard_5']['count']
+    assert 0 == tables['shard_0']['count']
+    assert ['id', 'name', 'previous_id'] == tables['shard_5']['columns']
+    assert {
+        'incoming': [{
+            'other_table': 'shard_6',
+            'column': 'id',
+            'other_column': 'previous_id',
+        }],
+        'outgoing': [{
+            'other_table': 'shard_4',
+            'column': 'previous_id',
+            'other_column': 'id',
+        }],
+    } == tables['shard_5']['foreign_keys']
+    hidden = sorted(name for name, table in tables.items() if table['hidden'])
+    assert 'shard_100_fts' in hidden
+    assert 'shard_100_fts_segdir' in hidden
+    assert not tables['shard_100']['hidden']
+    assert 'shard_100_fts' == tables['shard_100']['fts_table']
+    assert None is tables['shard_101']['fts_table']
+    assert ['id'] == tables['shard_5']['primary_keys']
+    assert 3 * 5 == len(hidden)
+
+
+def test_table_pages_without_schema_registry():
+    # Inspect data generated by older versions lacks primary keys,
+    # definitions and FTS tables, so those get looked up per request
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filepath = os.path.join(tmpdir, 'test_tables.db')
+        conn = sqlite3.connect(filepath)
+        conn.executescript(FIXTURE_TABLES)
+        conn.close()
+        inspect_data = Datasette([filepath]).inspect()
+        del inspect_data['test_tables']['view_definitions']
+        for table in inspect_data['test_tables']['tables'].values():
+            for key in ('primary_keys', 'fts_table', 'sql'):
+                del table[key]
+        client = Datasette([filepath], inspect_data=inspect_data).app().test_client
+        for path, is_view, pks in (
+            ('/test_tables/compound_primary_key.json', False, ['pk1', 'pk2']),
+            ('/test_tables/simple_view.json', True, []),
+        ):
+            response = client.get(path, gather_request=False)
+            assert is_view == response.json['is_view']
+            assert pks == response.json['primary_keys']
+            if is_view:
+                assert response.json['view_definition'].startswith('CREATE VIEW')
+            else:
+                assert response.json['table_definition'].startswith('CREATE TABLE')
@@ -3,6 +3,7 @@ Tests for various datasette helper functions.
 """
 
 from datasette import utils
+import itertools
 import json
 import os
 import pytest
@@ -92,6 +93,13 @@ def test_custom_json_encoder(obj, expected):
         ['"foo" like :p0', '"zax" glob :p1'],
         ['2%2', '3*']
     ),
+    (
+        {
+            'foo__regex': '^a.*b$',
+        },
+        ['"foo" regexp :p0'],
+        ['^a.*b$']
+    ),
     (
         {
             'foo__isnull': '1',
@@ -112,6 +120,216 @@ def test_build_where(args, expected_where, expected_params):
     } == actual_params
 
 
+def test_build_where_with_column_types():
+    f = utils.Filters(sorted({
+        'name__startswith': 'Cle',
+        'score__gt': '-1.5',
+        'age': '3',
+        'code': '7',
+        'misc__lt': '2',
+    }.items()))
+    sql_bits, params = f.build_where_clauses({
+        'name': 'varchar(30)',
+        'score': 'REAL',
+        'age': 'INTEGER',
+        'code': 'TEXT',
+        'misc': '',
+    })
+    assert [
+        '"age" = :p0',
+        '"code" = :p1',
+        '"misc" < :p2',
+        '("name" >= :p3_lower and "name" < :p3_upper and "name" like :p3)',
+        '"score" > :p4',
+    ] == sql_bits
+    assert {
+        'p0': 3,
+        'p1': '7',
+        'p2': 2,
+        'p3': 'Cle%',
+        'p3_lower': 'CLE',
+        'p3_upper': 'clf',
+        'p4': -1.5,
+    } == params
+
+
+def test_build_where_with_trigram_tables():
+    f = utils.Filters([('a__contains', 'abc'), ('a__endswith', 'ab'), ('b__contains', 'abc')])
+    sql_bits, params = f.build_where_clauses(trigram_tables={'a': 'trigrams_0'})
+    assert [
+        '(rowid in (select rowid from trigrams.[trigrams_0] where value like :p0) and "a" like :p0)',
+        '"a" like :p1',
+        '"b" like :p2',
+    ] == sql_bits
+    assert {'p0': '%abc%', 'p1': '%ab', 'p2': '%abc%'} == params
+
+
+@pytest.mark.parametrize('declared_type,expected', [
+    ('INTEGER', 'INTEGER'),
+    ('BIGINT', 'INTEGER'),
+    ('varchar(30)', 'TEXT'),
+    ('CLOB', 'TEXT'),
+    ('', 'BLOB'),
+    (None, 'BLOB'),
+    ('BLOB', 'BLOB'),
+    ('DOUBLE PRECISION', 'REAL'),
+    ('FLOAT', 'REAL'),
+    ('DECIMAL(10,5)', 'NUMERIC'),
+    ('BOOLEAN', 'NUMERIC'),
+])
+def test_column_affinity(declared_type, expected):
+    assert expected == utils.column_affinity(declared_type)
+
+
+@pytest.mark.parametrize('prefix,expected', [
+    ('abc', 'abd'),
+    ('a\U0010ffff', 'b'),
+    ('\U0010ffff', None),
+    ('a\ud7ff', 'a\ue000'),
+    ('', None),
+])
+def test_prefix_upper_bound(prefix, expected):
+    assert expected == utils.prefix_upper_bound(prefix)
+
+
+@pytest.mark.parametrize('pattern,value,expected', [
+    ('^c', 'cat', 1),
+    ('a+t$', 'cat', 1),
+    ('z', 'cat', 0),
+    ('2', 123, 1),
+    ('a', None, None),
+    ('b$', 'a' * utils.REGEXP_MAX_VALUE_LENGTH + 'b', 0),
+])
+def test_regexp(pattern, value, expected):
+    assert expected == utils.regexp(pattern, value)
+
+
+@pytest.mark.parametrize('pattern,ok', [
+    (r'\d+(\.\d+)?', True),
+    ('(ab){2,5}', True),
+    ('(a|b)*c', True),
+    ('(a+)+$', False),
+    ('(.*)*x', False),
+    ('((a)+|b)*', False),
+    ('(a|a)*b', False),
+    ('(a|ab)*c', False),
+    ('(x|y|xy)+', False),
+    ('(?i)(cat|CAT)+', False),
+    ('(.*a){12}x', False),
+    ('(foo|far)+', True),
+    ('([a-c]x|[d-f]x)+', True),
+    ('(ab|cd){2}', True),
+    ('(a+|b)?', True),
+    ('x[', False),
+])
+def test_compile_regexp(pattern, ok):
+    if ok:
+        assert utils.compile_regexp(pattern).pattern == pattern
+    else:
+        with pytest.raises(utils.DatasetteError):
+            utils.compile_regexp(pattern)
+
+
+@pytest.mark.parametrize('q,expected', [
+    ('ca', 'ca*'),
+    ('Black CA', 'black ca*'),
+    ('"cat" OR (dog', 'cat or dog*'),
+    ('  ', None),
+    ('"*', None),
+])
+def test_fts_prefix_query(q, expected):
+    assert expected == utils.fts_prefix_query(q)
+
+
+@pytest.mark.parametrize('args,expected_names', [
+    # startswith ignores the case of ASCII letters, like LIKE does
+    ({'name__startswith': 'Cle'}, ['Cleo', 'cleopatra']),
+    ({'name__startswith': 'cLEO'}, ['Cleo', 'cleopatra']),
+    ({'name__startswith': 'Pan'}, ['Pancakes']),
+    ({'score__gte': '-1.5'}, ['Cleo', 'Pancakes', 'cleopatra']),
+    ({'score': '2.5'}, ['Cleo']),
+])
+def test_build_where_uses_index(args, expected_names):
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE people (id integer primary key, name text, score real);
+    CREATE INDEX idx_name ON people (name);
+    CREATE INDEX idx_score ON people (score);
+    INSERT INTO people (name, score) VALUES ('Cleo', 2.5);
+    INSERT INTO people (name, score) VALUES ('cleopatra', -1.5);
+    INSERT INTO people (name, score) VALUES ('Pancakes', 3);
+    ''')
+    sql_bits, params = utils.Filters(sorted(args.items())).build_where_clauses({
+        'id': 'integer', 'name': 'text', 'score': 'real',
+    })
+    sql = 'select * from people where {}'.format(' and '.join(sql_bits))
+    plan = ' '.join(r[-1] for r in conn.execute('explain query plan ' + sql, params))
+    assert 'USING INDEX' in plan
+    assert expected_names == sorted(
+        r[1] for r in conn.execute(sql, params).fetchall()
+    )
+
+
+@pytest.mark.parametrize('prefix', ['Cle', 'CLEO', 'c_e', 'Pan%', '\xe9', 'zz', ''])
+def test_build_where_startswith_matches_like(prefix):
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE people (name text)')
+    conn.executemany('INSERT INTO people VALUES (?)', [
+        (name,) for name in (
+            'Cleo', 'cleopatra', 'CLEOPATRA', 'cue', 'Pancakes', '\xe9clair',
+            '\xc9clair', 'Zz', '[cle]', '',
+        )
+    ])
+    sql_bits, params = utils.Filters([('name__startswith', prefix)]).build_where_clauses({
+        'name': 'text',
+    })
+    assert sorted(
+        r[0] for r in conn.execute('select name from people where ' + sql_bits[0], params)
+    ) == sorted(
+        r[0] for r in conn.execute('select name from people where name like ?', [prefix + '%'])
+    )
+
+
+@pytest.mark.parametrize('dbstat_min_tables', [0, 1000])
+def test_get_all_table_counts(monkeypatch, dbstat_min_tables):
+    monkeypatch.setattr(utils, 'DBSTAT_MIN_TABLES', dbstat_min_tables)
+    monkeypatch.setattr(utils, 'COUNT_CHUNK_SIZE', 2)
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE empty (id integer primary key);
+    CREATE TABLE big (id integer primary key, body text);
+    CREATE TABLE pairs (a text, b text, PRIMARY KEY (a, b)) WITHOUT ROWID;
+    CREATE VIRTUAL TABLE docs USING fts4 (body);
+    ''')
+    conn.executemany('INSERT INTO big VALUES (?, ?)', [(i, 'x' * 100) for i in range(5000)])
+    conn.executemany('INSERT INTO pairs VALUES (?, ?)', [
+        ('a' * 50 + str(i), str(i)) for i in range(3000)
+    ])
+    conn.executemany('INSERT INTO docs VALUES (?)', [('hello',), ('world',)])
+    tables = ['empty', 'big', 'pairs', 'docs']
+    assert {
+        'empty': 0,
+        'big': 5000,
+        'pairs': 3000,
+        'docs': 2,
+    } == utils.get_all_table_counts(conn, tables)
+
+
+def test_get_all_indexed_columns():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE pairs (a, b, c, PRIMARY KEY (a, b)) WITHOUT ROWID;
+    CREATE INDEX idx_pairs_c ON pairs (c);
+    CREATE TABLE people (id integer primary key, name text unique, age);
+    CREATE TABLE plain (a, b);
+    ''')
+    assert {
+        'pairs': {'a', 'c'},
+        'people': {'name'},
+        'plain': set(),
+    } == utils.get_all_indexed_columns(conn)
+
+
 @pytest.mark.parametrize('bad_sql', [
     'update blah;',
     'PRAGMA case_sensitive_like = true'
@@ -160,6 +378,65 @@ def test_detect_fts():
     assert 'Street_Tree_List_fts' == utils.detect_fts(conn, 'Street_Tree_List')
 
 
+def test_get_column_stats():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE dogs (id integer primary key, breed text, age integer);
+    INSERT INTO dogs VALUES (1, 'pug', 3);
+    INSERT INTO dogs VALUES (2, 'pug', null);
+    INSERT INTO dogs VALUES (3, 'corgi', 5);
+    INSERT INTO dogs VALUES (4, null, 3);
+    ''')
+    stats = utils.get_column_stats(conn, 'dogs', ['id', 'breed', 'age'], 1000, top_k=2)
+    assert {
+        'nulls': 0,
+        'distinct': 4,
+        'min': 1,
+        'max': 4,
+        'top': [],
+    } == stats['id']
+    assert {
+        'nulls': 1,
+        'distinct': 2,
+        'min': 'corgi',
+        'max': 'pug',
+        'top': [['pug', 2], [None, 1]],
+    } == stats['breed']
+    assert 1 == stats['age']['nulls']
+    assert [3, 2] == stats['age']['top'][0]
+
+
+def test_get_column_stats_time_limit():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (a integer)')
+    stats = utils.get_column_stats(conn, 't', ['a'], 0)
+    assert {
+        'nulls': None,
+        'distinct': None,
+        'min': None,
+        'max': None,
+        'top': None,
+    } == stats['a']
+
+
+def test_get_facet_counts():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+    CREATE TABLE dogs (id integer primary key, breed text, age integer);
+    INSERT INTO dogs VALUES (1, 'pug', 3);
+    INSERT INTO dogs VALUES (2, 'pug', null);
+    INSERT INTO dogs VALUES (3, 'corgi', 5);
+    INSERT INTO dogs VALUES (4, null, 3);
+    ''')
+    facets = utils.get_facet_counts(conn, 'dogs', ['id', 'breed', 'age'], 1000, max_values=3)
+    # id has four distinct values, so is not a facet
+    assert {
+        'breed': [['pug', 2], [None, 1], ['corgi', 1]],
+        'age': [[3, 2], [None, 1], [5, 1]],
+    } == facets
+    assert {} == utils.get_facet_counts(conn, 'dogs', ['breed'], 0)
+
+
 @pytest.mark.parametrize('url,expected', [
     ('http://www.google.com/', True),
     ('https://example.com/', True),
@@ -224,3 +501,97 @@ def test_temporary_docker_directory_uses_copy_if_hard_link_fails(mock_link):
             assert 'world' == open(hello).read()
             # It should be a copy, not a hard link
             assert 1 == os.stat(hello).st_nlink
+
+
+def test_get_all_fts_tables():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript('''
+        CREATE TABLE dogs (id integer primary key, name text);
+        CREATE VIRTUAL TABLE dogs_search USING FTS4 (name, content="dogs");
+        CREATE VIRTUAL TABLE notes USING FTS4 (body);
+    ''')
+    fts_tables = utils.get_all_fts_tables(conn)
+    assert 'dogs_search' == fts_tables['dogs']
+    assert 'notes' == fts_tables['notes']
+    assert 'notes_content' not in fts_tables
+    for table in ('dogs', 'notes', 'notes_content'):
+        assert fts_tables.get(table) == utils.detect_fts(conn, table)
+
+
+@pytest.mark.parametrize('sqlite_version,expected', [
+    ((3, 22, 0), '("a", "b", "c") > (:p0, :p1, :p2)'),
+    ((3, 8, 0), '(("a" > :p0) or ("a" = :p0 and "b" > :p1) or ("a" = :p0 and "b" = :p1 and "c" > :p2))'),
+])
+def test_keyset_where_clause(sqlite_version, expected):
+    with patch('sqlite3.sqlite_version_info', sqlite_version):
+        sql = utils.keyset_where_clause(['a', 'b', 'c'], ['p0', 'p1', 'p2'])
+    assert expected == sql
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table t (a, b, c)')
+    conn.executemany('insert into t values (?, ?, ?)', itertools.product(range(3), repeat=3))
+    rows = conn.execute(
+        'select * from t where {} order by a, b, c'.format(sql),
+        {'p0': 1, 'p1': 0, 'p2': 2}
+    ).fetchall()
+    assert [(1, 1, 0), (1, 1, 1)] == rows[:2]
+    assert 15 == len(rows)
+
+
+@pytest.mark.parametrize('value,affinity,expected_path', [
+    (None, None, '$null'),
+    (5, 'INTEGER', '5'),
+    (5, None, '$int:5'),
+    (2.5, 'BLOB', '$float:2.5'),
+    ('5', None, '5'),
+    ('$int:5', None, '%24int%3A5'),
+    ('a,b', 'TEXT', 'a%2Cb'),
+    (b'\x00\xff', 'INTEGER', '$blob:00ff'),
+])
+def test_path_from_key_value(value, affinity, expected_path):
+    assert expected_path == utils.path_from_key_value(value, affinity)
+    assert value == utils.key_value_from_path(expected_path, affinity)
+
+
+def test_key_values_from_path():
+    assert [5, '5', None] == utils.key_values_from_path(
+        '5,5,$null', ['INTEGER', 'TEXT', 'NUMERIC']
+    )
+    assert None is utils.key_values_from_path('5', ['INTEGER', 'INTEGER'])
+    with pytest.raises(utils.DatasetteError):
+        utils.key_values_from_path('$int:x', [None])
+
+
+def test_keyset_where_clause_with_nulls():
+    assert (
+        '(("a" is not null) or ("a" is :p0 and "b" > :p1))'
+    ) == utils.keyset_where_clause(['a', 'b'], ['p0', 'p1'], values=[None, 1])
+    assert (
+        '((("a" < :p0 or "a" is null)))'
+    ) == utils.keyset_where_clause(['a', 'b'], ['p0', 'p1'], '<', values=[1, None])
+
+
+def test_keyset_where_clause_single_column():
+    assert '"id" > :p3' == utils.keyset_where_clause(['id'], ['p3'])
+
+
+def test_label_cache():
+    cache = utils.LabelCache(max_bytes=1000)
+    key = ('hash', 'labels', 'id', 'name')
+    assert ({}, [1, 2]) == cache.get_many(key, [1, 2])
+    cache.set_many(key, [1, 2], {1: 'one'})
+    # Ids with no row are remembered, so they aren't looked up again
+    assert ({1: 'one'}, [3]) == cache.get_many(key, [1, 2, 3])
+    assert ({}, [1]) == cache.get_many(('other',), [1])
+    cache.set_many(key, list(range(3, 100)), {i: str(i) for i in range(3, 100)})
+    assert cache.size <= 1000
+    assert 0 < len(cache) < 97
+    # The least recently used labels were evicted first
+    labels, missing = cache.get_many(key, [1, 99])
+    assert {99: '99'} == labels
+    assert [1] == missing
+
+
+def test_label_cache_disabled():
+    cache = utils.LabelCache(max_bytes=0)
+    cache.set_many('key', [1], {1: 'one'})
+    assert ({}, [1]) == cache.get_many('key', [1])